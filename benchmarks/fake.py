@@ -0,0 +1,32 @@
+import stellata.replay
+
+class FakePool:
+    """Stand-in for stellata.database.Pool that serves synthetic result sets without a database.
+
+    `respond` is called with `(sql, args)` for each query and returns a list of rows. Every statement is
+    counted, so benchmarks can report round trips as well as time.
+    """
+
+    in_use = 0
+
+    def __init__(self, respond=None):
+        self.respond = respond or (lambda sql, args: [])
+        self.queries = 0
+
+    def execute(self, sql: str, args: tuple = None):
+        self.queries += 1
+
+    def query(self, sql: str, args: tuple = None):
+        self.queries += 1
+        return self.respond(sql, args)
+
+    def reader(self):
+        return self
+
+    def writer(self):
+        return self
+
+def rows(columns: list, values: list):
+    """Build psycopg2 DictRows, the type real pools return, from a list of columns and a list of value lists."""
+
+    return stellata.replay.rows(columns, values)
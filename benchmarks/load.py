@@ -0,0 +1,312 @@
+"""Concurrent load test for a local PostgreSQL database.
+
+Runs a mix of `find`, `where().get()` (with a join), `create` and `update` calls from many threads, optionally in
+several processes, and reports throughput, latency percentiles, time spent waiting for a connection and how
+busy the pool was. Useful for tuning `pool_size` and comparing join strategies and pool implementations:
+
+    python -m benchmarks.load --threads 32 --pool-size 10 --duration 10
+    python -m benchmarks.load --threads 32 --pool-size 10 --join-type join
+    python -m benchmarks.load --threads 32 --pool-size 10 --pool psycopg2
+"""
+
+import argparse
+import collections
+import multiprocessing
+import psycopg2
+import psycopg2.pool
+import random
+import sys
+import threading
+import time
+
+import stellata.database
+import stellata.fields
+import stellata.index
+import stellata.model
+import stellata.pool
+import stellata.relations
+import stellata.schema
+
+class LoadA(stellata.model.Model):
+    __table__ = 'stellata_load_a'
+
+    id = stellata.fields.UUID(null=False)
+    name = stellata.fields.Text()
+    counter = stellata.fields.Integer(default=0)
+
+    b = stellata.relations.HasMany(lambda: LoadB.a_id)
+
+    primary_key = stellata.index.PrimaryKey(lambda: LoadA.id)
+
+class LoadB(stellata.model.Model):
+    __table__ = 'stellata_load_b'
+
+    id = stellata.fields.UUID(null=False)
+    a_id = stellata.fields.UUID(null=False)
+    value = stellata.fields.Integer()
+
+    primary_key = stellata.index.PrimaryKey(lambda: LoadB.id)
+    a_id_index = stellata.index.Index(lambda: LoadB.a_id)
+
+class _ThreadedPool:
+    """Adapts psycopg2's ThreadedConnectionPool to the interface stellata.database.Pool expects, for comparison.
+
+    psycopg2 raises PoolError when every connection is in use, so checkouts are retried until `timeout`.
+    """
+
+    def __init__(self, connect_args, max_size, timeout):
+        self.timeout = timeout
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=max_size, **connect_args)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters = 0
+        self._checkouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self.max_size = max_size
+
+    @property
+    def in_use(self):
+        return self._in_use
+
+    def getconn(self):
+        start = time.monotonic()
+        waiting = False
+        while True:
+            try:
+                connection = self._pool.getconn()
+                break
+            except psycopg2.pool.PoolError:
+                if time.monotonic() - start > self.timeout:
+                    raise stellata.pool.PoolTimeout('timed out waiting for a connection')
+
+                if not waiting:
+                    waiting = True
+                    with self._lock:
+                        self._waiters += 1
+
+                time.sleep(0.001)
+
+        waited = time.monotonic() - start
+        with self._lock:
+            if waiting:
+                self._waiters -= 1
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_time += waited
+            self._max_wait_time = max(self._max_wait_time, waited)
+
+        return connection
+
+    def putconn(self, connection):
+        with self._lock:
+            self._in_use -= 1
+        self._pool.putconn(connection)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self.max_size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': None,
+                'waiters': self._waiters,
+                'checkouts': self._checkouts,
+                'timeouts': None,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
+
+def _connect(args):
+    pool = stellata.database.Pool(
+        name=args.name,
+        user=args.user,
+        password=args.password,
+        host=args.host,
+        port=args.port,
+        pool_size=args.pool_size,
+        min_idle=min(args.pool_size, args.min_idle),
+        timeout=args.timeout
+    )
+
+    if args.pool == 'psycopg2':
+        pool._pool.closeall()
+        pool._pool = _ThreadedPool(
+            {'database': args.name, 'user': args.user, 'password': args.password, 'host': args.host,
+                'port': args.port},
+            args.pool_size,
+            args.timeout
+        )
+
+    return pool
+
+def _operations(pool, join_type, ids):
+    def find():
+        LoadA.on(pool).where(LoadA.id == random.choice(ids)).get()
+
+    def get():
+        LoadA.on(pool).join_with(join_type).join(LoadA.b).where(LoadA.id << random.sample(ids, 5)).get()
+
+    def create():
+        a = LoadA.on(pool).create(LoadA(name='load'))
+        LoadB.on(pool).create([LoadB(a_id=a.id, value=i) for i in range(3)])
+
+    def update():
+        LoadA.on(pool).where(LoadA.id == random.choice(ids)).update(LoadA(counter=random.randint(0, 1000)))
+
+    return {'find': find, 'get': get, 'create': create, 'update': update}
+
+def _setup(args):
+    pool = _connect(args)
+    stellata.schema.migrate(pool, models=[LoadA, LoadB], execute=True)
+    pool.execute('truncate "%s", "%s"' % (LoadA.__table__, LoadB.__table__))
+
+    rows = LoadA.on(pool).create([LoadA(name='seed%d' % i) for i in range(args.rows)])
+    LoadB.on(pool).create([LoadB(a_id=a.id, value=i) for a in rows for i in range(3)])
+    return [e.id for e in rows]
+
+def _worker(args, ids, seed):
+    """Run the workload in this process and return latencies by operation, errors and pool samples."""
+
+    random.seed(seed)
+    pool = _connect(args)
+    operations = _operations(pool, args.join_type, ids)
+    mix = []
+    for name, weight in (('find', args.find), ('get', args.get), ('create', args.create), ('update', args.update)):
+        mix.extend([name] * weight)
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    samples = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    done = threading.Event()
+
+    def run():
+        local = collections.defaultdict(list)
+        local_errors = collections.Counter()
+        while time.monotonic() < deadline:
+            name = random.choice(mix)
+            start = time.perf_counter()
+            try:
+                operations[name]()
+                local[name].append(time.perf_counter() - start)
+            except Exception as e:
+                local_errors['%s: %s' % (name, type(e).__name__)] += 1
+
+        with lock:
+            for name, values in local.items():
+                latencies[name].extend(values)
+            errors.update(local_errors)
+
+    def sample():
+        while not done.wait(0.05):
+            samples.append(pool.stats())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    threads = [threading.Thread(target=run) for _ in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    done.set()
+    sampler.join()
+    return dict(latencies), errors, samples, pool.stats()
+
+def _percentile(values, p):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def _report(args, results, elapsed):
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    samples = []
+    checkouts = 0
+    wait_time = 0.0
+    max_wait_time = 0.0
+    for process_latencies, process_errors, process_samples, stats in results:
+        for name, values in process_latencies.items():
+            latencies[name].extend(values)
+        errors.update(process_errors)
+        samples.extend(process_samples)
+        checkouts += stats['checkouts']
+        wait_time += stats['wait_time']
+        max_wait_time = max(max_wait_time, stats['max_wait_time'])
+
+    total = sum(len(e) for e in latencies.values())
+    print('pool=%s pool_size=%s processes=%s threads=%s join_type=%s duration=%.1fs' % (
+        args.pool, args.pool_size, args.processes, args.threads, args.join_type, elapsed
+    ))
+    print()
+    print('%-8s %10s %10s %10s %10s %10s %10s' % ('op', 'count', 'ops/sec', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name in sorted(latencies) + ['all']:
+        values = sorted(latencies[name] if name != 'all' else [e for v in latencies.values() for e in v])
+        print('%-8s %10d %10.1f %10.2f %10.2f %10.2f %10.2f' % (
+            name,
+            len(values),
+            len(values) / elapsed,
+            _percentile(values, 50) * 1000,
+            _percentile(values, 95) * 1000,
+            _percentile(values, 99) * 1000,
+            (values[-1] if values else 0) * 1000
+        ))
+
+    print()
+    print('throughput:         %.1f ops/sec' % (total / elapsed))
+    print('pool wait:          %.3f ms avg, %.1f ms max over %d checkouts' % (
+        wait_time / checkouts * 1000 if checkouts else 0,
+        max_wait_time * 1000,
+        checkouts
+    ))
+    if samples:
+        print('utilization:        %.1f%% of connections in use on average, %d waiters at most' % (
+            sum(e['in_use'] / e['max_size'] for e in samples) / len(samples) * 100,
+            max(e['waiters'] for e in samples)
+        ))
+    for error, count in errors.most_common():
+        print('error:              %d x %s' % (count, error))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a concurrent stellata workload against a local database.')
+    parser.add_argument('--name', default='stellata_test')
+    parser.add_argument('--user', default='stellata_test')
+    parser.add_argument('--password', default='stellata_test')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--pool', choices=('stellata', 'psycopg2'), default='stellata', help='pool implementation')
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--min-idle', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for a connection')
+    parser.add_argument('--join-type', choices=('join', 'queries'), default='queries')
+    parser.add_argument('--threads', type=int, default=16, help='threads per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to run for')
+    parser.add_argument('--rows', type=int, default=1000, help='rows to seed before running')
+    parser.add_argument('--find', type=int, default=4, help='relative weight of find operations')
+    parser.add_argument('--get', type=int, default=3, help='relative weight of where().get() operations')
+    parser.add_argument('--create', type=int, default=1, help='relative weight of create operations')
+    parser.add_argument('--update', type=int, default=2, help='relative weight of update operations')
+    parser.add_argument('--keep', action='store_true', help="don't drop the load test tables afterwards")
+    args = parser.parse_args(argv)
+
+    ids = _setup(args)
+    start = time.monotonic()
+    if args.processes > 1:
+        with multiprocessing.Pool(args.processes) as processes:
+            results = processes.starmap(_worker, [(args, ids, i) for i in range(args.processes)])
+    else:
+        results = [_worker(args, ids, 0)]
+    elapsed = time.monotonic() - start
+
+    _report(args, results, elapsed)
+
+    if not args.keep:
+        pool = _connect(args)
+        pool.execute('drop table if exists "%s", "%s"' % (LoadA.__table__, LoadB.__table__))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
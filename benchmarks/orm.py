@@ -0,0 +1,224 @@
+"""Benchmarks for the ORM's own overhead, run against a fake in-memory pool.
+
+No database is needed. Each benchmark is timed with timeit, and the best of several repeats is reported, which
+keeps numbers stable enough to compare between versions:
+
+    python -m benchmarks.orm --rows 1000 --fanout 5 --json before.json
+    python -m benchmarks.orm --rows 1000 --fanout 5 --compare before.json
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import platform
+import random
+import re
+import sys
+import timeit
+import uuid
+
+import stellata.fields
+import stellata.model
+import stellata.query
+import stellata.relations
+
+import benchmarks.fake
+
+class A(stellata.model.Model):
+    __table__ = 'a'
+
+    id = stellata.fields.UUID()
+    foo = stellata.fields.Text()
+    bar = stellata.fields.Integer()
+    price = stellata.fields.Numeric()
+    day = stellata.fields.Date()
+    dt = stellata.fields.Timestamp()
+
+    b = stellata.relations.HasMany(lambda: B.a_id)
+
+class B(stellata.model.Model):
+    __table__ = 'b'
+
+    id = stellata.fields.UUID()
+    a_id = stellata.fields.UUID()
+    qux = stellata.fields.Integer()
+    dt = stellata.fields.Timestamp()
+
+    a = stellata.relations.BelongsTo(lambda: B.a_id, lambda: A)
+
+_benchmarks = []
+
+def benchmark(f):
+    """Register a benchmark. Each benchmark is given the result set size and returns the statement to time, along
+    with the fake pool it runs against, if any."""
+
+    _benchmarks.append(f)
+    return f
+
+def _a_values(i):
+    return {
+        'id': str(uuid.UUID(int=i)),
+        'foo': 'foo%d' % i,
+        'bar': i,
+        'price': decimal.Decimal('%d.99' % i),
+        'day': datetime.date(2017, 1, 1) + datetime.timedelta(days=i % 365),
+        'dt': datetime.datetime(2017, 1, 1) + datetime.timedelta(seconds=i),
+    }
+
+def _b_values(i, j, fanout):
+    return {
+        'id': str(uuid.UUID(int=(1 << 64) + i * fanout + j)),
+        'a_id': str(uuid.UUID(int=i)),
+        'qux': j,
+        'dt': datetime.datetime(2017, 1, 1) + datetime.timedelta(seconds=j),
+    }
+
+def _columns(model, alias=None):
+    alias = alias or model.__table__
+    return ['%s.%s' % (alias, field.column) for field in model.__fields__]
+
+def _values(model, values):
+    return [values[field.column] for field in model.__fields__]
+
+def _pool(rows, fanout, join_alias=None):
+    # pre-build every result set, so the fake pool costs no more than a dictionary lookup per query
+    a = [_a_values(i) for i in range(rows)]
+    b = [_b_values(i, j, fanout) for i in range(rows) for j in range(fanout)]
+    results = {
+        'a': benchmarks.fake.rows(_columns(A), [_values(A, e) for e in a]),
+        'b': benchmarks.fake.rows(_columns(B), [_values(B, e) for e in b]),
+    }
+
+    if join_alias:
+        results['join'] = benchmarks.fake.rows(
+            _columns(A) + _columns(B, join_alias),
+            [_values(A, a[i]) + _values(B, b[i * fanout + j]) for i in range(rows) for j in range(fanout)]
+        )
+
+    table = re.compile(r'from "(\w+)"')
+    def respond(sql, args):
+        if ' left join ' in sql:
+            return results['join']
+        return results[table.search(sql).group(1)]
+
+    return benchmarks.fake.FakePool(respond)
+
+@benchmark
+def compile_insert(rows, fanout):
+    objects = [A(**_a_values(i)) for i in range(rows)]
+    query = stellata.query.Query(A)
+    return lambda: query._insert_query(objects), None
+
+@benchmark
+def compile_select(rows, fanout):
+    ids = [str(uuid.UUID(int=i)) for i in range(rows)]
+    query = stellata.query.Query(A).join(A.b) \
+        .where((A.id << ids) & (A.bar > 5) | (A.foo == 'foo')) \
+        .order(A.dt, 'desc') \
+        .limit(10)
+
+    alias_map = {'b': query.joins[0].alias}
+    return lambda: query._select_query(alias_map), None
+
+@benchmark
+def create(rows, fanout):
+    objects = [A(**_a_values(i)) for i in range(rows)]
+    result = _pool(rows, fanout).query('select * from "a"')
+    pool = benchmarks.fake.FakePool(lambda sql, args: result)
+    query = stellata.query.Query(A).on(pool)
+    return lambda: query.create(objects), pool
+
+@benchmark
+def create_no_returning(rows, fanout):
+    objects = [A(**_a_values(i)) for i in range(rows)]
+    pool = benchmarks.fake.FakePool()
+    query = stellata.query.Query(A).on(pool)
+    return lambda: query.create(objects, returning=None), pool
+
+@benchmark
+def get_with_joins(rows, fanout):
+    query = stellata.query.Query(A).join_with('join').join(A.b)
+    pool = _pool(rows, fanout, query.joins[0].alias)
+    query.on(pool)
+    return lambda: query.get(), pool
+
+@benchmark
+def get_with_queries(rows, fanout):
+    pool = _pool(rows, fanout)
+    query = stellata.query.Query(A).join_with('queries').join(A.b).on(pool)
+    return lambda: query.get(), pool
+
+@benchmark
+def hydrate(rows, fanout):
+    result = _pool(rows, fanout).query('select * from "a"')
+    query = stellata.query.Query(A)
+    return lambda: [query._row_to_object(A, row) for row in result], None
+
+@benchmark
+def serialize(rows, fanout):
+    data = stellata.query.Query(A).join_with('queries').join(A.b).on(_pool(rows, fanout)).get()
+    return lambda: stellata.model.serialize(data), None
+
+def run(names=None, rows=1000, fanout=5, repeat=5, number=None):
+    """Run benchmarks and return a dictionary of results keyed on benchmark name."""
+
+    results = {}
+    for f in _benchmarks:
+        if names and f.__name__ not in names:
+            continue
+
+        # joins use random aliases, so seed for identical SQL from run to run
+        random.seed(12345)
+        statement, pool = f(rows, fanout)
+        timer = timeit.Timer(statement)
+        n = number or max(timer.autorange()[0], 1)
+        best = min(timer.repeat(repeat=repeat, number=n)) / n
+
+        # count round trips for a single run
+        queries = None
+        if pool is not None:
+            before = pool.queries
+            statement()
+            queries = pool.queries - before
+
+        results[f.__name__] = {'seconds': best, 'queries': queries, 'rows': rows, 'fanout': fanout}
+
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark stellata ORM overhead without a database.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--rows', type=int, default=1000, help='number of root rows per result set')
+    parser.add_argument('--fanout', type=int, default=5, help='number of child rows per root row')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing repeats; the best is reported')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='compare against results previously written with --json')
+    args = parser.parse_args(argv)
+
+    results = run(args.names, rows=args.rows, fanout=args.fanout, repeat=args.repeat)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print('%-20s %12s %12s %8s %10s' % ('benchmark', 'usec/op', 'ops/sec', 'queries', 'change'))
+    for name, result in results.items():
+        change = ''
+        if name in baseline:
+            change = '%+.1f%%' % ((result['seconds'] / baseline[name]['seconds'] - 1) * 100)
+
+        print('%-20s %12.1f %12.1f %8s %10s' % (
+            name,
+            result['seconds'] * 1e6,
+            1 / result['seconds'],
+            '' if result['queries'] is None else result['queries'],
+            change
+        ))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results}, f, indent=4)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,2 +1,4 @@
 # required import order due to metaclass execution
 import stellata.model
+
+from stellata.detect import detect_n_plus_one
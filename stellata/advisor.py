@@ -0,0 +1,303 @@
+"""Index advisor driven by the queries an application actually runs.
+
+Record a workload while the application runs, then compare the columns it filters, joins and orders on against
+the indexes defined on models:
+
+    with stellata.advisor.Workload('workload.json'):
+        handle_requests()
+
+    python -m stellata.advisor workload.json --module myapp.models --name mydb --user me --password secret
+"""
+
+import argparse
+import importlib
+import json
+import sys
+import threading
+
+import stellata.database
+import stellata.field
+import stellata.instrument
+import stellata.model
+import stellata.query
+
+_version = 1
+
+# comparisons that pin a column to one or more values, which can lead a composite index
+_equality = ('=', 'in', 'is', '= any')
+
+# comparisons that a btree index can't narrow down
+_unindexed = ('!=', 'not in', 'is not', 'ilike')
+
+def _candidates(query: 'stellata.query.Query', strategy: str = None):
+    """Return `(table, columns)` pairs for indexes that would help a query.
+
+    Columns compared for equality (and-ed together) come first, followed by a single range column, or the order
+    columns if there isn't one. Each branch of an `or` can only use an index of its own. Columns wrapped in SQL
+    functions are skipped, since those need an expression index.
+    """
+
+    result = _where_candidates(query.where_expression, query.order_expression)
+
+    # a join looks up the child rows of every parent row
+    if strategy == 'join':
+        for join in query.joins:
+            child = join.relation.child()
+            result.append((child.model.__table__, (child.column,)))
+
+    return result
+
+def _covered(model, columns):
+    # an index helps if it leads with the first column, as long as it's not partial
+    for index in model.__indexes__:
+        leading = index.fields()[0]
+        if isinstance(leading, stellata.field.Field) and leading.column == columns[0] and not index.where_lambda:
+            return True
+
+    return False
+
+def _unused_indexes(database, tables):
+    # unique indexes enforce constraints even if they're never scanned, so leave those out
+    sql = '''
+        select
+            s.relname,
+            s.indexrelname
+        from pg_stat_user_indexes s
+        join pg_index i on i.indexrelid = s.indexrelid
+        where
+            s.relname = any(%s) and
+            s.idx_scan = 0 and
+            not i.indisunique
+        order by s.relname, s.indexrelname
+    '''
+
+    return [(table, index) for table, index in database.query(sql, (list(tables),))]
+
+def _where_candidates(expression, order=None):
+    result = []
+    equality = []
+    ranges = []
+    pending = [expression] if expression else []
+    while pending:
+        expression = pending.pop()
+        if isinstance(expression, stellata.query.MultiColumnExpression):
+            if expression.operator == 'or':
+                for term in expression.terms:
+                    result.extend(_where_candidates(term))
+            else:
+                pending.extend(expression.terms)
+        elif isinstance(expression, stellata.query.ExistsExpression):
+            # the subquery looks up related rows by the child column, along with its own filter
+            child = expression.relation.child()
+            lookup = stellata.query.SingleColumnExpression(child.model, child.column, '=', 0)
+            result.extend(_where_candidates(
+                stellata.query.MultiColumnExpression.combine(child.model, lookup, expression.where, 'and')
+            ))
+        elif isinstance(expression, stellata.query.SingleColumnExpression) and not expression.template:
+            if isinstance(expression.value, stellata.query.Query):
+                result.extend(_where_candidates(expression.value.where_expression, expression.value.order_expression))
+
+            if expression.comparison in _equality:
+                equality.append(expression)
+            elif expression.comparison not in _unindexed:
+                ranges.append(expression)
+
+    # group terms by table, since joined tables are filtered in the same statement
+    tables = {}
+    for expression in equality + ranges[:1]:
+        columns = tables.setdefault(expression.model.__table__, [])
+        if expression.column not in columns:
+            columns.append(expression.column)
+
+    if order and not ranges:
+        for field in order.fields:
+            if isinstance(field, stellata.field.Field) and not field.template:
+                columns = tables.setdefault(field.model.__table__, [])
+                if field.column not in columns:
+                    columns.append(field.column)
+
+    result.extend((table, tuple(columns)) for table, columns in tables.items())
+    return result
+
+class Suggestion:
+    """An index that queries in a workload would have used, had it existed."""
+
+    def __init__(self, model, columns):
+        self.model = model
+        self.columns = columns
+        self.count = 0
+        self.time = 0.0
+        self.shapes = []
+
+    def __str__(self):
+        return '%s (%s): %d queries, %.2fs total, e.g. %s' % (
+            self.model.__table__,
+            ', '.join(self.columns),
+            self.count,
+            self.time,
+            self.definition()
+        )
+
+    def definition(self):
+        fields = ', '.join('%s.%s' % (self.model.__name__, e) for e in self.columns)
+        if len(self.columns) > 1:
+            fields = '(%s)' % fields
+
+        return 'stellata.index.Index(lambda: %s)' % fields
+
+class Report:
+    """Missing indexes, ordered by the time spent on queries that would use them, and unused indexes."""
+
+    def __init__(self, missing, unused):
+        self.missing = missing
+        self.unused = unused
+
+    def __str__(self):
+        lines = ['missing indexes:']
+        lines.extend('    %s' % e for e in self.missing)
+        if not self.missing:
+            lines.append('    none')
+
+        if self.unused is not None:
+            lines.append('unused indexes:')
+            lines.extend('    %s on %s' % (index, table) for table, index in self.unused)
+            if not self.unused:
+                lines.append('    none')
+
+        return '\n'.join(lines)
+
+class Workload:
+    """Records the query shapes an application runs, with how many times each ran and for how long.
+
+    As a context manager, recording starts on entry and stops on exit, and the workload is saved if a path was
+    given. Only queries built with stellata.query.Query are recorded.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.shapes = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        if self.path:
+            self.save()
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path) as f:
+            data = json.load(f)
+
+        workload = cls(path)
+        workload.shapes = data['shapes']
+        return workload
+
+    def merge(self, workload: 'Workload'):
+        """Add the counts and times of another workload to this one."""
+
+        with self._lock:
+            for shape, entry in workload.shapes.items():
+                existing = self.shapes.setdefault(shape, dict(entry, count=0, time=0.0))
+                existing['count'] += entry['count']
+                existing['time'] += entry['time']
+
+    def observe(self, event: 'stellata.instrument.QueryEvent'):
+        if event.query is None or event.error is not None:
+            return
+
+        shape = event.shape
+        with self._lock:
+            entry = self.shapes.get(shape)
+            if entry is None:
+                entry = self.shapes[shape] = {
+                    'count': 0,
+                    'time': 0.0,
+                    'candidates': [
+                        [table, list(columns)] for table, columns in _candidates(event.query, event.strategy)
+                    ],
+                }
+
+            entry['count'] += 1
+            entry['time'] += event.duration
+
+    def report(self, models: list = None, database=None):
+        """Compare the workload against the indexes defined on `models`, all registered models by default.
+
+        If a database is given, indexes that haven't been scanned since its statistics were last reset are
+        listed as unused.
+        """
+
+        models = {e.__table__: e for e in (models or stellata.model.registered())}
+        suggestions = {}
+        with self._lock:
+            for shape, entry in self.shapes.items():
+                for table, columns in entry['candidates']:
+                    model = models.get(table)
+                    if model is None or not columns or _covered(model, columns):
+                        continue
+
+                    suggestion = suggestions.get((table, tuple(columns)))
+                    if suggestion is None:
+                        suggestion = suggestions[(table, tuple(columns))] = Suggestion(model, tuple(columns))
+
+                    suggestion.count += entry['count']
+                    suggestion.time += entry['time']
+                    suggestion.shapes.append(shape)
+
+        unused = None
+        if database is not None:
+            unused = _unused_indexes(database, models.keys())
+
+        return Report(sorted(suggestions.values(), key=lambda e: -e.time), unused)
+
+    def save(self, path: str = None):
+        path = path or self.path
+        with self._lock:
+            data = json.dumps({'version': _version, 'shapes': self.shapes}, indent=4)
+
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def start(self):
+        stellata.instrument.on_query(self.observe)
+
+    def stop(self):
+        stellata.instrument.off_query(self.observe)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Suggest indexes for a workload recorded with stellata.advisor.')
+    parser.add_argument('workloads', nargs='+', help='workload files to combine')
+    parser.add_argument('--module', action='append', default=[], help='module defining models, to import')
+    parser.add_argument('--name', help='database to check for unused indexes')
+    parser.add_argument('--user')
+    parser.add_argument('--password')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    args = parser.parse_args(argv)
+
+    for module in args.module:
+        importlib.import_module(module)
+
+    workload = Workload()
+    for path in args.workloads:
+        workload.merge(Workload.load(path))
+
+    database = None
+    if args.name:
+        database = stellata.database.Pool(
+            name=args.name,
+            user=args.user,
+            password=args.password,
+            host=args.host,
+            port=args.port
+        )
+
+    print(workload.report(database=database))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
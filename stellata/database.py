@@ -1,11 +1,18 @@
 import contextlib
+import contextvars
 import json
 import logging
 import psycopg2
-import psycopg2.pool
+import psycopg2.extensions
 import psycopg2.extras
+import re
+import threading
+import time
+import uuid
 
+import stellata.instrument
 import stellata.model
+import stellata.pool
 
 pool = None
 log = logging.getLogger('stellata')
@@ -14,54 +21,320 @@ class Pool:
     """Database connection pool instance.
 
     Enables multiple database connections to be defined and used by the application.
+
+    If `slow_query_threshold` (in seconds) is given, statements that take longer are recorded in `slow_queries`,
+    along with the location that issued them and their EXPLAIN plan. Args are redacted unless `redact_args` is
+    false.
     """
 
-    def __init__(self, name='', pool_size=10, host='localhost', password='', port=5432, user=''):
-        self._pool = psycopg2.pool.ThreadedConnectionPool(
-            database=name,
-            minconn=1,
-            maxconn=pool_size,
-            host=host,
-            password=password,
-            port=port,
-            user=user
+    def __init__(self, name='', pool_size=10, host='localhost', password='', port=5432, user='', min_idle=1,
+            timeout=30.0, max_lifetime=3600.0, idle_timeout=600.0, health_check_interval=30.0,
+            slow_query_threshold=None, slow_query_log_size=100, redact_args=True):
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_queries = stellata.instrument.SlowQueryLog(slow_query_log_size, redact=redact_args)
+
+        self._pool = stellata.pool.ConnectionPool(
+            lambda: psycopg2.connect(database=name, host=host, password=password, port=port, user=user),
+            max_size=pool_size,
+            min_idle=min_idle,
+            timeout=timeout,
+            max_lifetime=max_lifetime,
+            idle_timeout=idle_timeout,
+            health_check_interval=health_check_interval
         )
 
         # enable support for UUID creation at the database level
         self.execute('create extension if not exists "uuid-ossp"')
 
     @contextlib.contextmanager
-    def _cursor(self):
+    def _cursor(self, name=None, autocommit=False):
+        # a named cursor is a server-side cursor, which fetches rows in batches rather than all at once
         connection = self._pool.getconn()
         try:
-            yield connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            if autocommit:
+                connection.autocommit = True
+
+            cursor = connection.cursor(name=name, cursor_factory=psycopg2.extras.DictCursor)
+            yield cursor
+            cursor.close()
             connection.commit()
         finally:
+            if autocommit and not connection.closed:
+                connection.autocommit = False
+
             self._pool.putconn(connection)
 
-    def execute(self, sql: str, args: tuple = None):
-        """Execute a SQL query with no return value."""
+    def _explain(self, cursor, sql: str, args: tuple = None):
+        # only plannable statements can be explained
+        if not re.match(r'\s*(select|insert|update|delete|with)\b', sql, re.IGNORECASE):
+            return None
+
+        # use a separate cursor on the same connection, so results of the original statement aren't lost. a
+        # savepoint keeps a failed explain from aborting the caller's transaction
+        connection = cursor.connection
+        explain_cursor = connection.cursor()
+        try:
+            if not connection.autocommit:
+                explain_cursor.execute('savepoint stellata_explain')
+
+            try:
+                explain_cursor.execute('explain (format json) ' + sql, args)
+                plan = explain_cursor.fetchone()[0]
+            except psycopg2.Error:
+                log.warning('Unable to explain slow query')
+                plan = None
+                if not connection.autocommit:
+                    explain_cursor.execute('rollback to savepoint stellata_explain')
+
+            if not connection.autocommit:
+                explain_cursor.execute('release savepoint stellata_explain')
+        finally:
+            explain_cursor.close()
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        return plan
+
+    def _run(self, cursor, sql: str, args: tuple = None, fp=None):
+        # with a file, run a COPY statement into it instead
+        execute = cursor.execute
+        if fp is not None:
+            execute = lambda sql, args: cursor.copy_expert(sql, fp)
+
+        # keep the common case, where nobody is listening, free of timing and event overhead
+        instrument = stellata.instrument.active()
+        if not instrument and self.slow_query_threshold is None:
+            execute(sql, args)
+            return
+
+        start = time.perf_counter()
+        try:
+            execute(sql, args)
+        except Exception as e:
+            if instrument:
+                stellata.instrument.emit(sql, args, time.perf_counter() - start, -1, self, error=e)
+            raise
+
+        duration = time.perf_counter() - start
+        if self.slow_query_threshold is not None and duration >= self.slow_query_threshold:
+            self.slow_queries.record(sql, args, duration, self._explain(cursor, sql, args))
+
+        if instrument:
+            stellata.instrument.emit(sql, args, duration, cursor.rowcount, self)
+
+    @property
+    def in_use(self):
+        """Number of connections currently checked out."""
+
+        return self._pool.in_use
+
+    def execute(self, sql: str, args: tuple = None, autocommit: bool = False, lock_timeout: float = None):
+        """Execute a SQL query with no return value, and return the number of rows it affected.
+
+        With `autocommit`, the statement runs outside of a transaction, which statements like `create index
+        concurrently` require. With `lock_timeout` (in seconds), the statement fails with a LockNotAvailable error
+        rather than waiting longer than that for a lock.
+        """
+
+        with self._cursor(autocommit=autocommit) as cursor:
+            # outside of a transaction, the setting lasts for the session, so it's reset before the connection is
+            # returned to the pool
+            if lock_timeout is not None:
+                scope = 'session' if autocommit else 'local'
+                cursor.execute('set %s lock_timeout = %%s' % scope, ('%dms' % (lock_timeout * 1000),))
+
+            try:
+                self._run(cursor, sql, args)
+            finally:
+                if lock_timeout is not None and autocommit and not cursor.connection.closed:
+                    cursor.execute('reset lock_timeout')
+
+            return cursor.rowcount
+
+    def copy_to(self, sql: str, args: tuple, fp, format: str = 'csv'):
+        """Stream the result of a SQL query into a file-like object with `COPY ... TO STDOUT`.
+
+        Returns the number of rows copied.
+        """
 
         with self._cursor() as cursor:
-            log.debug('Running SQL: ' + str((sql, args)))
-            cursor.execute(sql, args)
+            sql = cursor.mogrify(sql, args).decode(psycopg2.extensions.encodings[cursor.connection.encoding])
+            copy = 'copy (%s) to stdout with (format %s, header true)' % (sql, format)
+            self._run(cursor, copy, None, fp=fp)
+            return cursor.rowcount
 
     def query(self, sql: str, args: tuple = None):
         """Execute a SQL query with a return value."""
 
         with self._cursor() as cursor:
-            log.debug('Running SQL: ' + str((sql, args)))
-            cursor.execute(sql, args)
+            self._run(cursor, sql, args)
             return cursor.fetchall()
 
-def initialize(name='', pool_size=10, host='localhost', password='', port=5432, user=''):
+    def reader(self):
+        """Return the pool that should serve read queries."""
+
+        return self
+
+    def stream(self, sql: str, args: tuple = None, batch_size: int = 1000):
+        """Execute a SQL query with a server-side cursor, yielding lists of at most `batch_size` rows."""
+
+        with self._cursor(name='stellata_%s' % uuid.uuid4().hex) as cursor:
+            cursor.itersize = batch_size
+            self._run(cursor, sql, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+
+                yield rows
+
+    def stats(self):
+        """Return connection gauges (in use, idle, waiters) and checkout counters."""
+
+        return self._pool.stats()
+
+    def writer(self):
+        """Return the pool that should serve write queries."""
+
+        return self
+
+class RoutedPool:
+    """Database connection pool that sends reads to replicas and writes to a primary.
+
+    Reads are pinned to the primary for `pin_seconds` after a write in the same context (thread or task), so
+    callers always see their own writes. Replicas whose replay lag exceeds `max_lag` seconds are skipped until
+    they catch up, and if no replica is usable, reads fall back to the primary.
+    """
+
+    def __init__(self, primary: Pool, replicas: list = None, strategy='round_robin', pin_seconds=1.0, max_lag=5.0,
+            lag_check_interval=1.0):
+        if strategy not in ('round_robin', 'least_busy'):
+            raise ValueError('Unknown routing strategy: %s' % strategy)
+
+        self.primary = primary
+        self.replicas = list(replicas or [])
+        self.strategy = strategy
+        self.pin_seconds = pin_seconds
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+
+        self._last_write = contextvars.ContextVar('stellata_last_write_%s' % id(self), default=None)
+        self._lag = {}
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def _replica_lag(self, replica: Pool):
+        now = time.monotonic()
+        with self._lock:
+            checked, lag = self._lag.get(replica, (None, None))
+            if checked is not None and now - checked < self.lag_check_interval:
+                return lag
+
+            # record the check time up front so concurrent readers don't all measure the same replica
+            self._lag[replica] = (now, lag)
+
+        try:
+            rows = replica.query('''
+                select case
+                    when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                    else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 0)
+                end as lag
+            ''')
+            lag = float(rows[0][0]) if rows else 0.0
+        except psycopg2.Error:
+            log.warning('Unable to measure replica lag, skipping replica')
+            lag = float('inf')
+
+        with self._lock:
+            self._lag[replica] = (now, lag)
+
+        return lag
+
+    def execute(self, sql: str, args: tuple = None, autocommit: bool = False, lock_timeout: float = None):
+        """Execute a SQL query with no return value on the primary."""
+
+        return self.writer().execute(sql, args, autocommit=autocommit, lock_timeout=lock_timeout)
+
+    def copy_to(self, sql: str, args: tuple, fp, format: str = 'csv'):
+        """Stream the result of a SQL query into a file-like object from the pool that serves reads."""
+
+        return self.reader().copy_to(sql, args, fp, format=format)
+
+    @property
+    def in_use(self):
+        """Number of connections currently checked out from the primary."""
+
+        return self.primary.in_use
+
+    def query(self, sql: str, args: tuple = None):
+        """Execute a SQL query with a return value on the primary.
+
+        Raw queries may read or write, so they always go to the primary, but unlike `execute` they don't pin
+        subsequent reads to it.
+        """
+
+        return self.primary.query(sql, args)
+
+    def reader(self):
+        """Return the pool that should serve read queries."""
+
+        last_write = self._last_write.get()
+        if last_write is not None and time.monotonic() - last_write < self.pin_seconds:
+            return self.primary
+
+        replicas = []
+        for replica in self.replicas:
+            lag = self._replica_lag(replica)
+            if lag is None or lag <= self.max_lag:
+                replicas.append(replica)
+
+        if not replicas:
+            return self.primary
+
+        if self.strategy == 'least_busy':
+            return min(replicas, key=lambda e: e.in_use)
+
+        with self._lock:
+            self._next = (self._next + 1) % len(replicas)
+            return replicas[self._next]
+
+    def stats(self):
+        """Return connection gauges (in use, idle, waiters) and checkout counters for the primary."""
+
+        return self.primary.stats()
+
+    def stream(self, sql: str, args: tuple = None, batch_size: int = 1000):
+        """Execute a SQL query with a server-side cursor on the pool that serves reads, yielding lists of rows."""
+
+        return self.reader().stream(sql, args, batch_size=batch_size)
+
+    def writer(self):
+        """Return the pool that should serve write queries, pinning subsequent reads to the primary."""
+
+        self._last_write.set(time.monotonic())
+        return self.primary
+
+def initialize(name='', pool_size=10, host='localhost', password='', port=5432, user='', **kwargs):
     """Initialize a new database connection and return the pool object.
 
     Saves a reference to that instance in a module-level variable, so applications with only one database
-    can just call this function and not worry about pool objects.
+    can just call this function and not worry about pool objects. Any additional keyword arguments
+    (`min_idle`, `timeout`, `max_lifetime`, `idle_timeout`, `health_check_interval`) are passed to the pool.
+    """
+
+    global pool
+    instance = Pool(name=name, pool_size=pool_size, host=host, password=password, port=port, user=user, **kwargs)
+    pool = instance
+    return instance
+
+def initialize_routed(primary: Pool, replicas: list, **kwargs):
+    """Initialize a pool that routes reads to replicas and writes to the primary and return it.
+
+    Like `initialize`, saves a reference to the instance in a module-level variable.
     """
 
     global pool
-    instance = Pool(name=name, pool_size=pool_size, host=host, password=password, port=port, user=user)
+    instance = RoutedPool(primary, replicas, **kwargs)
     pool = instance
     return instance
@@ -0,0 +1,130 @@
+import collections
+import contextlib
+import contextvars
+import logging
+import threading
+import warnings
+
+import stellata.instrument
+import stellata.model
+import stellata.query
+
+log = logging.getLogger('stellata')
+
+_scopes = contextvars.ContextVar('stellata_n_plus_one_scopes', default=())
+_lock = threading.Lock()
+_active = 0
+
+class NPlusOneError(AssertionError):
+    """Raised when a scope created with `detect_n_plus_one(fail=True)` runs the same query shape too many times."""
+
+class NPlusOneWarning(UserWarning):
+    """Warning issued when a scope created with `detect_n_plus_one()` runs the same query shape too many times."""
+
+class Violation:
+    """A query shape that ran more times than allowed within a scope."""
+
+    def __init__(self, shape, count, locations, suggestions):
+        self.shape = shape
+        self.count = count
+        self.locations = locations
+        self.suggestions = suggestions
+
+    def __str__(self):
+        lines = ['%s x %s' % (self.count, self.shape)]
+        for location, count in self.locations.most_common():
+            lines.append('    %s x at %s' % (count, location))
+        for suggestion in self.suggestions:
+            lines.append('    consider %s' % suggestion)
+
+        return '\n'.join(lines)
+
+class Scope:
+    """Record of the query shapes run within a single `detect_n_plus_one` block."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.counts = collections.Counter()
+        self.locations = collections.defaultdict(collections.Counter)
+        self.queries = {}
+        self.violations = []
+
+    def _finish(self):
+        self.violations = [
+            Violation(shape, count, self.locations[shape], _suggestions(self.queries.get(shape)))
+            for shape, count in self.counts.most_common()
+            if count > self.threshold
+        ]
+
+    def _observe(self, event: 'stellata.instrument.QueryEvent', location):
+        shape = event.shape
+        self.counts[shape] += 1
+        self.locations[shape][location] += 1
+        if event.query is not None:
+            self.queries.setdefault(shape, event.query)
+
+    def report(self):
+        return 'N+1 queries detected:\n' + '\n'.join(str(e) for e in self.violations)
+
+def _observe(event: 'stellata.instrument.QueryEvent'):
+    scopes = _scopes.get()
+    if not scopes:
+        return
+
+    location = stellata.instrument.caller()
+    for scope in scopes:
+        scope._observe(event, location)
+
+def _suggestions(query: 'stellata.query.Query'):
+    # a repeated lookup on a single column that some relation joins on can be replaced by that join
+    if query is None or not isinstance(query.where_expression, stellata.query.SingleColumnExpression):
+        return []
+
+    model = query.where_expression.model
+    column = query.where_expression.column
+    result = []
+    for candidate in stellata.model.registered():
+        for relation in candidate.__relations__:
+            try:
+                child = relation.child()
+            except Exception:
+                continue
+
+            if child.model is model and child.column == column:
+                result.append('%s.join(%s.%s)' % (candidate.__name__, candidate.__name__, relation.column))
+
+    return result
+
+@contextlib.contextmanager
+def detect_n_plus_one(threshold: int = 3, fail: bool = False):
+    """Watch the queries run within a block, and flag any query shape that runs more than `threshold` times.
+
+    Flagged shapes are reported with the call sites that ran them and, where possible, a join that would replace
+    them. By default the report is issued as an NPlusOneWarning; with `fail=True`, an NPlusOneError is raised
+    instead, which makes this usable as a hard failure in test suites.
+    """
+
+    global _active
+    scope = Scope(threshold)
+    with _lock:
+        if _active == 0:
+            stellata.instrument.on_query(_observe)
+        _active += 1
+
+    token = _scopes.set(_scopes.get() + (scope,))
+    try:
+        yield scope
+    finally:
+        _scopes.reset(token)
+        with _lock:
+            _active -= 1
+            if _active == 0:
+                stellata.instrument.off_query(_observe)
+
+    scope._finish()
+    if scope.violations:
+        if fail:
+            raise NPlusOneError(scope.report())
+
+        log.warning(scope.report())
+        warnings.warn(scope.report(), NPlusOneWarning, stacklevel=3)
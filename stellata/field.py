@@ -2,35 +2,94 @@ from typing import Union
 
 import stellata.query
 
-class Field:
-    """Base class for an object representing a single field on a model.
+class Operand:
+    """Base class for anything that can be compared to values to build query expressions.
 
-    Fields correspond to database columns.
+    Subclasses set `model` and `column`, and optionally a `template` that wraps the column in SQL, like
+    `lower({})`.
     """
 
-    def __init__(self, length=None, null=True, default=None):
-        self.length = length
-        self.null = null
-        self.default = default
+    template = None
 
     def __eq__(self, value: Union[int, str, float]):
-        return stellata.query.SingleColumnExpression(self.model, self.column, '=', value)
+        return stellata.query.SingleColumnExpression(self.model, self.column, '=', value, self.template)
 
     def __lt__(self, value: Union[int, str, float]):
-        return stellata.query.SingleColumnExpression(self.model, self.column, '<', value)
+        return stellata.query.SingleColumnExpression(self.model, self.column, '<', value, self.template)
 
     def __gt__(self, value: Union[int, str, float]):
-        return stellata.query.SingleColumnExpression(self.model, self.column, '>', value)
+        return stellata.query.SingleColumnExpression(self.model, self.column, '>', value, self.template)
 
-    def __lshift__(self, value: list):
-        if len(value) == 0:
+    def __ne__(self, value: Union[int, str, float]):
+        return stellata.query.SingleColumnExpression(self.model, self.column, '!=', value, self.template)
+
+    def __le__(self, value: Union[int, str, float]):
+        return stellata.query.SingleColumnExpression(self.model, self.column, '<=', value, self.template)
+
+    def __ge__(self, value: Union[int, str, float]):
+        return stellata.query.SingleColumnExpression(self.model, self.column, '>=', value, self.template)
+
+    def __lshift__(self, value: Union[list, 'stellata.query.Query']):
+        # a query is compiled into the statement as a subquery, rather than run on its own
+        if not isinstance(value, stellata.query.Query) and len(value) == 0:
             return None
 
-        return stellata.query.SingleColumnExpression(self.model, self.column, 'in', value)
+        return stellata.query.SingleColumnExpression(self.model, self.column, 'in', value, self.template)
 
     # in case people forget which way the arrows go, lol
-    def __rshift__(self, value: list):
-        if len(value) == 0:
+    def __rshift__(self, value: Union[list, 'stellata.query.Query']):
+        return self.__lshift__(value)
+
+    def between(self, low: Union[int, str, float], high: Union[int, str, float]):
+        return stellata.query.SingleColumnExpression(self.model, self.column, 'between', (low, high), self.template)
+
+    def like(self, pattern: str):
+        """Match a LIKE pattern.
+
+        Patterns anchored at the start, like `foo%`, can use a btree index only if the database uses the C collation
+        or the index is built with `text_pattern_ops` or `varchar_pattern_ops`.
+        """
+
+        return stellata.query.SingleColumnExpression(self.model, self.column, 'like', pattern, self.template)
+
+    def ilike(self, pattern: str):
+        """Match a LIKE pattern, ignoring case. To use an index, match `Lower(field).like(...)` instead."""
+
+        return stellata.query.SingleColumnExpression(self.model, self.column, 'ilike', pattern, self.template)
+
+    def is_null(self, null: bool = True):
+        return stellata.query.SingleColumnExpression(self.model, self.column, '=' if null else '!=', None,
+            self.template)
+
+    def not_in(self, value: Union[list, 'stellata.query.Query']):
+        # nothing is excluded by an empty list, so there's nothing to filter
+        if not isinstance(value, stellata.query.Query) and len(value) == 0:
             return None
 
-        return self.__lshift__(value)
+        return stellata.query.SingleColumnExpression(self.model, self.column, 'not in', value, self.template)
+
+    def any(self, value: list):
+        """Match any value in a list, sent as a single array parameter rather than one parameter per value.
+
+        The array is cast to the column type, so values like UUIDs given as strings compare correctly.
+        """
+
+        cast = None
+        if not self.template and getattr(self, 'column_type', None):
+            cast = '%s[]' % self.column_type
+
+        return stellata.query.SingleColumnExpression(self.model, self.column, '= any', list(value), self.template,
+            cast)
+
+class Field(Operand):
+    """Base class for an object representing a single field on a model.
+
+    Fields correspond to database columns. A field with `generated`, a lambda returning a field or function of
+    other fields on the model, is a generated column, which is computed by the database and never written.
+    """
+
+    def __init__(self, length=None, null=True, default=None, generated=None):
+        self.length = length
+        self.null = null
+        self.default = default
+        self.generated = generated
@@ -35,22 +35,24 @@ class Timestamp(stellata.field.Field):
 
     column_type = 'timestamp without time zone'
 
-    def __init__(self, length=None, null=True, default=''):
+    def __init__(self, length=None, null=True, default='', generated=None):
+        # generated columns can't have defaults
         if default == '':
-            default = 'now()'
+            default = None if generated else 'now()'
 
-        super().__init__(length, null, default)
+        super().__init__(length, null, default, generated)
 
 class UUID(stellata.field.Field):
     """UUID column type."""
 
     column_type = 'uuid'
 
-    def __init__(self, length=None, null=True, default=''):
+    def __init__(self, length=None, null=True, default='', generated=None):
+        # generated columns can't have defaults
         if default == '':
-            default = 'uuid_generate_v1mc()'
+            default = None if generated else 'uuid_generate_v1mc()'
 
-        super().__init__(length, null, default)
+        super().__init__(length, null, default, generated)
 
 class Varchar(stellata.field.Field):
     """CHARACTER VARYING column type."""
@@ -0,0 +1,26 @@
+import stellata.field
+
+class Function(stellata.field.Operand):
+    """Base class for an object representing a SQL function applied to a field, like `lower(email)`.
+
+    Functions can be compared to values in queries just like fields, and used in place of fields in indexes and
+    generated columns. `template` is the SQL for the function, with `{}` where the column goes.
+    """
+
+    def __init__(self, field: stellata.field.Operand, template: str):
+        # functions of functions are flattened into a single template around the innermost field
+        if field.template:
+            template = template.format(field.template)
+
+        self.model = field.model
+        self.column = field.column
+        self.template = template
+
+    def sql(self, table: str = None):
+        """Return the SQL for this function, with the column qualified by `table` if one is given."""
+
+        column = '"%s"' % self.column
+        if table:
+            column = '"%s".%s' % (table, column)
+
+        return self.template.format(column)
@@ -0,0 +1,29 @@
+import stellata.function
+
+class DateTrunc(stellata.function.Function):
+    """DATE_TRUNC function, which truncates a timestamp to a unit like `day` or `hour`."""
+
+    units = (
+        'microseconds', 'milliseconds', 'second', 'minute', 'hour', 'day', 'week', 'month', 'quarter', 'year',
+        'decade', 'century', 'millennium'
+    )
+
+    def __init__(self, unit: str, field):
+        # the unit is written into the SQL rather than passed as an argument, so that the planner can match it to
+        # indexes on the same expression
+        if unit not in self.units:
+            raise ValueError('Unknown date_trunc unit: %s' % unit)
+
+        super().__init__(field, "date_trunc('%s', {})" % unit)
+
+class Lower(stellata.function.Function):
+    """LOWER function."""
+
+    def __init__(self, field):
+        super().__init__(field, 'lower({})')
+
+class Upper(stellata.function.Function):
+    """UPPER function."""
+
+    def __init__(self, field):
+        super().__init__(field, 'upper({})')
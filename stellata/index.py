@@ -1,17 +1,58 @@
+methods = ('btree', 'hash', 'gin', 'gist', 'spgist', 'brin')
+
 class Index:
-    """Base class for an object representing a database index."""
+    """Base class for an object representing a database index.
+
+    `fields_lambda` returns a field, or a tuple of fields. To give a column a sort order, use a `(field, 'desc')`
+    tuple in place of the field. `method` is the index type, `where` is a lambda returning an expression that
+    makes this a partial index, and `include` is a lambda returning fields to store in the index without indexing
+    them, for index-only scans.
+    """
+
+    def __init__(self, fields_lambda, primary_key=False, unique=False, method='btree', where=None, include=None):
+        if method not in methods:
+            raise ValueError('Unknown index method: %s' % method)
 
-    def __init__(self, fields_lambda, primary_key=False, unique=False):
         self.fields_lambda = fields_lambda
         self.unique = unique
+        self.method = method
+        self.where_lambda = where
+        self.include_lambda = include
+        self._columns = None
+
+    def columns(self):
+        """Return a tuple of `(field, order)` pairs, where order is None if it wasn't given."""
+
+        if self._columns is None:
+            result = self.fields_lambda()
+
+            # a single field with an order looks like a tuple of fields, but its second element is a string
+            if not isinstance(result, tuple) or (len(result) == 2 and isinstance(result[1], str)):
+                result = (result,)
+
+            self._columns = tuple(e if isinstance(e, tuple) else (e, None) for e in result)
+
+        return self._columns
 
     def fields(self):
-        result = self.fields_lambda()
+        return tuple(field for field, order in self.columns())
+
+    def include(self):
+        if not self.include_lambda:
+            return ()
+
+        result = self.include_lambda()
         if not isinstance(result, tuple):
             result = (result,)
 
         return result
 
+    def where(self):
+        if not self.where_lambda:
+            return None
+
+        return self.where_lambda()
+
 class PrimaryKey(Index):
     def __init__(self, fields_lambda, primary_key=True, unique=False):
         return super().__init__(fields_lambda, primary_key, True)
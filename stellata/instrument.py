@@ -0,0 +1,197 @@
+import collections
+import contextlib
+import contextvars
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+log = logging.getLogger('stellata')
+
+_package = os.path.dirname(os.path.abspath(__file__)) + os.sep
+_tests = os.path.join(_package, 'tests') + os.sep
+_subscribers = []
+_context = contextvars.ContextVar('stellata_instrument_context', default={})
+_noop = contextlib.nullcontext()
+
+class QueryEvent:
+    """A single SQL statement run through a Pool.
+
+    `model`, `strategy` and `query` describe the stellata.query.Query that issued the statement, if any. The
+    strategy is `join` or `queries` for queries with joins, depending on how the joins were executed.
+    """
+
+    __slots__ = ('sql', 'args', 'duration', 'rowcount', 'pool', 'model', 'strategy', 'query', 'error')
+
+    def __init__(self, sql, args, duration, rowcount, pool, model=None, strategy=None, query=None, error=None):
+        self.sql = sql
+        self.args = args
+        self.duration = duration
+        self.rowcount = rowcount
+        self.pool = pool
+        self.model = model
+        self.strategy = strategy
+        self.query = query
+        self.error = error
+
+    @property
+    def arg_count(self):
+        return len(self.args) if self.args else 0
+
+    @property
+    def shape(self):
+        return shape(self.sql)
+
+class SlowQuery:
+    """A statement that took longer than its pool's slow query threshold."""
+
+    def __init__(self, sql, args, duration, location, plan=None):
+        self.sql = sql
+        self.shape = shape(sql)
+        self.args = args
+        self.duration = duration
+        self.location = location
+        self.plan = plan
+        self.dt = datetime.datetime.now(datetime.timezone.utc)
+
+    def to_dict(self):
+        return {
+            'sql': self.sql,
+            'shape': self.shape,
+            'args': self.args,
+            'duration': self.duration,
+            'location': self.location,
+            'plan': self.plan,
+            'dt': self.dt.isoformat(),
+        }
+
+class SlowQueryLog:
+    """Bounded in-memory ring buffer of slow queries; the oldest entries are dropped first."""
+
+    def __init__(self, size=100, redact=True):
+        self.redact = redact
+        self._entries = collections.deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def dump(self, pretty: bool = False):
+        """Serialize all recorded slow queries to a JSON string."""
+
+        entries = [e.to_dict() for e in self.entries()]
+        if pretty:
+            return json.dumps(entries, default=str, indent=4)
+        return json.dumps(entries, default=str)
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries)
+
+    def record(self, sql: str, args, duration: float, plan=None):
+        if args is not None and self.redact:
+            args = ['<%s>' % type(e).__name__ for e in args]
+
+        entry = SlowQuery(sql, args, duration, caller(), plan)
+        with self._lock:
+            self._entries.append(entry)
+
+        log.warning('Slow query (%.2fms) at %s: %s', duration * 1000, entry.location, entry.shape)
+        return entry
+
+def active():
+    """Return whether anyone is listening for query events."""
+
+    return bool(_subscribers) or log.isEnabledFor(logging.DEBUG)
+
+def caller():
+    """Return `file:line function` for the innermost frame outside of stellata itself."""
+
+    frame = sys._getframe(1)
+    while frame:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if not filename.startswith(_package) or filename.startswith(_tests):
+            return '%s:%s %s' % (filename, frame.f_lineno, frame.f_code.co_name)
+
+        frame = frame.f_back
+
+    return None
+
+def emit(sql: str, args, duration: float, rowcount: int, pool, error=None):
+    """Send a query event to all subscribers. Pools only call this when `active()` is true."""
+
+    context = _context.get()
+    event = QueryEvent(
+        sql,
+        args,
+        duration,
+        rowcount,
+        pool,
+        model=context.get('model'),
+        strategy=context.get('strategy'),
+        query=context.get('query'),
+        error=error
+    )
+
+    for callback in list(_subscribers):
+        callback(event)
+
+    # the debug log is always subscribed, but only does anything when debug logging is enabled
+    if log.isEnabledFor(logging.DEBUG):
+        log_query(event)
+
+def log_query(event: QueryEvent):
+    """Subscriber that writes each query to the debug log."""
+
+    log.debug('Running SQL: %s (%.2fms)', (event.sql, event.args), event.duration * 1000)
+
+def off_query(callback):
+    """Unsubscribe a callback added with `on_query`."""
+
+    if callback in _subscribers:
+        _subscribers.remove(callback)
+
+def on_query(callback):
+    """Subscribe to query events. The callback is given a QueryEvent after each statement runs.
+
+    Returns the callback, so this can also be used as a decorator.
+    """
+
+    _subscribers.append(callback)
+    return callback
+
+def shape(sql: str):
+    """Normalize a SQL string so queries that differ only in the number of values share a shape.
+
+    For example, `id in (%s,%s,%s)` becomes `id in (...)` and multi-row `values` lists collapse to one row.
+    """
+
+    sql = re.sub(r'\(\s*%s(\s*,\s*%s)*\s*\)', '(...)', sql)
+    sql = re.sub(r'values \(\.\.\.\)(\s*,\s*\(\.\.\.\))+', 'values (...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def tag(**kwargs):
+    """Attach metadata (model, strategy, query) to every query event emitted within a block.
+
+    When nothing is subscribed, this returns a shared no-op context manager.
+    """
+
+    if not active():
+        return _noop
+
+    return _tag(kwargs)
+
+@contextlib.contextmanager
+def _tag(kwargs):
+    token = _context.set(dict(_context.get(), **kwargs))
+    try:
+        yield
+    finally:
+        _context.reset(token)
@@ -7,6 +7,12 @@ import importlib
 import json
 import msgpack
 import re
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 import stellata.database
 import stellata.field
@@ -16,6 +22,12 @@ import stellata.query
 
 _models = []
 _join_type = None
+_encoders = {}
+_instance_dict = object.__getattribute__
+_plain_types = {str, int, float, bool, type(None)}
+
+class NotFoundError(LookupError):
+    """Raised when saving an instance whose row no longer exists."""
 
 class ModelType(type):
     """Metaclass for models.
@@ -77,6 +89,7 @@ class Model(object, metaclass=ModelType):
 
     __table__ = None
     __database__ = None
+    __partition__ = None
 
     def __init__(self, *args, **kwargs):
         # set all values given in constructor
@@ -92,7 +105,31 @@ class Model(object, metaclass=ModelType):
 
         return result
 
+    def _changes(self):
+        # writable fields whose values differ from the ones the instance was loaded with, or None if it wasn't
+        # loaded. fields that weren't loaded (say, with a partial returning) but have been set count as changed.
+        # generated columns are computed by the database, so changes to them are never written
+        original = self.__dict__.get('__original__')
+        if original is None:
+            return None
+
+        data = self.__dict__
+        result = {}
+        for field in self.__class__.__fields__:
+            column = field.column
+            if field.generated or column not in data:
+                continue
+
+            if column not in original or data[column] != original[column]:
+                result[column] = data[column]
+
+        return result
+
     def to_dict(self):
+        # the values an instance was loaded with aren't part of its data
+        if '__original__' in self.__dict__:
+            return {k: v for k, v in self.__dict__.items() if k != '__original__'}
+
         return self.__dict__
 
     @classmethod
@@ -104,10 +141,10 @@ class Model(object, metaclass=ModelType):
         cls.execute('commit', database=database)
 
     @classmethod
-    def create(cls, data, unique=None):
+    def create(cls, data, unique=None, returning='all', ignore=False):
         if not data:
             return
-        return stellata.query.Query(cls).create(data, unique)
+        return stellata.query.Query(cls).create(data, unique, returning, ignore)
 
     @classmethod
     def execute(cls, sql: str, args: tuple = None, database=None):
@@ -121,6 +158,10 @@ class Model(object, metaclass=ModelType):
 
         db.execute(sql, args)
 
+    @classmethod
+    def export(cls, fp, format: str = 'ndjson', batch_size: int = 1000):
+        return stellata.query.Query(cls).export(fp, format, batch_size)
+
     @classmethod
     def find(cls, ids, field=None):
         one = False
@@ -154,7 +195,33 @@ class Model(object, metaclass=ModelType):
         return stellata.query.Query(cls, limit=stellata.query.LimitExpression(n))
 
     def save(self, unique=False):
-        return self.__class__.create(self, unique=unique)
+        """Write this instance to the database.
+
+        Instances loaded from a query only update the fields that have changed since, by ID, and do nothing if none
+        have. If the row has since been deleted, NotFoundError is raised. Other instances are inserted, or upserted
+        on the `unique` fields if given.
+        """
+
+        cls = self.__class__
+        changes = self._changes()
+        if changes is None:
+            return cls.create(self, unique=unique)
+
+        # a loaded instance is already stored, so without its ID there's no way to tell which row to update
+        if 'id' not in self.__dict__['__original__']:
+            raise ValueError('Cannot save an instance of %s that was loaded without its id' % cls.__name__)
+
+        if not changes:
+            return self
+
+        id = self.__dict__['__original__']['id']
+        rows = stellata.query.Query(cls).where(cls.id == id).update(cls(**changes))
+        if not rows:
+            raise NotFoundError('No row in "%s" with id %s' % (cls.__table__, id))
+
+        # pick up anything the database computed, like generated columns, and track changes from here
+        self.__dict__.update(rows[0].__dict__)
+        return self
 
     @classmethod
     def on(cls, database):
@@ -164,13 +231,17 @@ class Model(object, metaclass=ModelType):
     def order(cls, fields: list, order=None):
         return stellata.query.Query(cls, order=stellata.query.OrderByExpression(fields, order))
 
+    @classmethod
+    def select(cls, field: 'stellata.field.Operand'):
+        return stellata.query.Query(cls).select(field)
+
     @classmethod
     def truncate(cls, database=None):
         cls.execute('truncate "%s"' % cls.__table__, database=database)
 
     @classmethod
-    def update(cls, data: 'stellata.model.Model'):
-        return stellata.query.Query(cls).update(data)
+    def update(cls, data: 'stellata.model.Model', returning='all'):
+        return stellata.query.Query(cls).update(data, returning)
 
     @classmethod
     def where(cls, expression: 'stellata.query.Expression'):
@@ -184,32 +255,166 @@ def _join_with(join_type: str):
     yield
     _join_type = previous
 
+def finalize():
+    """Resolve the relations and indexes of every registered model.
+
+    They're resolved on first use otherwise. Call this once all models are defined to keep that off the first
+    queries, and to surface mistakes in their lambdas right away.
+    """
+
+    for model in registered():
+        for relation in model.__relations__:
+            relation.resolve()
+
+        for index in model.__indexes__:
+            index.columns()
+
 def registered():
     global _models
     return [e for e in _models if hasattr(e, '__table__') and e.__table__]
 
-def serialize(data, format: str = 'json', pretty: bool = False):
-    """Serialize a stellata object to a string format."""
-    def encode(obj):
-        if isinstance(obj, stellata.model.Model):
-            return obj.to_dict()
-        elif isinstance(obj, datetime.datetime):
-            return int(obj.timestamp())
-        elif isinstance(obj, datetime.date):
-            return obj.isoformat()
-        elif isinstance(obj, decimal.Decimal):
-            return float(obj)
-        elif hasattr(obj, 'serialize'):
-            return obj.serialize()
+def _encode(obj):
+    # models are the common case, so look them up before trying anything else
+    encoder = _encoders.get(type(obj))
+    if encoder:
+        return encoder(obj)
+
+    if isinstance(obj, stellata.model.Model):
+        return _encoder(type(obj))(obj)
+    elif isinstance(obj, datetime.datetime):
+        return int(obj.timestamp())
+    elif isinstance(obj, datetime.date):
+        return obj.isoformat()
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif isinstance(obj, uuid.UUID):
+        return str(obj)
+    elif hasattr(obj, 'serialize'):
+        return obj.serialize()
+
+    return obj
+
+def _encode_date(value):
+    if type(value) is datetime.date:
+        return value.isoformat()
+    return _encode(value)
+
+def _encode_numeric(value):
+    if type(value) is decimal.Decimal:
+        return float(value)
+    return _encode(value)
+
+def _encode_timestamp(value):
+    if type(value) is datetime.datetime:
+        return int(value.timestamp())
+    return _encode(value)
+
+def _encode_uuid(value):
+    if type(value) is uuid.UUID:
+        return str(value)
+    return value
+
+# per-column-type converters used by precompiled model encoders; other types are passed through as-is
+_converters = {
+    'date': _encode_date,
+    'numeric': _encode_numeric,
+    'timestamp without time zone': _encode_timestamp,
+    'uuid': _encode_uuid,
+}
+
+def _encoder(model: type):
+    """Return a function that converts an instance of the given model to a dictionary of its fields and relations.
+
+    The encoder is built once per model, so serializing an instance only touches its fields and relations (not
+    every attribute on the instance), with a converter chosen ahead of time for each field type.
+    """
+
+    encoder = _encoders.get(model)
+    if encoder:
+        return encoder
+
+    fields = [(field.column, _converters.get(field.column_type)) for field in model.__fields__]
+    relations = [relation.column for relation in model.__relations__]
+
+    def encoder(obj):
+        # skip Model.__getattribute__, which is comparatively slow
+        data = _instance_dict(obj, '__dict__')
+        result = {}
+        for column, converter in fields:
+            if column in data:
+                value = data[column]
+                if converter and type(value) not in _plain_types:
+                    value = converter(value)
+                result[column] = value
+
+        # related models are left for the serializer to encode when it reaches them
+        for column in relations:
+            if column in data:
+                result[column] = data[column]
+
+        return result
+
+    _encoders[model] = encoder
+    return encoder
+
+def _normalize(data):
+    """Replace every model instance in data with a reference to a single copy stored in an entity map.
+
+    Instances are identified by table and ID, so the same row reached through different joins is only stored
+    once. Instances without an ID are left in place.
+    """
+
+    entities = {}
+
+    def walk(obj):
+        if isinstance(obj, Model):
+            model = type(obj)
+            id = _instance_dict(obj, '__dict__').get('id')
+            if id is None or not model.__table__:
+                return {k: walk(v) for k, v in _encoder(model)(obj).items()}
+
+            # repeats are skipped before encoding, and a placeholder is stored first in case the graph has cycles
+            if type(id) not in _plain_types:
+                id = _encode(id)
+            table = entities.setdefault(model.__table__, {})
+            if id not in table:
+                table[id] = None
+                table[id] = {k: walk(v) for k, v in _encoder(model)(obj).items()}
+
+            return {'$table': model.__table__, '$id': id}
+        elif isinstance(obj, dict):
+            return {k: walk(v) for k, v in obj.items()}
+        elif isinstance(obj, (list, tuple)):
+            return [walk(e) for e in obj]
 
         return obj
 
+    result = walk(data)
+    return {'entities': entities, 'result': result}
+
+def serialize(data, format: str = 'json', pretty: bool = False, fast: bool = False, normalize: bool = False):
+    """Serialize a stellata object to a string format.
+
+    With `fast`, JSON is encoded with orjson when it's installed, which produces compact output. With `normalize`,
+    the output is `{"entities": {table: {id: object}}, "result": data}`, where each model instance is stored once
+    in the entity map and every occurrence in data is replaced with a `{"$table": table, "$id": id}` reference.
+    """
+
+    if normalize:
+        data = _normalize(data)
+
     if format == 'msgpack':
-        return msgpack.packb(data, default=encode)
+        return msgpack.packb(data, default=_encode)
 
     if format == 'json':
         if pretty:
-            return json.dumps(data, default=encode, indent=4)
-        return json.dumps(data, default=encode)
+            return json.dumps(data, default=_encode, indent=4)
+        if fast and orjson:
+            return orjson.dumps(
+                data,
+                default=_encode,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            ).decode('utf-8')
+        return json.dumps(data, default=_encode)
 
     return data
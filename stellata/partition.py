@@ -0,0 +1,168 @@
+import calendar
+import datetime
+import re
+
+import stellata.query
+
+# day-based intervals are aligned to a monday, so weekly partitions start on mondays
+_epoch = datetime.date(1970, 1, 5)
+
+def _add(day: datetime.date, n: int, unit: str):
+    # only called with dates aligned by _floor, so months always start on the first
+    if unit == 'day':
+        return day + datetime.timedelta(days=n)
+
+    months = day.year * 12 + day.month - 1 + n
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+def _floor(day: datetime.date, n: int, unit: str):
+    if unit == 'day':
+        return _epoch + datetime.timedelta(days=(day - _epoch).days // n * n)
+
+    months = day.year * 12 + day.month - 1
+    months -= months % n
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+def _interval(interval: str):
+    match = re.fullmatch(r'\s*(\d+)\s*(day|week|month|year)s?\s*', interval)
+    if not match or int(match.group(1)) < 1:
+        raise ValueError('Unknown interval: %s' % interval)
+
+    n = int(match.group(1))
+    unit = match.group(2)
+    if unit == 'week':
+        return (n * 7, 'day')
+    elif unit == 'year':
+        return (n * 12, 'month')
+
+    return (n, unit)
+
+def _subtract(day: datetime.date, n: int, unit: str):
+    if unit == 'day':
+        return day - datetime.timedelta(days=n)
+
+    months = day.year * 12 + day.month - 1 - n
+    year = months // 12
+    month = months % 12 + 1
+    return datetime.date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def _today():
+    return datetime.datetime.now(datetime.timezone.utc).date()
+
+class Partition:
+    """Base class for a table partitioning scheme, set on a model with `__partition__`.
+
+    Partitions are named after their table, like `<table>_p0`, and created by migrations.
+    """
+
+    method = None
+    drop = False
+
+    def __init__(self, fields_lambda):
+        self.fields_lambda = fields_lambda
+
+    def expired(self, suffixes: list, today: datetime.date):
+        """Return the suffixes of existing partitions that should be removed."""
+
+        return []
+
+    def fields(self):
+        result = self.fields_lambda()
+        if not isinstance(result, tuple):
+            result = (result,)
+
+        return result
+
+    def key(self):
+        return '%s (%s)' % (self.method, ', '.join(['"%s"' % e.column for e in self.fields()]))
+
+    def partitions(self, today: datetime.date):
+        """Return a dictionary mapping the suffix of each partition that should exist to its bounds."""
+
+        raise NotImplementedError()
+
+class Hash(Partition):
+    """Partitions rows evenly across `modulus` partitions by the hash of their key."""
+
+    method = 'hash'
+
+    def __init__(self, fields_lambda, modulus: int):
+        super().__init__(fields_lambda)
+        self.modulus = modulus
+
+    def partitions(self, today: datetime.date):
+        return {
+            'p%d' % i: 'for values with (modulus %d, remainder %d)' % (self.modulus, i)
+            for i in range(self.modulus)
+        }
+
+class List(Partition):
+    """Partitions rows by their key's value.
+
+    `values` is either a list, with one partition per value, or a dictionary mapping partition names to lists
+    of values.
+    """
+
+    method = 'list'
+
+    def __init__(self, fields_lambda, values):
+        super().__init__(fields_lambda)
+        if not isinstance(values, dict):
+            values = {re.sub(r'\W', '_', str(e)).lower(): [e] for e in values}
+
+        self.values = values
+
+    def partitions(self, today: datetime.date):
+        return {
+            'p%s' % name: 'for values in (%s)' % ', '.join(stellata.query._literal(e) for e in values)
+            for name, values in self.values.items()
+        }
+
+class Range(Partition):
+    """Partitions rows into consecutive ranges of a date or timestamp key, one per `interval`.
+
+    Intervals look like `1 day`, `1 week`, `3 months` or `1 year`. The partition for the current interval and
+    the next `premake` are created ahead of time. If `retention` is given, as an interval, partitions that only
+    contain older rows are detached from the table, or dropped entirely if `drop` is true.
+    """
+
+    method = 'range'
+
+    def __init__(self, fields_lambda, interval: str = '1 month', premake: int = 3, retention: str = None,
+            drop: bool = False):
+        super().__init__(fields_lambda)
+        self.interval = _interval(interval)
+        self.premake = premake
+        self.retention = _interval(retention) if retention else None
+        self.drop = drop
+
+    def expired(self, suffixes: list, today: datetime.date):
+        if not self.retention:
+            return []
+
+        cutoff = _subtract(today, *self.retention)
+        result = []
+        for suffix in suffixes:
+            # skip partitions that weren't created by stellata
+            match = re.fullmatch(r'p(\d{8})', suffix)
+            if not match:
+                continue
+
+            start = datetime.datetime.strptime(match.group(1), '%Y%m%d').date()
+            if _add(start, *self.interval) <= cutoff:
+                result.append(suffix)
+
+        return sorted(result)
+
+    def partitions(self, today: datetime.date):
+        result = {}
+        start = _floor(today, *self.interval)
+        for i in range(self.premake + 1):
+            end = _add(start, *self.interval)
+            result['p%s' % start.strftime('%Y%m%d')] = "for values from ('%s') to ('%s')" % (
+                start.isoformat(),
+                end.isoformat()
+            )
+            start = end
+
+        return result
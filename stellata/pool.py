@@ -0,0 +1,309 @@
+import collections
+import logging
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import threading
+import time
+
+log = logging.getLogger('stellata')
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection becomes available before the checkout timeout expires."""
+
+class _Connection:
+    """Bookkeeping for a single connection owned by a ConnectionPool."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+class _Waiter:
+    """A thread waiting in line for a connection.
+
+    When a connection is released, it's handed directly to the first waiter, so waiters are served in the
+    order they arrived. If a connection is discarded instead, the waiter is given permission to open a new one.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.entry = None
+        self.create = False
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of PostgreSQL connections.
+
+    Unlike psycopg2's ThreadedConnectionPool, checkouts block in a fair queue (up to `timeout` seconds) when
+    all `max_size` connections are in use, rather than failing immediately. `min_idle` connections are opened
+    at startup and kept around, connections older than `max_lifetime` or idle for longer than `idle_timeout`
+    are closed, and connections that have been idle for more than `health_check_interval` seconds are checked
+    before being handed out.
+    """
+
+    def __init__(self, connect, max_size=10, min_idle=1, timeout=30.0, max_lifetime=3600.0, idle_timeout=600.0,
+            health_check_interval=30.0, reap_interval=1.0):
+        if min_idle > max_size:
+            raise ValueError('min_idle cannot be larger than max_size')
+
+        self.max_size = max_size
+        self.min_idle = min_idle
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.reap_interval = reap_interval
+
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._waiters = collections.deque()
+        self._checked_out = {}
+        self._size = 0
+        self._closed = False
+        self._next_reap = time.monotonic() + reap_interval
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        # warm up the pool so the first requests don't pay for connection setup
+        self._fill()
+
+    @property
+    def idle(self):
+        """Number of open connections waiting to be checked out."""
+
+        return len(self._idle)
+
+    @property
+    def in_use(self):
+        """Number of connections currently checked out."""
+
+        return len(self._checked_out)
+
+    @property
+    def size(self):
+        """Number of connections currently open, or being opened."""
+
+        return self._size
+
+    @property
+    def waiters(self):
+        """Number of threads waiting for a connection."""
+
+        return len(self._waiters)
+
+    def _close(self, entry):
+        try:
+            entry.connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _discard(self, entry):
+        # caller must hold the lock. if someone is waiting, let them open a replacement connection
+        self._size -= 1
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.create = True
+            self._size += 1
+            waiter.event.set()
+
+    def _expired(self, entry, now):
+        return self.max_lifetime is not None and now - entry.created > self.max_lifetime
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) >= self.min_idle or self._size >= self.max_size:
+                    return
+
+                self._size += 1
+
+            self._release(self._open())
+
+    def _healthy(self, entry, now):
+        if entry.connection.closed:
+            return False
+
+        if self.health_check_interval is None or now - entry.last_used < self.health_check_interval:
+            return True
+
+        try:
+            cursor = entry.connection.cursor()
+            cursor.execute('select 1')
+            cursor.close()
+            entry.connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _open(self):
+        try:
+            return _Connection(self._connect())
+        except Exception:
+            with self._lock:
+                self._discard(None)
+            raise
+
+    def _reap(self):
+        now = time.monotonic()
+        if now < self._next_reap:
+            return
+
+        closed = []
+        with self._lock:
+            self._next_reap = now + self.reap_interval
+            keep = collections.deque()
+            remaining = len(self._idle)
+            for entry in self._idle:
+                idle_expired = self.idle_timeout is not None and now - entry.last_used > self.idle_timeout
+                if self._expired(entry, now) or (idle_expired and remaining > self.min_idle):
+                    closed.append(entry)
+                    self._discard(entry)
+                    remaining -= 1
+                else:
+                    keep.append(entry)
+            self._idle = keep
+
+        for entry in closed:
+            self._close(entry)
+
+        if closed:
+            log.debug('Reaped %s connections' % len(closed))
+            self._fill()
+
+    def _release(self, entry):
+        entry.last_used = time.monotonic()
+        with self._lock:
+            if self._closed:
+                self._size -= 1
+                discard = True
+            elif self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.entry = entry
+                waiter.event.set()
+                discard = False
+            else:
+                self._idle.append(entry)
+                discard = False
+
+        if discard:
+            self._close(entry)
+
+    def closeall(self):
+        """Close every idle connection and refuse further checkouts."""
+
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+
+        for entry in idle:
+            self._close(entry)
+
+    def getconn(self, timeout=None):
+        """Check out a connection, waiting up to `timeout` seconds for one to become available."""
+
+        if timeout is None:
+            timeout = self.timeout
+
+        self._reap()
+        start = time.monotonic()
+        deadline = start + timeout
+        while True:
+            entry = None
+            create = False
+            waiter = None
+            with self._lock:
+                if self._closed:
+                    raise psycopg2.pool.PoolError('connection pool is closed')
+
+                # most recently used connections are the most likely to still be healthy and warm
+                if self._idle and not self._waiters:
+                    entry = self._idle.pop()
+                elif self._size < self.max_size and not self._waiters:
+                    self._size += 1
+                    create = True
+                else:
+                    waiter = _Waiter()
+                    self._waiters.append(waiter)
+
+            if waiter:
+                if not waiter.event.wait(max(deadline - time.monotonic(), 0)):
+                    with self._lock:
+                        # a connection may have been handed over right as we timed out
+                        if waiter.entry is None and not waiter.create:
+                            self._waiters.remove(waiter)
+                            self._timeouts += 1
+                            raise PoolTimeout('timed out after %.1fs waiting for a connection' % timeout)
+
+                entry = waiter.entry
+                create = waiter.create
+
+            if create:
+                entry = self._open()
+
+            now = time.monotonic()
+            if not create and (self._expired(entry, now) or not self._healthy(entry, now)):
+                self._close(entry)
+                with self._lock:
+                    self._discard(entry)
+                continue
+
+            waited = now - start
+            with self._lock:
+                self._checked_out[id(entry.connection)] = entry
+                self._checkouts += 1
+                self._wait_time += waited
+                self._max_wait_time = max(self._max_wait_time, waited)
+
+            return entry.connection
+
+    def putconn(self, connection, close=False):
+        """Return a connection to the pool."""
+
+        with self._lock:
+            entry = self._checked_out.pop(id(connection), None)
+
+        if not entry:
+            raise psycopg2.pool.PoolError('trying to put unkeyed connection')
+
+        if not close and not connection.closed:
+            # roll back anything left open so the next user gets a clean session
+            status = connection.get_transaction_status()
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        if close or connection.closed or self._expired(entry, time.monotonic()):
+            self._close(entry)
+            with self._lock:
+                self._discard(entry)
+
+            self._fill()
+            return
+
+        self._release(entry)
+
+    def stats(self):
+        """Return a dictionary of pool gauges and counters."""
+
+        with self._lock:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'in_use': len(self._checked_out),
+                'idle': len(self._idle),
+                'waiters': len(self._waiters),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
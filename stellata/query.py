@@ -2,9 +2,15 @@ from typing import Union
 
 import collections
 import enum
+import io
+import json
+import msgpack
+import psycopg2.extensions
 import random
+import re
 import string
 import stellata.database
+import stellata.instrument
 import stellata.index
 import stellata.relations
 import stellata.model
@@ -29,15 +35,20 @@ class Query:
         self.order_expression = order
         self.limit_expression = limit
         self.join_type = join_type
+        self.select_field = None
 
-    def _delete_query(self):
+    def _delete_query(self, returning=None):
         query = 'delete from "%s" ' % self.model.__table__
         where_query, where_values = self.where_expression.to_query()
         query += 'where %s' % where_query
 
+        fields = self._returning_fields(returning)
+        if fields:
+            query += ' returning %s' % ','.join(self._field_aliases(fields=fields))
+
         return (query, where_values)
 
-    def _field_aliases(self, model=None, alias=None):
+    def _field_aliases(self, model=None, alias=None, fields=None):
         # use query model by default
         if not model:
             model = self.model
@@ -48,7 +59,7 @@ class Query:
         # return a list of fields with aliases that can be used in a SQL query
         return [
             '"%s"."%s" as "%s.%s"' % (alias, field.column, alias, field.column)
-            for field in model.__fields__
+            for field in fields or model.__fields__
         ]
 
     def _get_with_joins(self, one, join_order, join_map):
@@ -60,26 +71,28 @@ class Query:
             alias_map[join.relation.child().model.__table__] = join.alias
 
         query, values = self._select_query(alias_map)
-        rows = self._pool().query(query, values)
+        with self._tag('join'):
+            rows = self._pool(read=True).query(query, values)
 
         # iterate over joins in order from leaf nodes to root node
         data = {}
         parent_key = None
         for child_model in join_order:
             for join in join_map.get(child_model, []):
+                # resolve everything about the join once, rather than once per row
                 parent_model = join.relation.parent().model
-                parent_column = join.relation.parent().column
-                parent_table = join.relation.parent().model.__table__
+                parent_table = parent_model.__table__
                 parent_alias = alias_map.get(parent_table, parent_table)
                 parent_key = '%s.id' % parent_alias
 
                 child_model = join.relation.child().model
-                child_column = join.relation.child().column
-                child_table = join.relation.child().model.__table__
                 child_alias = join.alias
                 child_key = '%s.id' % child_alias
 
+                column = join.relation.column
                 many = isinstance(join.relation, stellata.relations.HasMany)
+                parent_data = data.setdefault(parent_key, {}) if rows else {}
+                child_data = data.get(child_key)
                 visited = set()
                 for row in rows:
                     # for each join, insert into a table that maps models to their descendents.
@@ -90,39 +103,32 @@ class Query:
                     # referenced values are inserted first. then, for each model, we can replace any
                     # fields that are actually references to other models with data already stored in the table.
                     parent_value = row[parent_key]
-                    data.setdefault(parent_key, {})
-                    data[parent_key].setdefault(parent_value, None)
 
                     # convert row to model objects, since that's what we'll ultimately return
                     child_row = self._row_to_object(child_model, row, child_alias)
-                    parent_row = self._row_to_object(parent_model, row, parent_alias)
-                    if data.get(parent_key, {}).get(parent_value):
-                        parent_row = data[parent_key][parent_value]
+                    parent_row = parent_data.get(parent_value)
+                    if not parent_row:
+                        parent_data[parent_value] = None
+                        parent_row = self._row_to_object(parent_model, row, parent_alias)
 
                     # get values stored for this row and alias
                     v = [] if many else None
-                    if (
-                        hasattr(data[parent_key][parent_value], join.relation.column) and \
-                        getattr(data[parent_key][parent_value], join.relation.column) and \
-                        not isinstance(
-                            getattr(data[parent_key][parent_value], join.relation.column),
-                            stellata.relation.Relation
-                        )
-                    ):
-                        v = getattr(data[parent_key][parent_value], join.relation.column)
+                    existing = getattr(parent_data[parent_value], column, None)
+                    if existing and not isinstance(existing, stellata.relation.Relation):
+                        v = existing
 
                     # since joins are left joins, skip rows that are empty for the current join
                     if child_row:
                         child_row_id = child_row.id
 
                         # if data for foreign key already exists, then use that
-                        if child_key in data:
+                        if child_data is not None:
                             if many:
                                 if child_row_id not in visited:
-                                    v.append(data.get(child_key, {}).get(child_row_id, []))
+                                    v.append(child_data.get(child_row_id, []))
                                     visited.add(child_row_id)
                             else:
-                                v = data.get(child_key, {}).get(child_row_id, [])
+                                v = child_data.get(child_row_id, [])
 
                         # if no data exists, then we must be at a leaf node, so use the row value
                         else:
@@ -135,8 +141,8 @@ class Query:
 
                     # insert data into table
                     if parent_row:
-                        setattr(parent_row, join.relation.column, v)
-                        data[parent_key][parent_value] = parent_row
+                        setattr(parent_row, column, v)
+                        parent_data[parent_value] = parent_row
 
         # if no rows are returned, then return an empty list
         if not parent_key or parent_key not in data:
@@ -153,7 +159,8 @@ class Query:
         result = {}
         data = {}
         query, values = self._select_query(use_joins=False)
-        rows = self._pool().query(query, values)
+        with self._tag('queries'):
+            rows = self._pool(read=True).query(query, values)
 
         # instantiate model objects from rows in initial query
         for row in rows:
@@ -170,20 +177,20 @@ class Query:
                 related_field = None
                 if belongs_to:
                     related_field = join.relation.child()
-                    related_ids = [
-                        getattr(row, join.relation.foreign_key().column)
-                        for row in data.get(join.relation.parent().model, {}).values()
-                    ]
+                    column = join.relation.foreign_key().column
+                    related_ids = [getattr(row, column) for row in data.get(join.relation.parent().model, {}).values()]
                 else:
                     related_field = join.relation.foreign_key()
                     related_ids = list(data.get(join.relation.parent().model, {}).keys())
 
-                rows = join.relation.child().model.where(related_field << related_ids).get()
-                row_ids = []
-                for row in rows:
-                    data.setdefault(join.relation.child().model, {})
-                    data[join.relation.child().model][row.id] = row
-                    row_ids.append(row.id)
+                model = join.relation.child().model
+                with self._tag('queries'):
+                    rows = Query(model, database=self.database, where=related_field << related_ids).get()
+
+                if rows:
+                    children = data.setdefault(model, {})
+                    for row in rows:
+                        children[row.id] = row
 
         # now that all rows are in memory, associate children with their parents by aggregating children
         # by the foreign key and then setting attributes on the parents
@@ -192,37 +199,36 @@ class Query:
                 many = isinstance(join.relation, stellata.relations.HasMany)
                 belongs_to = isinstance(join.relation, stellata.relations.BelongsTo)
 
+                # resolve everything about the join once, rather than once per row
+                column = join.relation.column
+                foreign_key = join.relation.foreign_key().column
+                parents = data.get(join.relation.parent().model, {})
+                children = data.get(join.relation.child().model, {})
+
                 # for belongs to, index into the child and set the value on the parent
                 if belongs_to:
-                    for parent in data.get(join.relation.parent().model, {}).values():
-                        setattr(
-                            parent,
-                            join.relation.column,
-                            data.get(join.relation.child().model, {}) \
-                                .get(getattr(parent, join.relation.foreign_key().column))
-                        )
+                    for parent in parents.values():
+                        setattr(parent, column, children.get(getattr(parent, foreign_key)))
 
                 # for has many/one, aggregate children by their ID, then attach that to the parent
                 else:
                     children_by_parent_id = {}
-                    for child in data.get(join.relation.child().model, {}).values():
-                        parent_id = getattr(child, join.relation.foreign_key().column)
+                    for child in children.values():
+                        parent_id = getattr(child, foreign_key)
                         if many:
                             children_by_parent_id.setdefault(parent_id, [])
                             children_by_parent_id[parent_id].append(child)
                         else:
                             children_by_parent_id[parent_id] = child
 
-                    for parent_id in data.get(join.relation.parent().model, {}).keys():
-                        parent = data[join.relation.parent().model][parent_id]
-                        children = children_by_parent_id.get(parent_id, [] if many else None)
-                        setattr(parent, join.relation.column, children)
+                    for parent_id, parent in parents.items():
+                        setattr(parent, column, children_by_parent_id.get(parent_id, [] if many else None))
 
         return list(data.get(join_order[-1], {}).values())
 
-    def _insert_query(self, objects: list, unique=None, one=False):
+    def _insert_query(self, objects: list, unique=None, one=False, returning='all', ignore=False):
         # construct list of field names and placeholders for escaped values
-        data = [e.to_dict() for e in objects]
+        data = [self._writable(e) for e in objects]
         columns = list(data[0].keys())
         fields = ' (%s)' % ','.join(sorted(columns))
         values = ' values ' + ','.join([
@@ -232,6 +238,8 @@ class Query:
 
         # handle unique indexes
         unique_string = ''
+        unique_fields = None
+        unique_where = None
         if unique:
             # assume a list of fields is given by default
             unique_fields = unique
@@ -243,13 +251,15 @@ class Query:
                 if 'index' in unique:
                     unique_fields = unique['index']
 
-            # if index is given, then expand to all columns in that index
+            # if index is given, then expand to all columns in that index. postgres only infers a partial index
+            # from the conflict target if it's given the index predicate as well
             if isinstance(unique_fields, stellata.index.Index):
                 assert unique_fields.unique
+                unique_where = unique_fields.where()
                 unique_fields = unique_fields.fields()
 
             # if a single column is passed, then convert to a list
-            elif isinstance(unique_fields, stellata.field.Field):
+            elif isinstance(unique_fields, stellata.field.Operand):
                 unique_fields = [unique_fields]
 
             # if no columns are given, then update all columns
@@ -257,33 +267,73 @@ class Query:
             if isinstance(unique, dict):
                 update_columns = unique.get('update', [])
 
-            unique_string = ' on conflict (%s) do update set %s' % (
-                ','.join([e.column for e in unique_fields]),
-                ', '.join(['%s = excluded.%s' % (column, column) for column in update_columns])
-            )
+            # functions are written out as expressions, so postgres can match them to an expression index
+            conflict_target = '(%s)' % ','.join([
+                e.template.format('"%s"' % e.column) if e.template else e.column for e in unique_fields
+            ])
+            if unique_where is not None:
+                conflict_target += ' where %s' % _predicate(unique_where)
+
+            if not ignore:
+                unique_string = ' on conflict %s do update set %s' % (
+                    conflict_target,
+                    ', '.join(['%s = excluded.%s' % (column, column) for column in update_columns])
+                )
+
+        # skip rows that conflict, with the unique fields if given or any constraint otherwise
+        if ignore:
+            unique_string = ' on conflict do nothing'
+            if unique_fields:
+                unique_string = ' on conflict %s do nothing' % conflict_target
 
         # concatenate query parts and execute
-        returning = ' returning %s' % ','.join(self._field_aliases())
-        sql = 'insert into "' + self.model.__table__ + '"' + fields + values + unique_string + returning
+        returning_string = ''
+        returning_fields = self._returning_fields(returning)
+        if returning_fields:
+            returning_string = ' returning %s' % ','.join(self._field_aliases(fields=returning_fields))
+
+        sql = 'insert into "' + self.model.__table__ + '"' + fields + values + unique_string + returning_string
 
         # convert enum values to scalars
         args = [e.value if isinstance(e, enum.Enum) else e for e in args]
         return (sql, args)
 
-    def _pool(self):
-        if self.database:
-            return self.database
+    def _pool(self, read=False):
+        pool = self.database or stellata.database.pool
+        if not pool:
+            return pool
+
+        # routed pools send reads to replicas and writes to the primary
+        if read:
+            return pool.reader()
+
+        return pool.writer()
+
+    def _returning_fields(self, returning):
+        # fields for a returning clause: none, every field for 'all', or the field or fields given
+        if not returning:
+            return None
+
+        # fields overload ==, so check for the string before comparing
+        if isinstance(returning, str):
+            if returning != 'all':
+                raise ValueError('Unknown returning value: %s' % returning)
 
-        return stellata.database.pool
+            return self.model.__fields__
 
-    def _row_to_object(self, model: 'stellata.model.Model', row, alias=None):
+        if not isinstance(returning, (list, tuple)):
+            returning = [returning]
+
+        return list(returning)
+
+    def _row_to_object(self, model: 'stellata.model.Model', row, alias=None, fields=None):
         empty = True
         data = {}
         if not alias:
             alias = model.__table__
 
-        # iterate over fields defined in the model and extract them from the row dict
-        for field in model.__fields__:
+        # iterate over fields defined in the model (or only those selected) and extract them from the row dict
+        for field in fields or model.__fields__:
             value = row['%s.%s' % (alias, field.column)]
             data[field.column] = value
             if value is not None:
@@ -293,11 +343,15 @@ class Query:
         if empty:
             return None
 
-        return model(**data)
+        # remember the values as loaded, so that saving the instance can update only the fields that changed. when
+        # only some fields were selected, only those are remembered, and the rest count as changed once they're set
+        result = model(**data)
+        result.__dict__['__original__'] = data
+        return result
 
-    def _select_query(self, alias_map=None, use_joins=True):
+    def _select_query(self, alias_map=None, use_joins=True, columns=None):
         alias_map = alias_map or {}
-        columns = self._field_aliases()
+        columns = columns or self._field_aliases()
 
         # add each join to the list of columns to select
         if use_joins:
@@ -328,27 +382,69 @@ class Query:
         where_values = [e.value if isinstance(e, enum.Enum) else e for e in where_values]
         return (query, where_values)
 
-    def _update_query(self, data: 'stellata.model.Model'):
+    def _subquery(self):
+        # a subquery selects a single column, the model's ID unless another was chosen with .select
+        if self.joins:
+            raise ValueError('Subqueries cannot have joins')
+
+        field = self.select_field or self.model.id
+        column = '"%s"."%s"' % (self.model.__table__, field.column)
+        if field.template:
+            column = field.template.format(column)
+
+        return self._select_query(columns=[column])
+
+    def _tag(self, strategy=None):
+        # attach this query to instrumentation events. strategy is left alone when not given, so that queries
+        # issued on behalf of a join keep the join's strategy
+        if not stellata.instrument.active():
+            return stellata.instrument.tag()
+
+        if strategy:
+            return stellata.instrument.tag(model=self.model, query=self, strategy=strategy)
+
+        return stellata.instrument.tag(model=self.model, query=self)
+
+    def _update_query(self, data: 'stellata.model.Model', returning='all'):
         values = []
         query = 'update "%s" ' % self.model.__table__
 
-        update = ','.join([e + ' = %s' for e in data.to_dict().keys()])
+        data = self._writable(data)
+        update = ','.join([e + ' = %s' for e in data.keys()])
         query += 'set %s ' % update
-        values += list(data.to_dict().values())
-        has_where = False
+        values += list(data.values())
+        fields = None
 
         if self.where_expression:
             where_query, where_values = self.where_expression.to_query()
-            query += 'where %s returning ' % where_query
+            query += 'where %s' % where_query
             values += where_values
 
-            # return all data from updated objects, so caller can determine which rows where changed
-            query += ','.join(self._field_aliases())
-            has_where = True
+            # return data from updated objects, so caller can determine which rows where changed. without a where
+            # clause, that would be the whole table, so nothing is returned
+            fields = self._returning_fields(returning)
+            if fields:
+                query += ' returning %s' % ','.join(self._field_aliases(fields=fields))
 
-        return (query, values, has_where)
+        return (query, values, fields)
+
+    def _writable(self, data: 'stellata.model.Model'):
+        # generated columns are computed by the database, which rejects any value given for them
+        result = data.to_dict()
+        generated = [field.column for field in self.model.__fields__ if field.generated]
+        if generated:
+            result = {k: v for k, v in result.items() if k not in generated}
+
+        return result
+
+    def create(self, data: Union['stellata.model.Model', list], unique=None, returning='all', ignore=False):
+        """Insert one or more objects, returning them as stored, with any defaults added.
+
+        `unique` upserts on the given fields or index. With `ignore`, rows that conflict (on `unique`, if given) are
+        skipped instead. `returning` is `'all'`, a field or list of fields to return, or None to return only the
+        number of rows inserted.
+        """
 
-    def create(self, data: Union['stellata.model.Model', list], unique=None):
         # accept both a list and single dictionary as an argument
         one = False
         if not isinstance(data, list):
@@ -358,23 +454,83 @@ class Query:
         if len(data) == 0:
             return
 
-        # run insert query and get result, which will have any defaults added as well
-        query, values = self._insert_query(data, unique, one)
-        result = [self._row_to_object(self.model, row) for row in self._pool().query(query, values)]
+        query, values = self._insert_query(data, unique, one, returning, ignore)
+        fields = self._returning_fields(returning)
+        with self._tag():
+            if not fields:
+                return self._pool().execute(query, values)
 
-        if one and len(result) > 0:
-            return result[0]
+            # run insert query and get result, which will have any defaults added as well
+            rows = self._pool().query(query, values)
+
+        result = [self._row_to_object(self.model, row, fields=fields) for row in rows]
+
+        # a single object that was skipped as a conflict has no row to return
+        if one:
+            return result[0] if len(result) > 0 else None
         return result
 
-    def delete(self):
-        query, values = self._delete_query()
-        self._pool().execute(query, values)
+    def delete(self, returning=None):
+        """Delete matching rows, returning the number deleted, or the deleted objects with `returning`."""
+
+        query, values = self._delete_query(returning)
+        fields = self._returning_fields(returning)
+        with self._tag():
+            if not fields:
+                return self._pool().execute(query, values)
+
+            rows = self._pool().query(query, values)
+            return [self._row_to_object(self.model, row, fields=fields) for row in rows]
+
+    def export(self, fp, format: str = 'ndjson', batch_size: int = 1000):
+        """Stream query results into a file-like object (a file, socket file, etc.), returning the number of rows.
+
+        Rows are read with a server-side cursor and written `batch_size` at a time, so memory use stays constant and
+        output starts before the query finishes. `ndjson` writes one serialized model per line, `msgpack` writes a
+        stream of serialized models, and `csv` writes the raw columns with a header using `COPY ... TO STDOUT`.
+        """
+
+        if self.joins:
+            raise ValueError('Joins cannot be exported')
+
+        if format == 'csv':
+            columns = ['"%s"."%s"' % (self.model.__table__, field.column) for field in self.model.__fields__]
+            query, values = self._select_query(columns=columns)
+            with self._tag():
+                return self._pool(read=True).copy_to(query, values, fp)
+
+        if format not in ('ndjson', 'msgpack'):
+            raise ValueError('Unknown export format: %s' % format)
+
+        text = isinstance(fp, io.TextIOBase)
+        if format == 'msgpack' and text:
+            raise ValueError('msgpack must be exported to a binary file')
+
+        encoder = stellata.model._encoder(self.model)
+        packer = msgpack.Packer(default=stellata.model._encode)
+        count = 0
+        query, values = self._select_query()
+        with self._tag():
+            for rows in self._pool(read=True).stream(query, values, batch_size):
+                objects = [encoder(e) for e in (self._row_to_object(self.model, row) for row in rows) if e]
+                count += len(objects)
+
+                # write each batch at once, rather than a row at a time
+                if format == 'msgpack':
+                    fp.write(b''.join(packer.pack(e) for e in objects))
+                else:
+                    data = ''.join(json.dumps(e, default=stellata.model._encode) + '\n' for e in objects)
+                    fp.write(data if text else data.encode('utf-8'))
+
+        return count
 
     def get(self, one=False):
         # if we don't have any joins, then just grab rows and we're done
         if not self.joins:
             query, values = self._select_query()
-            rows = self._pool().query(query, values)
+            with self._tag():
+                rows = self._pool(read=True).query(query, values)
+
             result = [self._row_to_object(self.model, row) for row in rows]
             if one and len(result) > 0:
                 result = result[0]
@@ -454,14 +610,26 @@ class Query:
         self.order_expression = OrderByExpression(fields, order)
         return self
 
-    def update(self, data: 'stellata.model.Model'):
-        query, values, has_where = self._update_query(data)
+    def select(self, field: 'stellata.field.Operand'):
+        """Choose the column selected when this query is used as a subquery, like `A.id << B.select(B.a_id)`."""
 
-        if has_where:
-            rows = self._pool().query(query, values)
-            return [self._row_to_object(self.model, row) for row in rows]
+        self.select_field = field
+        return self
+
+    def update(self, data: 'stellata.model.Model', returning='all'):
+        """Update matching rows, returning the updated objects, or the number of rows updated with no `returning`.
+
+        Updates without a where clause always return the number of rows updated.
+        """
+
+        query, values, fields = self._update_query(data, returning)
 
-        return self._pool().execute(query, values)
+        with self._tag():
+            if fields:
+                rows = self._pool().query(query, values)
+                return [self._row_to_object(self.model, row, fields=fields) for row in rows]
+
+            return self._pool().execute(query, values)
 
     def where(self, expression: 'Expression'):
         self.where_expression = expression
@@ -523,19 +691,25 @@ class OrderByExpression(Expression):
 
     def to_query(self, alias_map=None):
         alias_map = alias_map or {}
-        return 'order by %s %s' % (','.join([
-            '"%s"."%s"' % (alias_map.get(field.model.__table__, field.model.__table__), field.column)
-            for field in self.fields
-        ]), self.order)
+        columns = []
+        for field in self.fields:
+            column = '"%s"."%s"' % (alias_map.get(field.model.__table__, field.model.__table__), field.column)
+            if field.template:
+                column = field.template.format(column)
+
+            columns.append(column)
+
+        return 'order by %s %s' % (','.join(columns), self.order)
 
 class SingleColumnExpression(Expression):
     """Expression containing a single column and value.
 
-    Example SingleColumnExpressions are `id = 5` or `count > 3`.
+    Example SingleColumnExpressions are `id = 5`, `count >= 3` or `name like 'a%'`.
     OR-ing or AND-ing two SingleColumnExpressions produces a MultiColumnExpression.
     """
 
-    def __init__(self, model: 'stellata.model.Model', column: str, comparison: str, value: Union[int, str, bool]):
+    def __init__(self, model: 'stellata.model.Model', column: str, comparison: str, value: Union[int, str, bool],
+            template: str = None, cast: str = None):
         if value is None:
             comparison = 'is' if comparison == '=' else 'is not'
 
@@ -543,65 +717,194 @@ class SingleColumnExpression(Expression):
         self.column = column
         self.comparison = comparison
         self.value = value
+        self.template = template
+        self.cast = cast
 
     def __or__(self, value: Expression):
-        return MultiColumnExpression(self.model, self, value, 'or')
+        return MultiColumnExpression.combine(self.model, self, value, 'or')
 
     def __and__(self, value: Expression):
-        return MultiColumnExpression(self.model, self, value, 'and')
+        return MultiColumnExpression.combine(self.model, self, value, 'and')
+
+    def _column(self, alias_map):
+        table = alias_map.get(self.model.__table__, self.model.__table__)
+        column = '"%s"."%s"' % (table, self.column)
+        if self.template:
+            column = self.template.format(column)
+
+        return column
 
     def to_query(self, alias_map=None):
         alias_map = alias_map or {}
-        table = alias_map.get(self.model.__table__, self.model.__table__)
-        if self.comparison == 'in':
+        column = self._column(alias_map)
+        if isinstance(self.value, Query):
+            subquery, values = self.value._subquery()
+            return ('%s %s (%s)' % (column, self.comparison, subquery.strip()), values)
+
+        if self.comparison in ('in', 'not in'):
             return (
-                '"%s"."%s" %s (%s)' % (
-                    table,
-                    self.column,
+                '%s %s (%s)' % (
+                    column,
                     self.comparison,
                     ','.join(['%s' for e in self.value])
                 ),
                 self.value
             )
 
+        if self.comparison == 'between':
+            return ('(%s >= %%s and %s <= %%s)' % (column, column), list(self.value))
+
+        if self.comparison == '= any':
+            cast = '::%s' % self.cast if self.cast else ''
+            return ('%s = any(%%s%s)' % (column, cast), [self.value])
+
         if self.value == None:
-            return ('"%s"."%s" %s null' % (table, self.column, self.comparison), [])
+            return ('%s %s null' % (column, self.comparison), [])
 
-        return ('"%s"."%s" %s %%s' % (table, self.column, self.comparison), [self.value])
+        return ('%s %s %%s' % (column, self.comparison), [self.value])
 
 class MultiColumnExpression(Expression):
-    """Expression containing a two SingleColumnExpressions.
+    """Expression containing any number of expressions joined by the same operator.
 
-    Example SingleColumnExpressions are `id = 5 OR count > 3`.
-    OR-ing or AND-ing two MultiColumnExpressions produces a MultiColumnExpression.
+    Example MultiColumnExpressions are `id = 5 OR count > 3` or `id = 5 AND count > 3 AND count < 10`.
+    OR-ing or AND-ing expressions produces a MultiColumnExpression, and chains of the same operator are flattened
+    into one, so `a | b | c` has three terms rather than nesting.
     """
 
-    def __init__(self, model: 'stellata.model.Model', left: Expression, right: Expression, operator: str):
+    def __init__(self, model: 'stellata.model.Model', terms: list, operator: str):
         self.model = model
-        self.left = left
-        self.right = right
+        self.terms = terms
         self.operator = operator
 
     def __or__(self, value: Expression):
-        return MultiColumnExpression(self.model, self, value, 'or')
+        return MultiColumnExpression.combine(self.model, self, value, 'or')
+
+    def __and__(self, value: Expression):
+        return MultiColumnExpression.combine(self.model, self, value, 'and')
+
+    @classmethod
+    def combine(cls, model: 'stellata.model.Model', left: Expression, right: Expression, operator: str):
+        # operands that are None are dropped, and operands with the same operator are merged into this one
+        terms = []
+        for expression in (left, right):
+            if isinstance(expression, MultiColumnExpression) and expression.operator == operator:
+                terms.extend(expression.terms)
+            elif expression is not None:
+                terms.append(expression)
+
+        return cls(model, terms, operator)
+
+    def _wrap(self, queries):
+        # an empty conjunction is always true, and an empty disjunction never is
+        if not queries:
+            return ' (%s) ' % ('true' if self.operator == 'and' else 'false')
+
+        return ' (%s) ' % (' %s ' % self.operator).join(queries)
+
+    def to_query(self, alias_map=None):
+        alias_map = alias_map or {}
+        values = []
+
+        # compile without recursion, so long chains and deeply nested expressions don't hit the recursion limit.
+        # each frame holds an expression, its remaining terms, its compiled terms and the keys of those terms
+        frames = [(self, iter(self.terms), [], set())]
+        while True:
+            expression, terms, queries, seen = frames[-1]
+            term = next(terms, None)
+            if term is None:
+                frames.pop()
+                query = expression._wrap(queries)
+                if not frames:
+                    return (query, values)
+
+                frames[-1][2].append(query)
+            elif isinstance(term, MultiColumnExpression):
+                frames.append((term, iter(term.terms), [], set()))
+            else:
+                query, term_values = term.to_query(alias_map)
+
+                # skip terms that are repeated verbatim, since they can't change the result
+                try:
+                    key = (query, tuple(term_values))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                except TypeError:
+                    pass
+
+                queries.append(query)
+                values.extend(term_values)
+
+class ExistsExpression(Expression):
+    """Expression containing a correlated EXISTS subquery over a relation.
+
+    The subquery matches rows of the relation's child model that are related to the outer row, filtered by an
+    optional expression on the child model. Inverting an ExistsExpression with `~` produces NOT EXISTS.
+    """
+
+    def __init__(self, relation: 'stellata.relation.Relation', where: Expression = None, negate: bool = False):
+        self.relation = relation
+        self.model = relation.parent().model
+        self.where = where
+        self.negate = negate
+
+    def __or__(self, value: Expression):
+        return MultiColumnExpression.combine(self.model, self, value, 'or')
 
     def __and__(self, value: Expression):
-        return MultiColumnExpression(self.model, self, value, 'and')
+        return MultiColumnExpression.combine(self.model, self, value, 'and')
+
+    def __invert__(self):
+        return ExistsExpression(self.relation, self.where, not self.negate)
 
     def to_query(self, alias_map=None):
         alias_map = alias_map or {}
-        left_query = ''
-        left_values = []
-        right_query = ''
-        right_values = []
+        parent = self.relation.parent()
+        child = self.relation.child()
+        parent_table = alias_map.get(parent.model.__table__, parent.model.__table__)
+
+        # a relation from a table to itself needs another name for the inner table
+        child_table = child.model.__table__
+        child_alias = child_table
+        if child_alias == parent_table:
+            child_alias = '%s__exists' % child_table
+
+        query = 'select 1 from "%s" as "%s" where "%s"."%s" = "%s"."%s"' % (
+            child_table,
+            child_alias,
+            child_alias,
+            child.column,
+            parent_table,
+            parent.column
+        )
+
+        values = []
+        if self.where:
+            where_query, values = self.where.to_query(dict(alias_map, **{child_table: child_alias}))
+            query += ' and %s' % where_query.strip()
+
+        return ('%sexists (%s)' % ('not ' if self.negate else '', query), values)
+
+def exists(relation: 'stellata.relation.Relation', where: Expression = None):
+    """Match rows with at least one related row, like `A.where(exists(A.b, where=B.count > 3))`.
+
+    The filter runs as a semi-join in the same statement, so the related rows are never sent back.
+    """
+
+    return ExistsExpression(relation, where)
+
+def _literal(value):
+    adapted = psycopg2.extensions.adapt(value)
+    if hasattr(adapted, 'encoding'):
+        adapted.encoding = 'UTF8'
+
+    return adapted.getquoted().decode('utf-8')
 
-        if self.left:
-            left_query, left_values = self.left.to_query(alias_map)
-        if self.right:
-            right_query, right_values = self.right.to_query(alias_map)
+def _predicate(expression: Expression):
+    """Return SQL for an expression with its values written inline, as index predicates need."""
 
-        # if either of the operands evaluates to None, then the operator is meaningless
-        if not self.left or not self.right:
-            self.operator = ''
+    sql, values = expression.to_query()
 
-        return (' (%s %s %s) ' % (left_query, self.operator, right_query), left_values + right_values)
+    # predicates can only refer to the indexed table, so columns are left unqualified
+    sql = re.sub(r'"[^"]+"\."', '"', sql)
+    return (sql % tuple(_literal(e) for e in values)).strip()
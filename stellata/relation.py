@@ -11,16 +11,25 @@ class Relation:
     def __init__(self, foreign_key, parent=None):
         self.foreign_key_lambda = foreign_key
         self.parent_lambda = parent or (lambda: self.model.id)
+        self._resolved = None
 
     def _parent(self):
-        parent = self.parent_lambda()
-        if isinstance(parent, stellata.model.ModelType):
-            parent = parent.id
-
-        return parent
+        return self.resolve()[1]
 
     def foreign_key(self):
-        return self.foreign_key_lambda()
+        return self.resolve()[0]
+
+    def resolve(self):
+        """Return the foreign key and parent fields, calling the lambdas only the first time."""
+
+        if self._resolved is None:
+            parent = self.parent_lambda()
+            if isinstance(parent, stellata.model.ModelType):
+                parent = parent.id
+
+            self._resolved = (self.foreign_key_lambda(), parent)
+
+        return self._resolved
 
     def child(self):
         raise NotImplementedError()
@@ -5,18 +5,18 @@ class BelongsTo(stellata.relation.Relation):
         return self._parent()
 
     def parent(self):
-        return self.foreign_key_lambda()
+        return self.foreign_key()
 
 class HasMany(stellata.relation.Relation):
     def child(self):
-        return self.foreign_key_lambda()
+        return self.foreign_key()
 
     def parent(self):
         return self._parent()
 
 class HasOne(stellata.relation.Relation):
     def child(self):
-        return self.foreign_key_lambda()
+        return self.foreign_key()
 
     def parent(self):
         return self._parent()
@@ -0,0 +1,258 @@
+import collections
+import datetime
+import decimal
+import gzip
+import msgpack
+import psycopg2.extras
+import sys
+import threading
+import time
+import uuid
+
+import stellata.instrument
+
+_version = 1
+
+# msgpack extension types for values psycopg2 returns that msgpack can't represent natively
+_DATETIME = 1
+_DATE = 2
+_TIME = 3
+_TIMEDELTA = 4
+_DECIMAL = 5
+_UUID = 6
+
+class ReplayError(KeyError):
+    """Raised by a strict ReplayPool when asked for a query that wasn't recorded."""
+
+class _Cursor:
+    """Just enough of a cursor to build psycopg2 DictRows."""
+
+    def __init__(self, columns):
+        self.description = columns
+        self.index = collections.OrderedDict((column, i) for i, column in enumerate(columns))
+
+def _decode(code, data):
+    value = data.decode('utf-8')
+    if code == _DATETIME:
+        return datetime.datetime.fromisoformat(value)
+    elif code == _DATE:
+        return datetime.date.fromisoformat(value)
+    elif code == _TIME:
+        return datetime.time.fromisoformat(value)
+    elif code == _TIMEDELTA:
+        return datetime.timedelta(seconds=float(value))
+    elif code == _DECIMAL:
+        return decimal.Decimal(value)
+    elif code == _UUID:
+        return uuid.UUID(value)
+
+    return msgpack.ExtType(code, data)
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(_DATETIME, obj.isoformat().encode('utf-8'))
+    elif isinstance(obj, datetime.date):
+        return msgpack.ExtType(_DATE, obj.isoformat().encode('utf-8'))
+    elif isinstance(obj, datetime.time):
+        return msgpack.ExtType(_TIME, obj.isoformat().encode('utf-8'))
+    elif isinstance(obj, datetime.timedelta):
+        return msgpack.ExtType(_TIMEDELTA, repr(obj.total_seconds()).encode('utf-8'))
+    elif isinstance(obj, decimal.Decimal):
+        return msgpack.ExtType(_DECIMAL, str(obj).encode('utf-8'))
+    elif isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(_UUID, str(obj).encode('utf-8'))
+    elif isinstance(obj, memoryview):
+        return obj.tobytes()
+
+    raise TypeError('Cannot record value of type %s' % type(obj).__name__)
+
+def _key(sql: str, args):
+    return (sql, msgpack.packb(args, default=_encode, use_bin_type=True))
+
+def _open(path: str, mode: str):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def rows(columns: list, values: list):
+    """Build psycopg2 DictRows, the type real pools return, from a list of columns and a list of value lists."""
+
+    cursor = _Cursor(columns)
+    result = []
+    for value in values:
+        row = psycopg2.extras.DictRow(cursor)
+        row[:] = value
+        result.append(row)
+
+    return result
+
+def counts(path: str):
+    """Return the number of times each query shape ran in a recording."""
+
+    with _open(path, 'rb') as f:
+        data = msgpack.unpackb(f.read(), ext_hook=_decode, raw=False, strict_map_key=False)
+
+    return collections.Counter(stellata.instrument.shape(e[0]) for e in data['exchanges'])
+
+def diff(before: str, after: str):
+    """Compare query counts between two recordings.
+
+    Returns a dictionary mapping each query shape whose count changed to a `(before, after)` tuple.
+    """
+
+    before_counts = counts(before)
+    after_counts = counts(after)
+    return {
+        shape: (before_counts.get(shape, 0), after_counts.get(shape, 0))
+        for shape in set(before_counts) | set(after_counts)
+        if before_counts.get(shape, 0) != after_counts.get(shape, 0)
+    }
+
+class RecordingPool:
+    """Pool wrapper that records every `(sql, args) -> rows` exchange with the wrapped pool.
+
+    Use it in place of a real pool while a workload runs, then save the recording and serve it back later with a
+    ReplayPool. Files ending in `.gz` are compressed. As a context manager, the recording is saved on exit.
+    """
+
+    def __init__(self, pool, path: str = None):
+        self.pool = pool
+        self.path = path
+        self.exchanges = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.path:
+            self.save()
+
+    @property
+    def in_use(self):
+        return self.pool.in_use
+
+    def _record(self, sql: str, args, rows, rowcount=None):
+        # statements run with execute have no columns, and store the number of rows they affected instead
+        columns = None
+        values = rowcount
+        if rows is not None:
+            columns = list(rows[0].keys()) if rows else []
+            values = [list(row.values()) if isinstance(row, dict) else list(row) for row in rows]
+
+        with self._lock:
+            self.exchanges.append([sql, list(args) if args is not None else None, columns, values])
+
+    def execute(self, sql: str, args: tuple = None, autocommit: bool = False, lock_timeout: float = None):
+        result = self.pool.execute(sql, args, autocommit=autocommit, lock_timeout=lock_timeout)
+        self._record(sql, args, None, result)
+        return result
+
+    def query(self, sql: str, args: tuple = None):
+        rows = self.pool.query(sql, args)
+        self._record(sql, args, rows)
+        return rows
+
+    def reader(self):
+        return self
+
+    def save(self, path: str = None):
+        """Write the recording to a file."""
+
+        path = path or self.path
+        with self._lock:
+            data = msgpack.packb(
+                {'version': _version, 'exchanges': self.exchanges},
+                default=_encode,
+                use_bin_type=True
+            )
+
+        with _open(path, 'wb') as f:
+            f.write(data)
+
+    def writer(self):
+        return self
+
+class ReplayPool:
+    """Pool that serves exchanges captured by a RecordingPool, without a database.
+
+    Identical statements are served back in the order they were recorded, and the last response is repeated once
+    they run out. `latency` seconds are added to every round trip to simulate a network. Unrecorded statements
+    raise a ReplayError, unless `strict` is false, in which case they return no rows.
+
+    Note that joins executed with `join_with('join')` use random table aliases, so seed `random` the same way
+    while recording and replaying.
+    """
+
+    in_use = 0
+
+    def __init__(self, path: str, latency: float = 0.0, strict: bool = True):
+        self.latency = latency
+        self.strict = strict
+        self.queries = 0
+        self.shapes = collections.Counter()
+        self._lock = threading.Lock()
+        self._responses = {}
+
+        with _open(path, 'rb') as f:
+            data = msgpack.unpackb(f.read(), ext_hook=_decode, raw=False, strict_map_key=False)
+
+        for sql, args, columns, values in data['exchanges']:
+            self._responses.setdefault(_key(sql, args), collections.deque()).append((columns, values))
+
+    def _respond(self, sql: str, args):
+        with self._lock:
+            self.queries += 1
+            self.shapes[stellata.instrument.shape(sql)] += 1
+            responses = self._responses.get(_key(sql, list(args) if args is not None else None))
+            response = None
+            if responses:
+                response = responses.popleft() if len(responses) > 1 else responses[0]
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if response is None:
+            if self.strict:
+                raise ReplayError('No recorded response for %s' % str((sql, args)))
+            return None
+
+        return response
+
+    def execute(self, sql: str, args: tuple = None, autocommit: bool = False, lock_timeout: float = None):
+        # return the number of rows the statement affected when it was recorded
+        response = self._respond(sql, args)
+        if response is None or response[0] is not None:
+            return None
+
+        return response[1]
+
+    def query(self, sql: str, args: tuple = None):
+        response = self._respond(sql, args)
+        if response is None or response[0] is None:
+            return []
+
+        return rows(*response)
+
+    def reader(self):
+        return self
+
+    def writer(self):
+        return self
+
+def main(argv):
+    if len(argv) != 3 or argv[0] != 'diff':
+        print('usage: python -m stellata.replay diff BEFORE AFTER')
+        return 1
+
+    changes = diff(argv[1], argv[2])
+    for shape, (before, after) in sorted(changes.items(), key=lambda e: e[1][0] - e[1][1]):
+        print('%6d -> %6d  %s' % (before, after, shape))
+
+    before = sum(counts(argv[1]).values())
+    after = sum(counts(argv[2]).values())
+    print('total: %d -> %d round trips' % (before, after))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
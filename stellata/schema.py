@@ -1,17 +1,227 @@
+import hashlib
+import logging
+import psycopg2.errors
 import re
+import time
+
 import stellata.database
+import stellata.field
+import stellata.function
+import stellata.index
 import stellata.model
+import stellata.partition
+import stellata.query
+
+log = logging.getLogger('stellata')
+
+# bump whenever the statements generated for the same models change, so stored fingerprints no longer match
+_fingerprint_version = 2
+_fingerprint_table = 'stellata_schema'
+
+class Backfill(str):
+    """An update that's run repeatedly, one batch at a time, until it no longer affects any rows."""
+
+class Concurrent(str):
+    """A statement that has to run outside of a transaction, like `create index concurrently`.
+
+    `index` names the index being built, if any. A failed concurrent build leaves an invalid index behind, so it's
+    dropped before the statement runs.
+    """
+
+    def __new__(cls, sql, index=None):
+        statement = super().__new__(cls, sql)
+        statement.index = index
+        return statement
+
+class Catalog:
+    """Columns and indexes that currently exist for a set of tables.
+
+    Everything is loaded up front with one query for columns and one for indexes, straight from pg_catalog, so
+    migrations can be diffed in memory rather than querying the database once or more per model.
+    """
+
+    def __init__(self, columns=None, primary_keys=None, indexes=None, invalid=None, partitions=None, rendered=None):
+        # table name -> [(column name, data type, length, default, 'YES' or 'NO' for nullable, generation expression)]
+        self.columns = columns or {}
+
+        # table name -> [(table name, index name, index definition)]
+        self.primary_keys = primary_keys or {}
+        self.indexes = indexes or {}
+
+        # names of indexes left invalid by a failed concurrent build
+        self.invalid = invalid or set()
+
+        # partitioned table name -> set of partition names
+        self.partitions = partitions or {}
 
-def _alter_table_string(field, primary_key=False, create=False):
+        # index name -> index definition, and (table name, column name) -> generation expression, as postgres
+        # writes the ones defined by models
+        self.rendered = rendered or {}
+
+    @classmethod
+    def load(cls, database, tables, partitioned=()):
+        """Load the catalog for `tables`, and the partitions of the tables in `partitioned`."""
+
+        tables = list(tables)
+        catalog = cls()
+        if not tables:
+            return catalog
+
+        # data types and lengths are computed the same way as information_schema.columns, which is a view over
+        # these tables, so the results can be compared against field definitions as-is
+        sql = '''
+            select
+                c.relname,
+                a.attname,
+                case
+                    when t.typcategory = 'A' then 'ARRAY'
+                    when t.typtype in ('c', 'e') then 'USER-DEFINED'
+                    else format_type(a.atttypid, null)
+                end,
+                case
+                    when a.atttypid in ('character varying'::regtype, 'character'::regtype) and a.atttypmod > 0
+                    then a.atttypmod - 4
+                end,
+                case when a.attgenerated = '' then pg_get_expr(d.adbin, d.adrelid) end,
+                case when a.attnotnull then 'NO' else 'YES' end,
+                case when a.attgenerated <> '' then pg_get_expr(d.adbin, d.adrelid) end
+            from pg_attribute a
+            join pg_class c on c.oid = a.attrelid
+            join pg_type t on t.oid = a.atttypid
+            left join pg_attrdef d on d.adrelid = a.attrelid and d.adnum = a.attnum
+            where
+                c.relname = any(%s) and
+                c.relkind in ('r', 'p') and
+                pg_table_is_visible(c.oid) and
+                a.attnum > 0 and
+                not a.attisdropped
+            order by c.relname, a.attnum
+        '''
+        for table, *column in database.query(sql, (tables,)):
+            catalog.columns.setdefault(table, []).append(tuple(column))
+
+        sql = '''
+            select
+                c.relname,
+                i.relname,
+                pg_get_indexdef(i.oid),
+                x.indisprimary,
+                x.indisvalid
+            from pg_index x
+            join pg_class c on c.oid = x.indrelid
+            join pg_class i on i.oid = x.indexrelid
+            where
+                c.relname = any(%s) and
+                pg_table_is_visible(c.oid)
+            order by c.relname, i.oid
+        '''
+        for table, index_name, definition, primary, valid in database.query(sql, (tables,)):
+            indexes = catalog.primary_keys if primary else catalog.indexes
+            indexes.setdefault(table, []).append((table, index_name, definition))
+            if not valid:
+                catalog.invalid.add(index_name)
+
+        # only partitioned models need the extra round trip
+        partitioned = list(partitioned)
+        if partitioned:
+            sql = '''
+                select
+                    p.relname,
+                    c.relname
+                from pg_class p
+                left join pg_inherits i on i.inhparent = p.oid
+                left join pg_class c on c.oid = i.inhrelid
+                where
+                    p.relname = any(%s) and
+                    p.relkind = 'p' and
+                    pg_table_is_visible(p.oid)
+            '''
+            for table, partition in database.query(sql, (partitioned,)):
+                partitions = catalog.partitions.setdefault(table, set())
+                if partition:
+                    partitions.add(partition)
+
+        return catalog
+
+    def render(self, database, models):
+        """Load how postgres writes the index definitions and generation expressions of models with tables.
+
+        Postgres rewrites definitions as it stores them: it qualifies the table, quotes identifiers, adds casts to
+        literals and parenthesizes operands. Rather than comparing against definitions as written, each model is
+        created as an empty temporary table with its indexes, and what postgres stores for those is read back,
+        all in one transaction that drops the tables when it commits.
+        """
+
+        models = [e for e in models if getattr(e, '__table__', None) and e.__table__ in self.columns]
+        if not models:
+            return
+
+        foreign_key_indexes = _foreign_key_indexes(models)
+        statements = []
+        tables = {}
+        for i, model in enumerate(models):
+            # columns are created as the model defines them, so definitions can refer to columns being added
+            table = 'stellata_scratch_%d' % i
+            tables[table] = model.__table__
+            columns = []
+            for field in model.__fields__:
+                generated = _generated(field)
+                suffix = ' generated always as (%s) stored' % generated if generated else ''
+                columns.append('"%s" %s%s' % (field.column, _column_type(field), suffix))
+
+            statements.append('create temporary table "%s" (%s) on commit drop ;' % (table, ', '.join(columns)))
+            for index in model.__indexes__ + foreign_key_indexes.get(model, []):
+                if not isinstance(index, stellata.index.PrimaryKey):
+                    statements.append('%s ;' % _index_string(index, table=table))
+
+        names = ', '.join("'%s'" % e for e in tables)
+        statements.append('''
+            select
+                'index',
+                c.relname,
+                i.relname,
+                pg_get_indexdef(i.oid)
+            from pg_index x
+            join pg_class c on c.oid = x.indrelid
+            join pg_class i on i.oid = x.indexrelid
+            where
+                c.relnamespace = pg_my_temp_schema() and
+                c.relname in (%s)
+            union all
+            select
+                'column',
+                c.relname,
+                a.attname,
+                pg_get_expr(d.adbin, d.adrelid)
+            from pg_attrdef d
+            join pg_attribute a on a.attrelid = d.adrelid and a.attnum = d.adnum
+            join pg_class c on c.oid = d.adrelid
+            where
+                c.relnamespace = pg_my_temp_schema() and
+                c.relname in (%s) and
+                a.attgenerated <> ''
+        ''' % (names, names))
+
+        # index names are unique on their own, and the scratch table they're on is left out, since it doesn't
+        # match the real one
+        for kind, table, name, definition in database.query('\n'.join(statements)):
+            if kind == 'index':
+                self.rendered[name] = _without_table(definition)
+            else:
+                self.rendered[(tables[table], name)] = definition
+
+def _alter_table_string(field, primary_key=False, create=False, online=False):
     result = []
 
     alter = 'alter table "%s"' % field.model.__table__
+    generated = _generated(field)
     if create:
         prefix = '%s add column "%s"' % (alter, field.column)
-        if field.length:
-            result.append('%s %s (%s) ;' % (prefix, field.column_type, field.length))
-        else:
-            result.append('%s %s ;' % (prefix, field.column_type))
+        suffix = ''
+        if generated:
+            suffix = ' generated always as (%s) stored' % generated
+
+        result.append('%s %s%s ;' % (prefix, _column_type(field), suffix))
     else:
         prefix = '%s alter column "%s" type %s' % (alter, field.column, field.column_type)
         if field.column_type == 'uuid':
@@ -24,9 +234,15 @@ def _alter_table_string(field, primary_key=False, create=False):
     alter += ' alter column "%s"' % field.column
     if field.null:
         result.append('%s drop not null ;' % alter)
+    elif online:
+        result.extend(_set_not_null_strings(field))
     else:
         result.append('%s set not null ;' % alter)
 
+    # generated columns can't have defaults at all
+    if generated:
+        return result
+
     if field.default is not None:
         result.append('%s set default %s ;' % (alter, field.default))
     else:
@@ -34,7 +250,41 @@ def _alter_table_string(field, primary_key=False, create=False):
 
     return result
 
-def _handle(database, statements, execute, debug=False):
+def _column_type(field):
+    if field.length:
+        return '%s (%s)' % (field.column_type, field.length)
+
+    return field.column_type
+
+def _execute(database, statement, lock_timeout=None, retries=0):
+    # plain statements are sent as-is, so offline migrations run exactly as they always have
+    if lock_timeout is None and not isinstance(statement, (Backfill, Concurrent)):
+        return database.execute(statement)
+
+    autocommit = isinstance(statement, Concurrent)
+    for attempt in range(retries + 1):
+        try:
+            if autocommit and statement.index:
+                database.execute(
+                    'drop index concurrently if exists "%s" ;' % statement.index,
+                    autocommit=True,
+                    lock_timeout=lock_timeout
+                )
+
+            rowcount = database.execute(statement, autocommit=autocommit, lock_timeout=lock_timeout)
+            while isinstance(statement, Backfill) and rowcount:
+                rowcount = database.execute(statement, lock_timeout=lock_timeout)
+
+            return
+        except psycopg2.errors.LockNotAvailable:
+            if attempt == retries:
+                raise
+
+            # back off, so the statement doesn't keep queueing behind the same long-running transaction
+            log.warning('Timed out waiting for a lock, retrying: %s', statement)
+            time.sleep(min(0.1 * 2 ** attempt, 5.0))
+
+def _handle(database, statements, execute, debug=False, lock_timeout=None, retries=0):
     if not statements:
         return
 
@@ -46,40 +296,140 @@ def _handle(database, statements, execute, debug=False):
             if debug:
                 print(statement)
 
-            database.execute(statement)
+            _execute(database, statement, lock_timeout, retries)
 
     return statements
 
+def _foreign_key_indexes(models, catalog=None):
+    """Return a dictionary mapping models to indexes for relation foreign keys that no index on the model leads with.
+
+    Relations are looked up by their foreign key, so without an index every join or child query scans the table.
+    Partial indexes don't count, since they only cover some rows. If a `catalog` is given, an existing index that
+    isn't defined on the model but leads with the foreign key covers it too; its index is returned with `existing`
+    set to that index's name, so migrations keep it rather than building another.
+    """
+
+    tables = set(_tables(models))
+    result = {}
+    seen = set()
+    for model in models:
+        for relation in getattr(model, '__relations__', []):
+            field = relation.foreign_key()
+            key = (field.model, field.column)
+            if field.model.__table__ not in tables or key in seen:
+                continue
+
+            seen.add(key)
+            covered = False
+            for index in field.model.__indexes__:
+                leading = index.fields()[0]
+                if isinstance(leading, stellata.field.Field) and leading.column == field.column and \
+                        not index.where_lambda:
+                    covered = True
+
+            if not covered:
+                index = stellata.index.Index(lambda field=field: field)
+                index.column = '%s__fkey' % field.column
+                index.model = field.model
+                index.relation = relation
+                index.existing = _covering_index(catalog, field) if catalog else None
+                result.setdefault(field.model, []).append(index)
+
+    return result
+
+def _covering_index(catalog, field):
+    # indexes defined on the model are checked against the model instead, since migrations may rebuild them
+    defined = set(_index_name(e) for e in field.model.__indexes__)
+    for table, index_name, definition in catalog.indexes.get(field.model.__table__, []):
+        if index_name in defined or index_name in catalog.invalid or ' WHERE ' in definition:
+            continue
+
+        match = re.search(r' USING \w+ \("?([^",)\s]+)"?[,)\s]', definition)
+        if match and match.group(1) == field.column:
+            return index_name
+
+    return None
+
+def _generated(field):
+    if not field.generated:
+        return None
+
+    expression = field.generated()
+    if isinstance(expression, stellata.function.Function):
+        return expression.sql()
+
+    return '"%s"' % expression.column
+
 def _index_name(index):
     return '%s__%s' % (index.model.__table__, index.column)
 
-def _index_string(index):
+def _index_string(index, concurrently=False, name=None, table=None):
     sql = 'create '
     if index.unique:
         sql += 'unique '
 
-    sql += 'index "%s" on "%s" using btree (%s)' % (
-        _index_name(index),
-        index.model.__table__,
-        ', '.join([e.column for e in index.fields()])
+    sql += 'index '
+    if concurrently:
+        sql += 'concurrently '
+
+    # ascending is the default order, and postgres leaves it out of index definitions
+    columns = []
+    for field, order in index.columns():
+        column = field.column
+        if isinstance(field, stellata.function.Function):
+            column = '(%s)' % field.sql()
+
+        if order and order.lower() != 'asc':
+            columns.append('%s %s' % (column, order.lower()))
+        else:
+            columns.append(column)
+
+    sql += '"%s" on "%s" using %s (%s)' % (
+        name or _index_name(index),
+        table or index.model.__table__,
+        index.method,
+        ', '.join(columns)
     )
 
+    include = index.include()
+    if include:
+        sql += ' include (%s)' % ', '.join([e.column for e in include])
+
+    where = index.where()
+    if where is not None:
+        sql += ' where %s' % stellata.query._predicate(where)
+
     return sql
 
-def _migrate_indexes(database, models, execute):
+def _online_primary_key(table, index_columns, replace=False):
+    # build the index without blocking writes, then promote it, which only needs a brief lock
+    result = [Concurrent(
+        'create unique index concurrently "%s_pkey__new" on "%s" using btree (%s) ;' % (table, table, index_columns),
+        '%s_pkey__new' % table
+    )]
+
+    sql = 'alter table %s add constraint %s_pkey primary key using index %s_pkey__new ;' % (table, table, table)
+    if replace:
+        sql = 'alter table %s drop constraint if exists %s_pkey ; %s' % (table, table, sql)
+
+    result.append(sql)
+    return result
+
+def _migrate_indexes(database, models, execute, catalog=None, online=False, foreign_key_indexes=None):
+    if catalog is None:
+        catalog = Catalog.load(database, _tables(models))
+        catalog.render(database, models)
+
+    if foreign_key_indexes is None:
+        foreign_key_indexes = {}
+
     result = []
     for model in models:
+        # partitioned tables don't support building indexes concurrently
+        concurrently = online and not model.__partition__
+
         # get the primary key for the table
-        sql = '''
-            select
-                tablename,
-                indexname,
-                indexdef
-            from pg_indexes where
-                tablename = '%s' and
-                indexname like '%%_pkey'
-        ''' % model.__table__
-        schema = database.query(sql)
+        schema = catalog.primary_keys.get(model.__table__, [])
 
         # handle primary keys first
         primary_keys_match = False
@@ -99,7 +449,9 @@ def _migrate_indexes(database, models, execute):
 
         if database_has_primary_key and not model_has_primary_key:
             result.append('alter table %s drop constraint if exists %s_pkey ;' % (model.__table__, model.__table__))
-        if not database_has_primary_key and model_has_primary_key:
+        if concurrently and model_has_primary_key and (not database_has_primary_key or not primary_keys_match):
+            result.extend(_online_primary_key(model.__table__, index_columns, replace=database_has_primary_key))
+        elif not database_has_primary_key and model_has_primary_key:
             result.append(
                 'alter table %s add primary key (%s) ;' %
                 (model.__table__, index_columns)
@@ -112,16 +464,7 @@ def _migrate_indexes(database, models, execute):
             )
 
         # get indexes that currently exist for table, excluding primary key
-        sql = '''
-            select
-                tablename,
-                indexname,
-                indexdef
-            from pg_indexes where
-                tablename = '%s' and
-                indexname not like '%%_pkey'
-        ''' % model.__table__
-        schema = database.query(sql)
+        schema = catalog.indexes.get(model.__table__, [])
 
         # get all indexes that should exist in database, skipping primary keys
         defined_indexes = []
@@ -133,6 +476,14 @@ def _migrate_indexes(database, models, execute):
             defined_indexes.append(index)
             defined_index_names.add(_index_name(index))
 
+        # an existing index that covers a foreign key is kept as-is, even though the model doesn't define it
+        for index in foreign_key_indexes.get(model, []):
+            if index.existing:
+                defined_index_names.add(index.existing)
+            else:
+                defined_indexes.append(index)
+                defined_index_names.add(_index_name(index))
+
         # make sure all existing indexes match the types defined by models
         existing_indexes = set()
         for existing_index in schema:
@@ -143,46 +494,171 @@ def _migrate_indexes(database, models, execute):
                 if _index_name(defined_index) == index_name:
                     index_string = _index_string(defined_index)
 
-                    # if definitions don't match, then drop index and re-create
-                    if index_string.lower().replace('"', '') != definition.lower().replace('"', ''):
-                        result.append('drop index "%s" ;' % index_name)
-                        result.append('%s ;' % index_string)
+                    # if definitions don't match, or a concurrent build failed, then drop index and re-create
+                    if catalog.rendered.get(index_name) != _without_table(definition) or \
+                            index_name in catalog.invalid:
+                        if concurrently:
+                            # build the replacement alongside the old index, so queries can use one or the other
+                            # throughout
+                            temporary_name = '%s__new' % index_name
+                            result.append(Concurrent(
+                                '%s ;' % _index_string(defined_index, concurrently=True, name=temporary_name),
+                                temporary_name
+                            ))
+                            result.append(Concurrent('drop index concurrently "%s" ;' % index_name))
+                            result.append('alter index "%s" rename to "%s" ;' % (temporary_name, index_name))
+                        else:
+                            result.append('drop index "%s" ;' % index_name)
+                            result.append('%s ;' % index_string)
 
         # drop indexes that are no longer needed
         unused_indexes = existing_indexes - defined_index_names
         for unused_index in unused_indexes:
-            result.append('drop index "%s" ;' % unused_index)
+            if concurrently:
+                result.append(Concurrent('drop index concurrently if exists "%s" ;' % unused_index))
+            else:
+                result.append('drop index "%s" ;' % unused_index)
 
         # add indexes that are missing
         missing_indexes = defined_index_names - existing_indexes
         for missing_index in missing_indexes:
             for defined_index in defined_indexes:
                 if missing_index == _index_name(defined_index):
-                    result.append('%s ;' % _index_string(defined_index))
+                    # foreign key indexes are added to tables that may already be big, so they're always built
+                    # concurrently where postgres allows it
+                    if concurrently or (hasattr(defined_index, 'relation') and not model.__partition__):
+                        result.append(Concurrent(
+                            '%s ;' % _index_string(defined_index, concurrently=True),
+                            missing_index
+                        ))
+                    else:
+                        result.append('%s ;' % _index_string(defined_index))
+
+    return result
+
+def _rewrites(field, column_type, length):
+    # widening a varchar, or turning it into text, only changes metadata; other type changes rewrite the table
+    if column_type == field.column_type:
+        return column_type == 'character varying' and field.length is not None and \
+            (length is None or field.length < length)
+
+    return not (column_type == 'character varying' and field.column_type == 'text')
+
+def _set_not_null_strings(field):
+    """Make a column not null without scanning the table under an exclusive lock.
+
+    A check constraint is added without checking existing rows, then validated, which scans the table but lets
+    writes through, and postgres 12 and later skip the scan for `set not null` when a valid check proves it. The
+    check isn't needed after that.
+    """
+
+    table = field.model.__table__
+    column = field.column
+    constraint = '%s__%s__not_null' % (table, column)
+    return [
+        'alter table "%s" drop constraint if exists "%s" , add constraint "%s" check ("%s" is not null) not valid ;'
+            % (table, constraint, constraint, column),
+        'alter table "%s" validate constraint "%s" ;' % (table, constraint),
+        'alter table "%s" alter column "%s" set not null ;' % (table, column),
+        'alter table "%s" drop constraint "%s" ;' % (table, constraint),
+    ]
+
+def _swap_column_strings(field, batch_size=1000):
+    """Change a column's type without rewriting the table under an exclusive lock.
+
+    A new column is added and kept in sync with the old one by a trigger, existing rows are backfilled in
+    batches, then the new column replaces the old one in a single short transaction.
+    """
+
+    table = field.model.__table__
+    column = field.column
+    temporary = '%s__new' % column
+    function = '%s__%s__sync' % (table, column)
+    column_type = field.column_type
+    if field.length:
+        column_type = '%s (%s)' % (column_type, field.length)
+
+    return [
+        'alter table "%s" add column if not exists "%s" %s ;' % (table, temporary, column_type),
+        'create or replace function "%s"() returns trigger as $$ begin new."%s" := new."%s"::%s ; return new ; '
+            'end $$ language plpgsql ;' % (function, temporary, column, column_type),
+        'drop trigger if exists "%s" on "%s" ; create trigger "%s" before insert or update on "%s" for each row '
+            'execute procedure "%s"() ;' % (function, table, function, table, function),
+        Backfill(
+            'update "%s" set "%s" = "%s"::%s where ctid = any(array(select ctid from "%s" where "%s" is null and '
+            '"%s" is not null limit %d)) ;' % (
+                table, temporary, column, column_type, table, temporary, column, batch_size
+            )
+        ),
+        'drop trigger "%s" on "%s" ; drop function "%s"() ; alter table "%s" drop column "%s" ; '
+            'alter table "%s" rename column "%s" to "%s" ;' % (
+                function, table, function, table, column, table, temporary, column
+            ),
+    ] + _alter_table_string(field, online=True)[1:]
+
+def _migrate_partitions(database, models, execute, catalog=None, online=False):
+    models = [e for e in models if getattr(e, '__table__', None) and e.__partition__]
+    if catalog is None:
+        catalog = Catalog.load(database, _tables(models), _tables(models))
+
+    result = []
+    today = stellata.partition._today()
+    for model in models:
+        table = model.__table__
+        partition = model.__partition__
+        if table in catalog.columns and table not in catalog.partitions:
+            log.warning('Table %s already exists without partitions, so it has to be partitioned by hand', table)
+            continue
+
+        # create partitions that don't exist yet
+        existing = catalog.partitions.get(table, set())
+        prefix = '%s_' % table
+        for suffix, bounds in partition.partitions(today).items():
+            name = prefix + suffix
+            if name not in existing:
+                result.append('create table "%s" partition of "%s" %s ;' % (name, table, bounds))
+
+        # and remove those that have expired
+        suffixes = [e[len(prefix):] for e in existing if e.startswith(prefix)]
+        for suffix in partition.expired(suffixes, today):
+            name = prefix + suffix
+            if partition.drop:
+                result.append('drop table "%s" ;' % name)
+            elif online:
+                result.append(Concurrent('alter table "%s" detach partition "%s" concurrently ;' % (table, name)))
+            else:
+                result.append('alter table "%s" detach partition "%s" ;' % (table, name))
 
     return result
 
-def _migrate_tables(database, models, execute):
+def _migrate_tables(database, models, execute, catalog=None, online=False, batch_size=1000):
+    if catalog is None:
+        catalog = Catalog.load(database, _tables(models))
+        catalog.render(database, models)
+
     result = []
     for model in models:
         if not hasattr(model, '__table__') or not model.__table__:
             continue
 
         # get columns that currently exist for table
-        sql = '''
-            select
-                column_name,
-                data_type,
-                character_maximum_length,
-                column_default,
-                is_nullable
-            from information_schema.columns where
-                table_name = '%s';
-        ''' % model.__table__
-        schema = database.query(sql)
-
-        # if table doesn't exist in schema, then it needs to be created
-        if len(schema) == 0:
+        schema = catalog.columns.get(model.__table__, [])
+
+        # if table doesn't exist in schema, then it needs to be created. partitioned tables need their partition
+        # key up front, so those columns are created along with the table
+        created_columns = set()
+        if len(schema) == 0 and model.__partition__:
+            keys = model.__partition__.fields()
+            result.append('create table "%s" (%s) partition by %s ;' % (
+                model.__table__,
+                ', '.join(['"%s" %s' % (e.column, _column_type(e)) for e in keys]),
+                model.__partition__.key()
+            ))
+
+            for field in keys:
+                result.extend(_alter_table_string(field, create=True)[1:])
+                created_columns.add(field.column)
+        elif len(schema) == 0:
             result.append('create table "%s" () ;' % model.__table__)
 
         # get all columns that should exist in the database
@@ -208,32 +684,142 @@ def _migrate_tables(database, models, execute):
 
         # for each column that exists in the database, make sure its metadata matches models
         existing_columns = set()
+        swapped_columns = set()
+        recreated_columns = set()
         for existing_column in schema:
-            column_name, column_type, length, default, null = existing_column
+            column_name, column_type, length, default, null, generated = existing_column
             existing_columns.add(column_name)
 
             for field in defined_fields:
                 if field.column == column_name:
+                    # generation expressions can't be changed in place, so the column is added again
+                    expression = _generated(field)
+                    if expression and (not generated or catalog.rendered.get((model.__table__, column_name)) !=
+                            generated):
+                        result.append('alter table "%s" drop column "%s" ;' % (model.__table__, column_name))
+                        result.extend(_alter_table_string(field, create=True))
+                        recreated_columns.add(column_name)
+                        continue
+
+                    if generated and not expression:
+                        result.append('alter table "%s" alter column "%s" drop expression ;' % (
+                            model.__table__,
+                            column_name
+                        ))
+
                     if column_type != field.column_type or \
                             length != field.length or \
                             str(default) != str(field.default) or \
                             (null == 'YES' and not field.null) or \
                             (null == 'NO' and field.null):
-                        result.extend(_alter_table_string(field))
-
-        # drop columns that are no longer needed
-        unused_columns = existing_columns - defined_columns
+                        if online and not expression and _rewrites(field, column_type, length):
+                            result.extend(_swap_column_strings(field, batch_size))
+                            swapped_columns.add(column_name)
+                        else:
+                            result.extend(_alter_table_string(field, online=online and null == 'YES'))
+
+        # indexes on swapped or recreated columns are dropped along with the old column, so they'll need to be
+        # created again
+        if swapped_columns or recreated_columns:
+            _forget_indexes(catalog, model.__table__, swapped_columns | recreated_columns)
+
+        # drop columns that are no longer needed, leaving alone any left over from an unfinished swap
+        unused_columns = existing_columns - defined_columns - {'%s__new' % e for e in swapped_columns}
         for unused_column in unused_columns:
             result.append('alter table "%s" drop column "%s" ;' % (model.__table__, unused_column))
 
         # add columns that are missing, preserving the order determined earlier
-        missing_columns = defined_columns - existing_columns
+        missing_columns = defined_columns - existing_columns - created_columns
         for field in defined_fields:
             if field.column in missing_columns:
                 result.extend(_alter_table_string(field, create=True))
 
     return result
 
+def _fingerprint(model, extra_indexes=()):
+    fields = sorted(
+        (field.column, field.column_type, field.length, str(field.default), field.null, _generated(field))
+        for field in model.__fields__
+    )
+
+    indexes = []
+    for index in model.__indexes__:
+        if isinstance(index, stellata.index.PrimaryKey):
+            indexes.append('primary key (%s)' % ','.join([e.column for e in index.fields()]))
+        else:
+            indexes.append(_index_string(index))
+
+    for index in extra_indexes:
+        indexes.append(_index_string(index))
+
+    partition = model.__partition__.key() if model.__partition__ else None
+    definition = repr((_fingerprint_version, model.__table__, fields, sorted(indexes), partition))
+    return hashlib.sha256(definition.encode('utf-8')).hexdigest()
+
+def _fingerprints(models, foreign_key_indexes=None):
+    foreign_key_indexes = foreign_key_indexes or {}
+    return {
+        model.__table__: _fingerprint(model, foreign_key_indexes.get(model, ()))
+        for model in models
+        if getattr(model, '__table__', None)
+    }
+
+def _forget_indexes(catalog, table, columns):
+    # look for the columns anywhere after the table name, outside of string literals, which covers keys, included
+    # columns, expressions and predicates
+    pattern = re.compile(r'\b(%s)\b' % '|'.join(re.escape(e) for e in columns))
+    for indexes in (catalog.primary_keys, catalog.indexes):
+        indexes[table] = [
+            e for e in indexes.get(table, [])
+            if not pattern.search(re.sub(r"'(''|[^'])*'", '', e[2].split(' USING ', 1)[-1]))
+        ]
+
+def _stored_fingerprints(database, tables):
+    try:
+        rows = database.query(
+            'select table_name, fingerprint from %s where table_name = any(%%s)' % _fingerprint_table,
+            (tables,)
+        )
+    except psycopg2.errors.UndefinedTable:
+        return {}
+
+    return {table: fingerprint for table, fingerprint in rows}
+
+def _store_fingerprints(database, fingerprints):
+    database.execute('''
+        create table if not exists %s (
+            table_name text primary key,
+            fingerprint text not null,
+            dt timestamp without time zone not null default now()
+        ) ;
+
+        insert into %s (table_name, fingerprint)
+        select * from unnest(%%s::text[], %%s::text[])
+        on conflict (table_name) do update set fingerprint = excluded.fingerprint, dt = now() ;
+    ''' % (_fingerprint_table, _fingerprint_table), (list(fingerprints), list(fingerprints.values())))
+
+def _partitioned(models):
+    return [e.__table__ for e in models if getattr(e, '__table__', None) and e.__partition__]
+
+def _tables(models):
+    return [e.__table__ for e in models if getattr(e, '__table__', None)]
+
+def _without_table(definition):
+    # index definitions name the table they're on between ON and USING
+    return re.sub(r' ON .*? USING ', ' USING ', definition, count=1)
+
+def fingerprint(models=None, foreign_key_indexes='warn'):
+    """Return a hash of everything migrations depend on in model definitions: tables, columns and indexes.
+
+    The hash doesn't depend on the order models, fields or indexes are defined in.
+    """
+
+    if not models:
+        models = stellata.model._models
+
+    indexes = _foreign_key_indexes(models) if foreign_key_indexes == 'create' else None
+    return hashlib.sha256(repr(sorted(_fingerprints(models, indexes).items())).encode('utf-8')).hexdigest()
+
 def drop_tables_and_lose_all_data(database, execute=False):
     sql = '''
         select
@@ -247,15 +833,121 @@ def drop_tables_and_lose_all_data(database, execute=False):
     _handle(database, statements, execute)
     return statements
 
-def migrate(database=None, models=None, execute=False, debug=False):
+def maintain_partitions(database=None, models=None, execute=False, debug=False, online=False, lock_timeout=5.0,
+        retries=5):
+    """Create upcoming partitions and detach or drop expired ones for partitioned models.
+
+    Migrations do this too, but partitions are created ahead of time, so run this regularly (daily, say) to keep
+    them coming even when there's nothing else to migrate. Returns the statements needed.
+    """
+
     if not database:
         database = stellata.database.pool
 
     if not models:
         models = stellata.model._models
 
+    partitioned = _partitioned(models)
+    catalog = Catalog.load(database, partitioned, partitioned)
+    result = _migrate_partitions(database, models, execute, catalog, online)
+    _handle(database, result, execute, debug, lock_timeout if online else None, retries if online else 0)
+    return result
+
+def migrate(database=None, models=None, execute=False, debug=False, timings=None, online=False, lock_timeout=5.0,
+        retries=5, batch_size=1000, fingerprint=False, foreign_key_indexes='warn'):
+    """Return the statements needed to sync the database with models, and run them if `execute` is true.
+
+    If a `timings` dictionary is given, the number of seconds spent in each phase (introspect, tables,
+    partitions, indexes and execute) is stored in it.
+
+    With `online`, the migration avoids holding locks that block writes for long: indexes and primary keys are
+    built concurrently, type changes that would rewrite a table are done with a new column that's backfilled
+    `batch_size` rows at a time, and every statement gives up waiting for a lock after `lock_timeout` seconds
+    and is retried up to `retries` times.
+
+    With `fingerprint`, a fingerprint of each model's definition is stored in the database after a migration is
+    executed, and later migrations skip introspection entirely, returning no statements, as long as no model has
+    changed since. Only use it if the schema isn't changed outside of migrations. Skipped migrations don't
+    create or expire partitions, so use `maintain_partitions` for that.
+
+    Foreign keys of relations that no index leads with are logged as warnings if `foreign_key_indexes` is
+    `'warn'`, or get an index named `<table>__<column>__fkey` if it's `'create'`, which is always built
+    concurrently unless the table is partitioned. An existing index that leads with the foreign key counts, and is
+    kept even if no model defines it. Pass None to skip the check.
+    """
+
+    if not database:
+        database = stellata.database.pool
+
+    if not models:
+        models = stellata.model._models
+
+    if timings is None:
+        timings = {}
+
+    if foreign_key_indexes not in ('warn', 'create', None):
+        raise ValueError('Unknown foreign_key_indexes mode: %s' % foreign_key_indexes)
+
+    if fingerprint:
+        start = time.perf_counter()
+        indexes = _foreign_key_indexes(models) if foreign_key_indexes == 'create' else None
+        fingerprints = _fingerprints(models, indexes)
+        matches = _stored_fingerprints(database, list(fingerprints)) == fingerprints
+        timings['fingerprint'] = time.perf_counter() - start
+        if matches:
+            log.debug('Schema fingerprint matches for %s models, skipping migration', len(models))
+            return []
+
+    start = time.perf_counter()
+    catalog = Catalog.load(database, _tables(models), _partitioned(models))
+    catalog.render(database, models)
+    timings['introspect'] = time.perf_counter() - start
+
     result = []
-    result.extend(_migrate_tables(database, models, execute))
-    result.extend(_migrate_indexes(database, models, execute))
-    _handle(database, result, execute, debug)
+    start = time.perf_counter()
+    result.extend(_migrate_tables(database, models, execute, catalog, online, batch_size))
+    timings['tables'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result.extend(_migrate_partitions(database, models, execute, catalog, online))
+    timings['partitions'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    missing_indexes = _foreign_key_indexes(models, catalog) if foreign_key_indexes else {}
+    if foreign_key_indexes == 'warn':
+        for model, indexes in missing_indexes.items():
+            for index in indexes:
+                if index.existing:
+                    continue
+
+                log.warning(
+                    'Foreign key %s.%s of relation %s.%s has no index, so lookups through it scan the table',
+                    model.__table__,
+                    index.fields()[0].column,
+                    index.relation.model.__name__,
+                    index.relation.column
+                )
+
+        # existing indexes are still passed along, so they aren't dropped
+        missing_indexes = {
+            model: [e for e in indexes if e.existing]
+            for model, indexes in missing_indexes.items()
+        }
+
+    result.extend(_migrate_indexes(database, models, execute, catalog, online, missing_indexes))
+    timings['indexes'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _handle(database, result, execute, debug, lock_timeout if online else None, retries if online else 0)
+    if fingerprint and execute:
+        _store_fingerprints(database, fingerprints)
+    timings['execute'] = time.perf_counter() - start
+
+    log.debug(
+        'Migrated %s models with %s statements (%s)',
+        len(models),
+        len(result),
+        ', '.join('%s %.2fms' % (phase, seconds * 1000) for phase, seconds in timings.items())
+    )
+
     return result
@@ -0,0 +1,96 @@
+import os
+import stellata.advisor
+import stellata.fields
+import stellata.index
+import stellata.instrument
+import stellata.model
+import stellata.query
+import stellata.relations
+import tempfile
+import unittest
+
+class A(stellata.model.Model):
+    __table__ = 'advisor_a'
+
+    id = stellata.fields.UUID()
+    foo = stellata.fields.Text()
+    bar = stellata.fields.Integer()
+    dt = stellata.fields.Timestamp()
+
+    b = stellata.relations.HasMany(lambda: B.a_id)
+
+    foo_index = stellata.index.Index(lambda: A.foo)
+    primary_key = stellata.index.PrimaryKey(lambda: A.id)
+
+class B(stellata.model.Model):
+    __table__ = 'advisor_b'
+
+    id = stellata.fields.UUID()
+    a_id = stellata.fields.UUID()
+
+def event(query, duration=0.01, strategy=None):
+    sql, args = query._select_query({join.relation.child().model.__table__: join.alias for join in query.joins})
+    return stellata.instrument.QueryEvent(sql, args, duration, 1, None, query=query, strategy=strategy)
+
+class TestAdvisor(unittest.TestCase):
+    def test_candidates(self):
+        self.assertEqual(stellata.advisor._candidates(A.where((A.bar == 1) & (A.dt > 0)).order(A.foo)), [
+            ('advisor_a', ('bar', 'dt')),
+        ])
+
+        self.assertEqual(stellata.advisor._candidates(A.where(A.bar == 1).order(A.dt)), [
+            ('advisor_a', ('bar', 'dt')),
+        ])
+
+        self.assertEqual(sorted(stellata.advisor._candidates(A.where((A.bar == 1) | (A.foo == 'foo')))), [
+            ('advisor_a', ('bar',)),
+            ('advisor_a', ('foo',)),
+        ])
+
+        self.assertEqual(stellata.advisor._candidates(A.where(A.bar.any([1, 2]) & (A.foo != 'foo') & (A.dt >= 0))), [
+            ('advisor_a', ('bar', 'dt')),
+        ])
+
+        self.assertEqual(sorted(stellata.advisor._candidates(
+            A.where((A.id << B.select(B.a_id).where(B.id == 1)) & stellata.query.exists(A.b, where=B.id == 2))
+        )), [
+            ('advisor_a', ('id',)),
+            ('advisor_b', ('id',)),
+            ('advisor_b', ('id', 'a_id')),
+        ])
+
+        self.assertEqual(stellata.advisor._candidates(A.join(A.b), 'join'), [('advisor_b', ('a_id',))])
+
+    def test_report(self):
+        workload = stellata.advisor.Workload()
+        workload.observe(event(A.where(A.bar == 1), duration=0.5))
+        workload.observe(event(A.where(A.bar == 2), duration=0.5))
+        workload.observe(event(A.where(A.foo == 'foo')))
+        workload.observe(event(B.where(B.a_id << [1, 2]), duration=2.0))
+
+        report = workload.report(models=[A, B])
+        self.assertEqual([(e.model, e.columns, e.count) for e in report.missing], [
+            (B, ('a_id',), 1),
+            (A, ('bar',), 2),
+        ])
+        self.assertEqual(report.missing[0].definition(), 'stellata.index.Index(lambda: B.a_id)')
+        self.assertIsNone(report.unused)
+        self.assertIn('advisor_a (bar): 2 queries, 1.00s total', str(report))
+
+    def test_save(self):
+        workload = stellata.advisor.Workload()
+        workload.observe(event(A.where(A.bar == 1)))
+
+        path = os.path.join(tempfile.mkdtemp(), 'workload.json')
+        workload.save(path)
+
+        loaded = stellata.advisor.Workload.load(path)
+        loaded.merge(stellata.advisor.Workload.load(path))
+        self.assertEqual(loaded.shapes[event(A.where(A.bar == 1)).shape]['count'], 2)
+        self.assertEqual(loaded.report(models=[A]).missing[0].columns, ('bar',))
+
+    def test_subscribe(self):
+        with stellata.advisor.Workload() as workload:
+            self.assertTrue(stellata.instrument.active())
+
+        self.assertNotIn(workload.observe, stellata.instrument._subscribers)
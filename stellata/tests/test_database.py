@@ -2,6 +2,9 @@ import stellata.database
 import stellata.fields
 import stellata.tests.base
 
+import unittest
+import unittest.mock
+
 db = stellata.tests.base.db
 db2 = stellata.tests.base.db2
 
@@ -43,3 +46,100 @@ class TestPool(stellata.tests.base.Base):
         self.assertEqual(len(A.where(A.foo == 'bar').on(db).get()), 1)
         self.assertEqual(len(A.on(db2).where(A.foo == 'bar').get()), 0)
 
+
+class TestRoutedPool(unittest.TestCase):
+    def setUp(self):
+        self.primary = unittest.mock.MagicMock()
+        self.replicas = [unittest.mock.MagicMock(in_use=0), unittest.mock.MagicMock(in_use=0)]
+        for replica in self.replicas:
+            replica.query.return_value = []
+
+    def test_delegate(self):
+        routed = stellata.database.RoutedPool(self.primary, self.replicas[:1])
+        routed.copy_to('select 1', None, None)
+        routed.stream('select 1')
+        self.replicas[0].copy_to.assert_called_once()
+        self.replicas[0].stream.assert_called_once()
+        self.assertIs(routed.stats(), self.primary.stats.return_value)
+        self.assertIs(routed.in_use, self.primary.in_use)
+
+    def test_lag(self):
+        self.replicas[0].query.return_value = [(60,)]
+        routed = stellata.database.RoutedPool(self.primary, self.replicas, max_lag=5)
+        self.assertIs(routed.reader(), self.replicas[1])
+        self.assertIs(routed.reader(), self.replicas[1])
+
+        self.replicas[1].query.return_value = [(60,)]
+        routed = stellata.database.RoutedPool(self.primary, self.replicas, max_lag=5)
+        self.assertIs(routed.reader(), self.primary)
+
+    def test_least_busy(self):
+        self.replicas[0].in_use = 3
+        routed = stellata.database.RoutedPool(self.primary, self.replicas, strategy='least_busy')
+        self.assertIs(routed.reader(), self.replicas[1])
+
+    def test_pin_after_write(self):
+        routed = stellata.database.RoutedPool(self.primary, self.replicas, pin_seconds=60)
+        self.assertIn(routed.reader(), self.replicas)
+        A.on(routed).create(A(foo='bar'))
+        self.primary.query.assert_called()
+        self.assertIs(routed.reader(), self.primary)
+
+    def test_query_does_not_pin(self):
+        routed = stellata.database.RoutedPool(self.primary, self.replicas, pin_seconds=60)
+        routed.query('select 1')
+        self.primary.query.assert_called_once_with('select 1', None)
+        self.assertIn(routed.reader(), self.replicas)
+
+    def test_round_robin(self):
+        routed = stellata.database.RoutedPool(self.primary, self.replicas)
+        A.on(routed).where(A.foo == 'bar').get()
+        A.on(routed).where(A.foo == 'bar').get()
+        self.primary.query.assert_not_called()
+        self.assertEqual(self.replicas[0].query.call_count, 2)
+        self.assertEqual(self.replicas[1].query.call_count, 2)
+
+class TestSlowQuery(stellata.tests.base.Base):
+    up = '''
+    create table if not exists a (
+        id uuid not null default uuid_generate_v1mc(),
+        foo text not null
+    );
+    '''
+
+    down = '''
+    drop table if exists a;
+    '''
+
+    def test_capture(self):
+        slow = stellata.database.Pool(
+            name='stellata_test',
+            user='stellata_test',
+            password='stellata_test',
+            slow_query_threshold=0,
+            slow_query_log_size=2
+        )
+
+        slow.slow_queries.clear()
+        A.on(slow).where(A.foo == 'bar').get()
+        entries = slow.slow_queries.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0].args, ['<str>'])
+        self.assertEqual(entries[0].plan[0]['Plan']['Relation Name'], 'a')
+        self.assertIn('test_database.py', entries[0].location)
+
+        # buffer only keeps the most recent entries
+        A.on(slow).where(A.foo == 'baz').get()
+        A.on(slow).where(A.foo == 'qux').get()
+        self.assertEqual(len(slow.slow_queries), 2)
+
+    def test_threshold(self):
+        slow = stellata.database.Pool(
+            name='stellata_test',
+            user='stellata_test',
+            password='stellata_test',
+            slow_query_threshold=60
+        )
+
+        A.on(slow).where(A.foo == 'bar').get()
+        self.assertEqual(len(slow.slow_queries), 0)
@@ -0,0 +1,73 @@
+import stellata
+import stellata.detect
+import stellata.fields
+import stellata.model
+import stellata.relations
+import stellata.tests.base
+
+import warnings
+
+db = stellata.tests.base.db
+
+class A(stellata.model.Model):
+    __table__ = 'a'
+
+    id = stellata.fields.UUID()
+    foo = stellata.fields.Text()
+
+    b = stellata.relations.HasMany(lambda: B.a_id)
+
+class B(stellata.model.Model):
+    __table__ = 'b'
+
+    id = stellata.fields.UUID()
+    a_id = stellata.fields.UUID()
+
+class TestDetect(stellata.tests.base.Base):
+    up = '''
+    create table if not exists a (
+        id uuid not null default uuid_generate_v1mc(),
+        foo text not null
+    );
+
+    create table if not exists b (
+        id uuid not null default uuid_generate_v1mc(),
+        a_id uuid not null
+    );
+    '''
+
+    down = '''
+    drop table if exists a;
+    drop table if exists b;
+    '''
+
+    def setUp(self):
+        super().setUp()
+        A.create([A(foo='foo'), A(foo='bar'), A(foo='baz'), A(foo='qux')])
+
+    def test_fail(self):
+        with self.assertRaises(stellata.detect.NPlusOneError) as context:
+            with stellata.detect_n_plus_one(threshold=3, fail=True):
+                for a in A.get():
+                    B.where(B.a_id == a.id).get()
+
+        self.assertIn('4 x select', str(context.exception))
+        self.assertIn('test_detect.py', str(context.exception))
+        self.assertIn('A.join(A.b)', str(context.exception))
+
+    def test_join(self):
+        with stellata.detect_n_plus_one(threshold=1, fail=True) as scope:
+            A.join(A.b).get()
+
+        self.assertEqual(scope.violations, [])
+
+    def test_warn(self):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            with stellata.detect_n_plus_one(threshold=3) as scope:
+                for a in A.get():
+                    B.where(B.a_id == a.id).get()
+
+        self.assertEqual(len(scope.violations), 1)
+        self.assertEqual(scope.violations[0].count, 4)
+        self.assertEqual(caught[0].category, stellata.detect.NPlusOneWarning)
@@ -0,0 +1,67 @@
+import stellata.database
+import stellata.fields
+import stellata.instrument
+import stellata.model
+import stellata.tests.base
+
+db = stellata.tests.base.db
+
+class A(stellata.model.Model):
+    __table__ = 'a'
+
+    id = stellata.fields.UUID()
+    foo = stellata.fields.Text()
+
+class TestInstrument(stellata.tests.base.Base):
+    up = '''
+    create table if not exists a (
+        id uuid not null default uuid_generate_v1mc(),
+        foo text not null
+    );
+    '''
+
+    down = '''
+    drop table if exists a;
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.events = []
+        stellata.instrument.on_query(self.events.append)
+
+    def tearDown(self):
+        stellata.instrument.off_query(self.events.append)
+        super().tearDown()
+
+    def test_event(self):
+        A.create([A(foo='bar'), A(foo='baz')])
+        A.where(A.foo << ['bar', 'baz']).get()
+
+        self.assertEqual(len(self.events), 2)
+        self.assertEqual(self.events[0].model, A)
+        self.assertEqual(self.events[0].arg_count, 2)
+        self.assertEqual(self.events[0].rowcount, 2)
+        self.assertIs(self.events[0].pool, db)
+        self.assertEqual(
+            self.events[1].shape,
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where "a"."foo" in (...)'
+        )
+        self.assertGreater(self.events[1].duration, 0)
+
+    def test_unsubscribed(self):
+        stellata.instrument.off_query(self.events.append)
+        A.where(A.foo == 'bar').get()
+        self.assertEqual(self.events, [])
+
+class TestShape(stellata.tests.base.Base):
+    def test_in(self):
+        self.assertEqual(
+            stellata.instrument.shape('select * from "a" where "a"."id" in (%s,%s,%s)'),
+            'select * from "a" where "a"."id" in (...)'
+        )
+
+    def test_values(self):
+        self.assertEqual(
+            stellata.instrument.shape('insert into "a" (foo,id) values (%s,%s),(%s,%s) returning "a"."id"'),
+            'insert into "a" (foo,id) values (...) returning "a"."id"'
+        )
@@ -1,8 +1,14 @@
 import stellata.database
 import stellata.model
 import stellata.fields
+import stellata.relations
 import stellata.tests.base
 
+import datetime
+import decimal
+import json
+import uuid
+
 db = stellata.tests.base.db
 
 class A(stellata.model.Model):
@@ -11,7 +17,59 @@ class A(stellata.model.Model):
     id = stellata.fields.UUID()
     foo = stellata.fields.Text()
 
+class B(stellata.model.Model):
+    __table__ = 'b'
+
+    id = stellata.fields.UUID()
+    a_id = stellata.fields.UUID()
+    day = stellata.fields.Date()
+    dt = stellata.fields.Timestamp()
+    price = stellata.fields.Numeric()
+
+    a = stellata.relations.BelongsTo(lambda: B.a_id, lambda: A)
+
 class TestSerialize(stellata.tests.base.Base):
+    def test_fast(self):
+        b = B(id=uuid.UUID(int=1), price=decimal.Decimal('1.5'), a=A(id=1, foo='bar'))
+        self.assertEqual(
+            json.loads(stellata.model.serialize([b], fast=True)),
+            json.loads(stellata.model.serialize([b]))
+        )
+
+    def test_field_types(self):
+        b = B(
+            id=uuid.UUID(int=1),
+            day=datetime.date(2017, 1, 2),
+            dt=datetime.datetime.fromtimestamp(1483228800),
+            price=decimal.Decimal('1.5'),
+            a=A(id=1, foo='bar'),
+        )
+
+        self.assertEqual(
+            stellata.model.serialize(b),
+            '{"id": "00000000-0000-0000-0000-000000000001", "day": "2017-01-02", "dt": 1483228800, '
+            '"price": 1.5, "a": {"id": 1, "foo": "bar"}}'
+        )
+
+    def test_ignores_other_attributes(self):
+        a = A(id=1, foo='bar')
+        a.cache = object()
+        self.assertEqual(stellata.model.serialize(a), '''{"id": 1, "foo": "bar"}''')
+
+    def test_normalize(self):
+        a = A(id=1, foo='bar')
+        b = [B(id=2, a_id=1, a=a), B(id=3, a_id=1, a=A(id=1, foo='bar'))]
+        self.assertEqual(json.loads(stellata.model.serialize(b, normalize=True)), {
+            'entities': {
+                'a': {'1': {'id': 1, 'foo': 'bar'}},
+                'b': {
+                    '2': {'id': 2, 'a_id': 1, 'a': {'$table': 'a', '$id': 1}},
+                    '3': {'id': 3, 'a_id': 1, 'a': {'$table': 'a', '$id': 1}},
+                },
+            },
+            'result': [{'$table': 'b', '$id': 2}, {'$table': 'b', '$id': 3}],
+        })
+
     def test_json_multi(self):
         one = A(id=1, foo='bar')
         two = A(id=2, foo='baz')
@@ -38,3 +96,16 @@ class TestSerialize(stellata.tests.base.Base):
             stellata.model.serialize({'a': [one, two]}, format='msgpack'),
             b'\x81\xa1a\x92\x82\xa2id\x01\xa3foo\xa3bar\x82\xa2id\x02\xa3foo\xa3baz'
         )
+
+class TestFinalize(stellata.tests.base.Base):
+    def test(self):
+        relation = stellata.relations.BelongsTo(lambda: calls.append(1) or B.a_id, lambda: A)
+        calls = []
+        self.assertIs(relation.parent(), B.a_id)
+        self.assertIs(relation.foreign_key(), B.a_id)
+        self.assertIs(relation.child(), A.id)
+        self.assertEqual(calls, [1])
+
+    def test_finalize(self):
+        stellata.model.finalize()
+        self.assertEqual(B.a.resolve(), (B.a_id, A.id))
@@ -0,0 +1,105 @@
+import datetime
+import stellata.fields
+import stellata.index
+import stellata.model
+import stellata.partition
+import stellata.schema
+import stellata.tests.base
+import unittest
+import unittest.mock
+
+db = stellata.tests.base.db
+
+class Event(stellata.model.Model):
+    __table__ = 'event'
+    __partition__ = stellata.partition.Range(lambda: Event.dt, interval='1 month', premake=1, retention='2 months')
+
+    id = stellata.fields.UUID(null=False)
+    dt = stellata.fields.Timestamp(null=False)
+
+    primary_key = stellata.index.PrimaryKey(lambda: (Event.id, Event.dt))
+
+def today(day):
+    return unittest.mock.patch('stellata.partition._today', return_value=day)
+
+class TestHash(unittest.TestCase):
+    def test(self):
+        partition = stellata.partition.Hash(lambda: Event.id, 2)
+        self.assertEqual(partition.key(), 'hash ("id")')
+        self.assertEqual(partition.partitions(datetime.date(2024, 5, 17)), {
+            'p0': 'for values with (modulus 2, remainder 0)',
+            'p1': 'for values with (modulus 2, remainder 1)',
+        })
+
+class TestList(unittest.TestCase):
+    def test(self):
+        self.assertEqual(stellata.partition.List(lambda: Event.id, ['us', 'eu-west']).partitions(None), {
+            'pus': "for values in ('us')",
+            'peu_west': "for values in ('eu-west')",
+        })
+
+    def test_dict(self):
+        partition = stellata.partition.List(lambda: Event.id, {'americas': ['us', 'ca'], 'other': ["o'ther"]})
+        self.assertEqual(partition.partitions(None), {
+            'pamericas': "for values in ('us', 'ca')",
+            'pother': "for values in ('o''ther')",
+        })
+
+class TestRange(unittest.TestCase):
+    def test_expired(self):
+        partition = stellata.partition.Range(lambda: Event.dt, retention='3 months')
+        self.assertEqual(
+            partition.expired(['p20240101', 'p20240201', 'p20240501', 'other'], datetime.date(2024, 5, 17)),
+            ['p20240101']
+        )
+
+    def test_interval(self):
+        with self.assertRaises(ValueError):
+            stellata.partition.Range(lambda: Event.dt, interval='1 fortnight')
+
+    def test_month(self):
+        partition = stellata.partition.Range(lambda: Event.dt, interval='1 month', premake=2)
+        self.assertEqual(partition.key(), 'range ("dt")')
+        self.assertEqual(partition.partitions(datetime.date(2024, 11, 17)), {
+            'p20241101': "for values from ('2024-11-01') to ('2024-12-01')",
+            'p20241201': "for values from ('2024-12-01') to ('2025-01-01')",
+            'p20250101': "for values from ('2025-01-01') to ('2025-02-01')",
+        })
+
+    def test_week(self):
+        partition = stellata.partition.Range(lambda: Event.dt, interval='1 week', premake=1)
+        self.assertEqual(partition.partitions(datetime.date(2024, 5, 17)), {
+            'p20240513': "for values from ('2024-05-13') to ('2024-05-20')",
+            'p20240520': "for values from ('2024-05-20') to ('2024-05-27')",
+        })
+
+class TestMigrate(stellata.tests.base.Base):
+    down = 'drop table if exists event cascade; drop table if exists event_p20240301;'
+
+    def test(self):
+        with today(datetime.date(2024, 3, 10)):
+            self.assertEqual(stellata.schema.migrate(db, models=[Event]), [
+                'create table "event" ("dt" timestamp without time zone) partition by range ("dt") ;',
+                'alter table "event" alter column "dt" set not null ;',
+                'alter table "event" alter column "dt" set default now() ;',
+                'alter table "event" add column "id" uuid ;',
+                'alter table "event" alter column "id" set not null ;',
+                'alter table "event" alter column "id" set default uuid_generate_v1mc() ;',
+                'create table "event_p20240301" partition of "event" for values from (\'2024-03-01\') to '
+                    '(\'2024-04-01\') ;',
+                'create table "event_p20240401" partition of "event" for values from (\'2024-04-01\') to '
+                    '(\'2024-05-01\') ;',
+                'alter table event add primary key (id,dt) ;',
+            ])
+
+            stellata.schema.migrate(db, models=[Event], execute=True)
+            self.assertEqual(stellata.schema.migrate(db, models=[Event]), [])
+
+        with today(datetime.date(2024, 6, 10)):
+            self.assertEqual(stellata.schema.maintain_partitions(db, models=[Event]), [
+                'create table "event_p20240601" partition of "event" for values from (\'2024-06-01\') to '
+                    '(\'2024-07-01\') ;',
+                'create table "event_p20240701" partition of "event" for values from (\'2024-07-01\') to '
+                    '(\'2024-08-01\') ;',
+                'alter table "event" detach partition "event_p20240301" ;',
+            ])
@@ -0,0 +1,78 @@
+import psycopg2.extensions
+import stellata.pool
+
+import threading
+import time
+import unittest
+import unittest.mock
+
+def connect():
+    connection = unittest.mock.MagicMock(closed=False)
+    connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return connection
+
+class TestConnectionPool(unittest.TestCase):
+    def test_gauges(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=2, min_idle=1)
+        connection = pool.getconn()
+        self.assertEqual(pool.in_use, 1)
+        self.assertEqual(pool.idle, 0)
+
+        pool.putconn(connection)
+        stats = pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['waiters'], 0)
+        self.assertEqual(stats['checkouts'], 1)
+
+    def test_health_check(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=1, min_idle=1, health_check_interval=0)
+        connection = pool.getconn()
+        connection.closed = True
+        pool.putconn(connection)
+
+        replacement = pool.getconn()
+        self.assertIsNot(replacement, connection)
+        replacement.cursor().execute.assert_called_with('select 1')
+
+    def test_max_lifetime(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=1, min_idle=0, max_lifetime=0)
+        connection = pool.getconn()
+        pool.putconn(connection)
+        connection.close.assert_called()
+        self.assertEqual(pool.size, 0)
+
+    def test_queue(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=1, min_idle=1)
+        connection = pool.getconn()
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(pool.getconn(timeout=5)))
+        waiter.start()
+
+        while pool.waiters == 0:
+            time.sleep(0.01)
+
+        pool.putconn(connection)
+        waiter.join()
+        self.assertIs(result[0], connection)
+
+    def test_rollback(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=1, min_idle=1)
+        connection = pool.getconn()
+        connection.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        pool.putconn(connection)
+        connection.rollback.assert_called()
+
+    def test_timeout(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=1, min_idle=1)
+        pool.getconn()
+        with self.assertRaises(stellata.pool.PoolTimeout):
+            pool.getconn(timeout=0.01)
+
+        self.assertEqual(pool.waiters, 0)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_warmup(self):
+        pool = stellata.pool.ConnectionPool(connect, max_size=5, min_idle=3)
+        self.assertEqual(pool.idle, 3)
+        self.assertEqual(pool.size, 3)
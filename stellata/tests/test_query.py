@@ -1,10 +1,15 @@
 import stellata.database
 import stellata.fields
+import stellata.functions
 import stellata.index
 import stellata.model
+import stellata.query
 import stellata.relations
 import stellata.tests.base
 
+import io
+import msgpack
+
 db = stellata.tests.base.db
 
 class A(stellata.model.Model):
@@ -55,6 +60,23 @@ class E(stellata.model.Model):
     d1 = stellata.relations.BelongsTo(lambda: E.d1_id, lambda: D)
     d2 = stellata.relations.BelongsTo(lambda: E.d2_id, lambda: D)
 
+class F(stellata.model.Model):
+    __table__ = 'f'
+
+    id = stellata.fields.UUID()
+    email = stellata.fields.Text()
+    email_lower = stellata.fields.Text(generated=lambda: stellata.functions.Lower(F.email))
+
+class G(stellata.model.Model):
+    __table__ = 'g'
+
+    id = stellata.fields.UUID()
+    email = stellata.fields.Text()
+    deleted = stellata.fields.Boolean()
+
+    email__index = stellata.index.Index(lambda: G.email, unique=True, where=lambda: G.deleted == False)
+    email_lower__index = stellata.index.Index(lambda: stellata.functions.Lower(G.email), unique=True)
+
 class TestCreateQuery(stellata.tests.base.Base):
     @stellata.tests.base.mock_query()
     def test_conflict_fields(self, query):
@@ -74,6 +96,29 @@ class TestCreateQuery(stellata.tests.base.Base):
             ['foo', 1]
         )
 
+    @stellata.tests.base.mock_execute()
+    def test_conflict_partial_index(self, execute):
+        G.create(G(email='foo'), unique=G.email__index, returning=None)
+        execute.assert_called_with(
+            'insert into "g" (email) values (%s) on conflict (email) where "deleted" = false do update set '
+            'email = excluded.email',
+            ['foo']
+        )
+
+        G.create(G(email='foo'), unique=G.email__index, returning=None, ignore=True)
+        execute.assert_called_with(
+            'insert into "g" (email) values (%s) on conflict (email) where "deleted" = false do nothing',
+            ['foo']
+        )
+
+    @stellata.tests.base.mock_execute()
+    def test_conflict_expression_index(self, execute):
+        G.create(G(email='Foo'), unique=G.email_lower__index, returning=None)
+        execute.assert_called_with(
+            'insert into "g" (email) values (%s) on conflict (lower("email")) do update set email = excluded.email',
+            ['Foo']
+        )
+
     @stellata.tests.base.mock_query()
     def test_multi(self, query):
         A.create([A(id=1, foo='foo'), A(id=2, foo='bar')])
@@ -90,12 +135,64 @@ class TestCreateQuery(stellata.tests.base.Base):
             ['foo', 5]
         )
 
+    @stellata.tests.base.mock_query()
+    def test_returning(self, query):
+        query.return_value = [{'a.id': 5}]
+        result = A.create(A(id=5, foo='foo'), returning=A.id)
+        query.assert_called_with('insert into "a" (foo,id) values (%s,%s) returning "a"."id" as "a.id"', ['foo', 5])
+        self.assertEqual(result.to_dict(), {'id': 5})
+
+    @stellata.tests.base.mock_execute()
+    def test_returning_none(self, execute):
+        A.create([A(id=5, foo='foo')], returning=None)
+        execute.assert_called_with('insert into "a" (foo,id) values (%s,%s)', ['foo', 5])
+
+    @stellata.tests.base.mock_execute()
+    def test_ignore(self, execute):
+        A.create(A(id=5, foo='foo'), returning=None, ignore=True)
+        execute.assert_called_with('insert into "a" (foo,id) values (%s,%s) on conflict do nothing', ['foo', 5])
+
+        A.create(A(id=5, foo='foo'), unique=A.id__foo__index, returning=None, ignore=True)
+        execute.assert_called_with(
+            'insert into "a" (foo,id) values (%s,%s) on conflict (id,foo) do nothing',
+            ['foo', 5]
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_ignore_conflict(self, query):
+        query.return_value = []
+        self.assertIsNone(A.create(A(id=5, foo='foo'), ignore=True))
+        query.assert_called_with(
+            'insert into "a" (foo,id) values (%s,%s) on conflict do nothing returning "a"."id" as "a.id",'
+            '"a"."foo" as "a.foo"',
+            ['foo', 5]
+        )
+
+        self.assertEqual(A.create([A(id=5, foo='foo')], ignore=True), [])
+
+    @stellata.tests.base.mock_query()
+    def test_generated(self, query):
+        F.create(F(id=5, email='Foo', email_lower='foo'))
+        query.assert_called_with(
+            'insert into "f" (email,id) values (%s,%s) returning "f"."id" as "f.id","f"."email" as "f.email",'
+            '"f"."email_lower" as "f.email_lower"',
+            ['Foo', 5]
+        )
+
 class TestDeleteQuery(stellata.tests.base.Base):
     @stellata.tests.base.mock_execute()
     def test_where(self, execute):
         A.where(A.id == 1).delete()
         execute.assert_called_with('delete from "a" where "a"."id" = %s', [1])
 
+    @stellata.tests.base.mock_query()
+    def test_returning(self, query):
+        A.where(A.id == 1).delete(returning='all')
+        query.assert_called_with(
+            'delete from "a" where "a"."id" = %s returning "a"."id" as "a.id","a"."foo" as "a.foo"',
+            [1]
+        )
+
 class TestGetQuery(stellata.tests.base.Base):
     @stellata.tests.base.mock_query()
     def test_where(self, query):
@@ -130,6 +227,42 @@ class TestGetQuery(stellata.tests.base.Base):
             [1, 2, 3]
         )
 
+    @stellata.tests.base.mock_query()
+    def test_flatten(self, query):
+        A.where((A.id == 1) | (A.id == 2) | ((A.id == 3) | (A.id == 4))).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."id" = %s or "a"."id" = %s or "a"."id" = %s or "a"."id" = %s) ',
+            [1, 2, 3, 4]
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_long_chain(self, query):
+        expression = A.id == 0
+        for i in range(1, 5000):
+            expression = expression | (A.id == i)
+
+        A.where(expression).get()
+        sql, values = query.call_args[0]
+        self.assertEqual(sql.count(' or '), 4999)
+        self.assertEqual(values, list(range(5000)))
+
+    @stellata.tests.base.mock_query()
+    def test_duplicates(self, query):
+        A.where((A.id == 1) & (A.foo == 'bar') & (A.id == 1)).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  ("a"."id" = %s and "a"."foo" = %s) ',
+            [1, 'bar']
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_none_operand(self, query):
+        A.where((A.id == 1) | None).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  ("a"."id" = %s) ',
+            [1]
+        )
+
     @stellata.tests.base.mock_query()
     def test_in(self, query):
         A.where(A.id << [1, 2, 3]).get()
@@ -138,6 +271,104 @@ class TestGetQuery(stellata.tests.base.Base):
             [1, 2, 3]
         )
 
+    @stellata.tests.base.mock_query()
+    def test_in_query(self, query):
+        A.where((A.id << B.select(B.a_id).where(B.id == 1)) | (A.id >> B.where(B.id == 2))).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."id" in (select "b"."a_id" from "b" where "b"."id" = %s) or '
+            '"a"."id" in (select "b"."id" from "b" where "b"."id" = %s)) ',
+            [1, 2]
+        )
+
+        with self.assertRaises(ValueError):
+            A.where(A.id << B.join(B.a_belongs_to)).get()
+
+    @stellata.tests.base.mock_query()
+    def test_exists(self, query):
+        A.where(stellata.query.exists(A.b_has_many, where=B.id == 1) & (A.foo == 'foo')).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '(exists (select 1 from "b" as "b" where "b"."a_id" = "a"."id" and "b"."id" = %s) and "a"."foo" = %s) ',
+            [1, 'foo']
+        )
+
+        B.where(~stellata.query.exists(B.a_belongs_to)).get()
+        query.assert_called_with(
+            'select "b"."id" as "b.id","b"."a_id" as "b.a_id" from "b" where '
+            'not exists (select 1 from "a" as "a" where "a"."id" = "b"."a_id")',
+            []
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_function(self, query):
+        A.where(stellata.functions.Lower(A.foo) == 'foo') \
+            .order(stellata.functions.DateTrunc('day', stellata.functions.Upper(A.foo))) \
+            .get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where lower("a"."foo") = %s '
+            'order by date_trunc(\'day\', upper("a"."foo")) asc',
+            ['foo']
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_comparisons(self, query):
+        A.where((A.foo != 'a') & (A.foo <= 'b') & (A.foo >= 'c') & (A.foo != None)).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."foo" != %s and "a"."foo" <= %s and "a"."foo" >= %s and "a"."foo" is not null) ',
+            ['a', 'b', 'c']
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_between(self, query):
+        A.where(A.foo.between('a', 'b')).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where ("a"."foo" >= %s and "a"."foo" <= %s)',
+            ['a', 'b']
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_like(self, query):
+        A.where(A.foo.like('a%') | stellata.functions.Lower(A.foo).ilike('b%')).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."foo" like %s or lower("a"."foo") ilike %s) ',
+            ['a%', 'b%']
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_is_null(self, query):
+        A.where(A.foo.is_null() | A.id.is_null(False)).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."foo" is null or "a"."id" is not null) ',
+            []
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_not_in(self, query):
+        A.where(A.id.not_in([1, 2])).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where "a"."id" not in (%s,%s)',
+            [1, 2]
+        )
+
+        self.assertIsNone(A.id.not_in([]))
+
+    @stellata.tests.base.mock_query()
+    def test_any(self, query):
+        A.where(A.id.any(('1', '2')) & stellata.functions.Lower(A.foo).any(['a'])).get()
+        query.assert_called_with(
+            'select "a"."id" as "a.id","a"."foo" as "a.foo" from "a" where  '
+            '("a"."id" = any(%s::uuid[]) and lower("a"."foo") = any(%s)) ',
+            [['1', '2'], ['a']]
+        )
+
+    def test_date_trunc_unit(self):
+        with self.assertRaises(ValueError):
+            stellata.functions.DateTrunc("day'); drop table a; --", A.foo)
+
 class TestJoinQuery(stellata.tests.base.Base):
     @stellata.tests.base.mock_query()
     def test_single(self, query):
@@ -178,6 +409,80 @@ class TestUpdateQuery(stellata.tests.base.Base):
             [2, 'foo', 1]
         )
 
+    @stellata.tests.base.mock_query()
+    def test_returning(self, query):
+        A.where(A.id == 1).update(A(foo='foo'), returning=[A.foo])
+        query.assert_called_with(
+            'update "a" set foo = %s where "a"."id" = %s returning "a"."foo" as "a.foo"',
+            ['foo', 1]
+        )
+
+    @stellata.tests.base.mock_execute()
+    def test_returning_none(self, execute):
+        A.where(A.id == 1).update(A(foo='foo'), returning=None)
+        execute.assert_called_with('update "a" set foo = %s where "a"."id" = %s', ['foo', 1])
+
+    @stellata.tests.base.mock_query()
+    def test_generated(self, query):
+        F.where(F.id == 1).update(F(email='Foo', email_lower='foo'))
+        query.assert_called_with(
+            'update "f" set email = %s where "f"."id" = %s returning "f"."id" as "f.id","f"."email" as "f.email",'
+            '"f"."email_lower" as "f.email_lower"',
+            ['Foo', 1]
+        )
+
+    @stellata.tests.base.mock_query()
+    def test_save_changed(self, query):
+        query.return_value = [{'a.id': 1, 'a.foo': 'bar'}]
+        a = stellata.query.Query(A)._row_to_object(A, {'a.id': 1, 'a.foo': 'foo'})
+        a.foo = 'bar'
+        a.save()
+        query.assert_called_with(
+            'update "a" set foo = %s where "a"."id" = %s returning "a"."id" as "a.id","a"."foo" as "a.foo"',
+            ['bar', 1]
+        )
+
+        self.assertEqual(a.to_dict(), {'id': 1, 'foo': 'bar'})
+
+    @stellata.tests.base.mock_query()
+    def test_save_unchanged(self, query):
+        a = stellata.query.Query(A)._row_to_object(A, {'a.id': 1, 'a.foo': 'foo'})
+        a.b_has_many = []
+        self.assertIs(a.save(), a)
+        query.assert_not_called()
+
+    @stellata.tests.base.mock_query()
+    def test_save_partial(self, query):
+        query.return_value = [{'a.id': 5}]
+        a = A.create(A(foo='x'), returning=A.id)
+        a.foo = 'y'
+        query.return_value = [{'a.id': 5, 'a.foo': 'y'}]
+        a.save()
+        query.assert_called_with(
+            'update "a" set foo = %s where "a"."id" = %s returning "a"."id" as "a.id","a"."foo" as "a.foo"',
+            ['y', 5]
+        )
+
+        query.return_value = [{'a.foo': 'y'}]
+        a = A.where(A.id == 5).update(A(foo='y'), returning=[A.foo])[0]
+        with self.assertRaises(ValueError):
+            a.save()
+
+    @stellata.tests.base.mock_query()
+    def test_save_generated(self, query):
+        f = stellata.query.Query(F)._row_to_object(F, {'f.id': 1, 'f.email': 'Foo', 'f.email_lower': 'foo'})
+        f.email_lower = 'bar'
+        self.assertIs(f.save(), f)
+        query.assert_not_called()
+
+    @stellata.tests.base.mock_query()
+    def test_save_deleted(self, query):
+        query.return_value = []
+        a = stellata.query.Query(A)._row_to_object(A, {'a.id': 1, 'a.foo': 'foo'})
+        a.foo = 'bar'
+        with self.assertRaises(stellata.model.NotFoundError):
+            a.save()
+
 class DatabaseTest(stellata.tests.base.Base):
     up = '''
     create table if not exists a (
@@ -308,6 +613,13 @@ class TestCreate(DatabaseTest):
         result = db.query('''select * from a''')
         self.assertEqual(len(result), 1)
 
+        a = A.where(A.foo == 'foo').get_one()
+        a.foo = 'bar'
+        a.save()
+
+        result = db.query('''select * from a''')
+        self.assertEqual([e['foo'] for e in result], ['bar'])
+
 class TestDelete(DatabaseTest):
     def test_where(self):
         A.where(A.foo == 'bar').delete()
@@ -352,6 +664,35 @@ class TestGet(DatabaseTest):
         result = A.where(A.foo == 'no').get()
         self.assertEqual(len(result), 0)
 
+class TestExport(DatabaseTest):
+    def test_csv(self):
+        output = io.StringIO()
+        count = A.order(A.foo).export(output, format='csv')
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            output.getvalue(),
+            'id,foo\n31be0c81-f5ee-49b9-a624-356402427f76,bar\n2a12f545-c587-4b99-8fd2-57e79f7c8bca,baz\n'
+        )
+
+    def test_msgpack(self):
+        output = io.BytesIO()
+        count = A.where(A.foo == 'bar').export(output, format='msgpack')
+        self.assertEqual(count, 1)
+        self.assertEqual(
+            list(msgpack.Unpacker(io.BytesIO(output.getvalue()), raw=False)),
+            [{'id': '31be0c81-f5ee-49b9-a624-356402427f76', 'foo': 'bar'}]
+        )
+
+    def test_ndjson(self):
+        output = io.StringIO()
+        count = A.order(A.foo).export(output, batch_size=1)
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            output.getvalue(),
+            '{"id": "31be0c81-f5ee-49b9-a624-356402427f76", "foo": "bar"}\n'
+            '{"id": "2a12f545-c587-4b99-8fd2-57e79f7c8bca", "foo": "baz"}\n'
+        )
+
 class TestFind(DatabaseTest):
     def test_single(self):
         A.create([
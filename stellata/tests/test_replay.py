@@ -0,0 +1,95 @@
+import stellata.database
+import stellata.fields
+import stellata.model
+import stellata.replay
+import stellata.tests.base
+
+import datetime
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+db = stellata.tests.base.db
+
+class A(stellata.model.Model):
+    __table__ = 'a'
+
+    id = stellata.fields.UUID()
+    foo = stellata.fields.Text()
+    dt = stellata.fields.Timestamp()
+
+class TestReplay(stellata.tests.base.Base):
+    up = '''
+    create table if not exists a (
+        id uuid not null default uuid_generate_v1mc(),
+        foo text not null,
+        dt timestamp without time zone not null default now()
+    );
+    '''
+
+    down = '''
+    drop table if exists a;
+    '''
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'workload.msgpack.gz')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super().tearDown()
+
+    def workload(self, pool):
+        A.on(pool).create([A(foo='bar'), A(foo='baz')])
+        return A.on(pool).where(A.foo == 'bar').get()
+
+    def test_diff(self):
+        with stellata.replay.RecordingPool(db, self.path) as recording:
+            self.workload(recording)
+
+        other = os.path.join(self.directory.name, 'other.msgpack')
+        with stellata.replay.RecordingPool(db, other) as recording:
+            self.workload(recording)
+            self.workload(recording)
+
+        changes = stellata.replay.diff(self.path, other)
+        self.assertEqual(
+            changes['select "a"."id" as "a.id","a"."foo" as "a.foo","a"."dt" as "a.dt" from "a" where "a"."foo" = %s'],
+            (1, 2)
+        )
+
+    def test_replay(self):
+        with stellata.replay.RecordingPool(db, self.path) as recording:
+            recorded = self.workload(recording)
+
+        db.execute('truncate a')
+        replay = stellata.replay.ReplayPool(self.path)
+        result = self.workload(replay)
+        self.assertEqual(replay.queries, 2)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].id, recorded[0].id)
+        self.assertIsInstance(result[0].dt, datetime.datetime)
+        self.assertEqual(result[0].dt, recorded[0].dt)
+
+    def test_strict(self):
+        stellata.replay.RecordingPool(db, self.path).save()
+        replay = stellata.replay.ReplayPool(self.path)
+        with self.assertRaises(stellata.replay.ReplayError):
+            A.on(replay).where(A.foo == 'bar').get()
+
+        replay = stellata.replay.ReplayPool(self.path, strict=False)
+        self.assertEqual(A.on(replay).where(A.foo == 'bar').get(), [])
+
+class TestRowcount(unittest.TestCase):
+    def test(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'workload.msgpack')
+            pool = unittest.mock.Mock()
+            pool.execute.return_value = 3
+            with stellata.replay.RecordingPool(pool, path) as recording:
+                self.assertEqual(A.on(recording).where(A.foo == 'bar').delete(), 3)
+
+            replay = stellata.replay.ReplayPool(path)
+            self.assertEqual(A.on(replay).where(A.foo == 'bar').delete(), 3)
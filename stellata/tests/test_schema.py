@@ -1,8 +1,15 @@
+import datetime
+import psycopg2.errors
 import stellata.database
 import stellata.fields
+import stellata.functions
 import stellata.index
+import stellata.instrument
+import stellata.relations
 import stellata.schema
 import stellata.tests.base
+import unittest
+import unittest.mock
 
 db = stellata.tests.base.db
 
@@ -388,3 +395,388 @@ class TestNoop(Base):
     def test(self):
         result = super().test()
         self.assertEqual(result, [])
+
+class TestIntrospection(Base):
+    up = TestNoop.up
+
+    def test(self):
+        queries = []
+        stellata.instrument.on_query(queries.append)
+        timings = {}
+        try:
+            result = stellata.schema.migrate(db, models=[A, B], timings=timings)
+        finally:
+            stellata.instrument.off_query(queries.append)
+
+        self.assertEqual(result, [])
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(set(timings), {'introspect', 'tables', 'partitions', 'indexes', 'execute'})
+
+    def test_catalog(self):
+        catalog = stellata.schema.Catalog.load(db, ['a', 'b'])
+        self.assertEqual(catalog.columns['b'], [
+            ('id', 'uuid', None, 'uuid_generate_v1mc()', 'NO', None),
+            ('bar', 'integer', None, None, 'YES', None),
+            ('baz', 'character varying', 255, None, 'YES', None),
+        ])
+        self.assertEqual([e[1] for e in catalog.primary_keys['a']], ['a_pkey'])
+        self.assertEqual([e[1] for e in catalog.indexes['b']], ['b__bar_baz_index'])
+
+class TestOnline(Base):
+    up = TestMissingPrimaryKey.up
+
+    def test(self):
+        db.execute('drop index "b__bar_baz_index"')
+        result = stellata.schema.migrate(db, models=[A, B], online=True)
+        self.assertEqual(result, [
+            'create unique index concurrently "a_pkey__new" on "a" using btree (id) ;',
+            'alter table a add constraint a_pkey primary key using index a_pkey__new ;',
+            'create unique index concurrently "b__bar_baz_index" on "b" using btree (bar, baz) ;'
+        ])
+
+        stellata.schema.migrate(db, models=[A, B], online=True, execute=True)
+        self.assertEqual(stellata.schema.migrate(db, models=[A, B]), [])
+
+class TestOnlineModifyColumnType(Base):
+    up = TestModifyColumnType.up
+
+    def test(self):
+        db.execute("insert into a (foo) values (1), (2), (null)")
+        result = stellata.schema.migrate(db, models=[A, B], online=True, batch_size=1)
+        self.assertEqual(result[:5], [
+            'alter table "a" add column if not exists "foo__new" text ;',
+            'create or replace function "a__foo__sync"() returns trigger as $$ begin new."foo__new" := '
+                'new."foo"::text ; return new ; end $$ language plpgsql ;',
+            'drop trigger if exists "a__foo__sync" on "a" ; create trigger "a__foo__sync" before insert or update '
+                'on "a" for each row execute procedure "a__foo__sync"() ;',
+            'update "a" set "foo__new" = "foo"::text where ctid = any(array(select ctid from "a" where "foo__new" '
+                'is null and "foo" is not null limit 1)) ;',
+            'drop trigger "a__foo__sync" on "a" ; drop function "a__foo__sync"() ; alter table "a" drop column '
+                '"foo" ; alter table "a" rename column "foo__new" to "foo" ;'
+        ])
+        self.assertIn('create index concurrently "a__foo_index" on "a" using btree (foo) ;', result)
+
+        stellata.schema.migrate(db, models=[A, B], online=True, execute=True, batch_size=1)
+        self.assertEqual(stellata.schema.migrate(db, models=[A, B]), [])
+        self.assertEqual(sorted(e[0] for e in db.query('select foo from a where foo is not null')), ['1', '2'])
+
+class TestOnlineNotNull(unittest.TestCase):
+    def test(self):
+        self.assertEqual(stellata.schema._alter_table_string(B.id, online=True)[1:5], [
+            'alter table "b" drop constraint if exists "b__id__not_null" , add constraint "b__id__not_null" check '
+                '("id" is not null) not valid ;',
+            'alter table "b" validate constraint "b__id__not_null" ;',
+            'alter table "b" alter column "id" set not null ;',
+            'alter table "b" drop constraint "b__id__not_null" ;',
+        ])
+
+    def test_swap(self):
+        result = stellata.schema._swap_column_strings(B.id)
+        self.assertNotIn('alter table "b" alter column "id" set not null ;', result[:5])
+        self.assertEqual(result[5], 'alter table "b" drop constraint if exists "b__id__not_null" , add constraint '
+            '"b__id__not_null" check ("id" is not null) not valid ;')
+
+class TestOnlineRetry(unittest.TestCase):
+    def test(self):
+        database = unittest.mock.MagicMock()
+        database.execute.side_effect = [psycopg2.errors.LockNotAvailable(), 1]
+        with unittest.mock.patch('time.sleep') as sleep:
+            stellata.schema._execute(database, 'alter table a add primary key (id) ;', lock_timeout=1.0, retries=1)
+
+        self.assertEqual(database.execute.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_backfill(self):
+        database = unittest.mock.MagicMock()
+        database.execute.side_effect = [10, 10, 3, 0]
+        stellata.schema._execute(database, stellata.schema.Backfill('update a'), lock_timeout=1.0)
+        self.assertEqual(database.execute.call_count, 4)
+
+    def test_concurrent(self):
+        database = unittest.mock.MagicMock()
+        statement = stellata.schema.Concurrent('create index concurrently "a__foo" on "a" (foo) ;', 'a__foo')
+        stellata.schema._execute(database, statement, lock_timeout=1.0)
+        database.execute.assert_has_calls([
+            unittest.mock.call('drop index concurrently if exists "a__foo" ;', autocommit=True, lock_timeout=1.0),
+            unittest.mock.call(statement, autocommit=True, lock_timeout=1.0),
+        ])
+
+    def test_gives_up(self):
+        database = unittest.mock.MagicMock()
+        database.execute.side_effect = psycopg2.errors.LockNotAvailable()
+        with unittest.mock.patch('time.sleep'):
+            with self.assertRaises(psycopg2.errors.LockNotAvailable):
+                stellata.schema._execute(database, 'alter table a add primary key (id) ;', lock_timeout=1.0, retries=2)
+
+        self.assertEqual(database.execute.call_count, 3)
+
+class TestFingerprint(Base):
+    down = Base.down + 'drop table if exists stellata_schema;'
+
+    def test(self):
+        self.assertEqual(len(stellata.schema.migrate(db, models=[A, B], execute=True, fingerprint=True)), 20)
+
+        queries = []
+        stellata.instrument.on_query(queries.append)
+        try:
+            result = stellata.schema.migrate(db, models=[A, B], fingerprint=True)
+        finally:
+            stellata.instrument.off_query(queries.append)
+
+        self.assertEqual(result, [])
+        self.assertEqual(len(queries), 1)
+
+    def test_changed(self):
+        stellata.schema.migrate(db, models=[A], execute=True, fingerprint=True)
+        db.execute('drop index a__foo_index')
+        self.assertEqual(stellata.schema.migrate(db, models=[A], fingerprint=True), [])
+        self.assertEqual(stellata.schema.migrate(db, models=[A, B], fingerprint=True)[-2:], [
+            'create index "a__foo_index" on "a" using btree (foo) ;',
+            'create unique index "b__bar_baz_index" on "b" using btree (bar, baz) ;'
+        ])
+
+    def test_stable(self):
+        class C(stellata.model.Model):
+            __table__ = 'a'
+
+            foo = stellata.fields.Text()
+            id = stellata.fields.UUID(null=False)
+
+            primary_key = stellata.index.PrimaryKey(lambda: C.id)
+            foo_index = stellata.index.Index(lambda: C.foo)
+
+        class D(stellata.model.Model):
+            __table__ = 'a'
+
+            id = stellata.fields.UUID(null=False)
+            foo = stellata.fields.Text(null=False)
+
+            foo_index = stellata.index.Index(lambda: D.foo)
+            primary_key = stellata.index.PrimaryKey(lambda: D.id)
+
+        self.assertEqual(stellata.schema.fingerprint([A, B]), stellata.schema.fingerprint([B, A]))
+        self.assertEqual(stellata.schema.fingerprint([A]), stellata.schema.fingerprint([C]))
+        self.assertNotEqual(stellata.schema.fingerprint([A]), stellata.schema.fingerprint([D]))
+
+class E(stellata.model.Model):
+    __table__ = 'e'
+
+    id = stellata.fields.UUID(null=False)
+    foo = stellata.fields.Text()
+    bar = stellata.fields.Integer()
+    dt = stellata.fields.Timestamp()
+
+    foo_bar_index = stellata.index.Index(
+        lambda: (E.foo, (E.bar, 'desc')),
+        unique=True,
+        include=lambda: E.id,
+        where=lambda: (E.foo << ['a', "b'c"]) & (E.dt == None)
+    )
+    dt_index = stellata.index.Index(lambda: E.dt, method='brin')
+    foo_index = stellata.index.Index(lambda: E.foo, method='hash', where=lambda: E.bar > 5)
+
+class F(stellata.model.Model):
+    __table__ = 'e'
+
+    id = stellata.fields.UUID(null=False)
+    bar = stellata.fields.Integer()
+    dt = stellata.fields.Timestamp()
+
+    bar_index = stellata.index.Index(
+        lambda: F.bar,
+        where=lambda: (F.bar < -1) | (F.dt > datetime.datetime(2020, 1, 1))
+    )
+
+class TestIndexOptions(Base):
+    down = 'drop table if exists e;'
+
+    def test(self):
+        self.assertEqual(stellata.schema.migrate(db, models=[E])[-3:], [
+            'create unique index "e__foo_bar_index" on "e" using btree (foo, bar desc) include (id) '
+                'where ("foo" in (\'a\',\'b\'\'c\') and "dt" is null) ;',
+            'create index "e__dt_index" on "e" using brin (dt) ;',
+            'create index "e__foo_index" on "e" using hash (foo) where "bar" > 5 ;',
+        ])
+
+        stellata.schema.migrate(db, models=[E], execute=True)
+        self.assertEqual(stellata.schema.migrate(db, models=[E]), [])
+
+    def test_casts(self):
+        # postgres writes negative numbers and timestamps differently than they're written here
+        stellata.schema.migrate(db, models=[F], execute=True)
+        self.assertEqual(stellata.schema.migrate(db, models=[F]), [])
+
+    def test_changed(self):
+        db.execute('''
+            create table e (id uuid default uuid_generate_v1mc() not null, foo text, bar integer, dt timestamp
+                default now());
+            create unique index e__foo_bar_index on e using btree (foo, bar) include (id)
+                where foo = any (array['a', 'b''c']) and dt is null;
+            create index e__dt_index on e using btree (dt);
+            create index e__foo_index on e using hash (foo) where bar > 6;
+        ''')
+
+        self.assertEqual(stellata.schema.migrate(db, models=[E]), [
+            'drop index "e__foo_bar_index" ;',
+            'create unique index "e__foo_bar_index" on "e" using btree (foo, bar desc) include (id) '
+                'where ("foo" in (\'a\',\'b\'\'c\') and "dt" is null) ;',
+            'drop index "e__dt_index" ;',
+            'create index "e__dt_index" on "e" using brin (dt) ;',
+            'drop index "e__foo_index" ;',
+            'create index "e__foo_index" on "e" using hash (foo) where "bar" > 5 ;',
+        ])
+
+class TestRender(unittest.TestCase):
+    def test(self):
+        database = unittest.mock.MagicMock()
+        database.query.return_value = [
+            ('index', 'stellata_scratch_0', 'g__email_index', 'CREATE UNIQUE INDEX g__email_index ON '
+                'pg_temp_3.stellata_scratch_0 USING btree (lower(email))'),
+            ('column', 'stellata_scratch_0', 'day', "date_trunc('day'::text, dt)"),
+        ]
+
+        catalog = stellata.schema.Catalog(columns={'g': [('id', 'uuid', None, None, 'NO', None)]})
+        catalog.render(database, [E, G])
+        sql = database.query.call_args[0][0]
+        self.assertIn('create temporary table "stellata_scratch_0" ("id" uuid, "email" text, "email_lower" text '
+            'generated always as (lower("email")) stored, ', sql)
+        self.assertIn('create unique index "g__email_index" on "stellata_scratch_0" using btree ((lower("email"))) ;',
+            sql)
+        self.assertNotIn('stellata_scratch_1', sql)
+        self.assertEqual(catalog.rendered, {
+            'g__email_index': 'CREATE UNIQUE INDEX g__email_index USING btree (lower(email))',
+            ('g', 'day'): "date_trunc('day'::text, dt)",
+        })
+
+    def test_compare(self):
+        catalog = stellata.schema.Catalog(
+            indexes={'e': [
+                ('e', 'e__foo_index', 'CREATE INDEX e__foo_index ON public.e USING hash (foo) WHERE (bar > 5)'),
+            ]},
+            rendered={'e__foo_index': 'CREATE INDEX e__foo_index USING hash (foo) WHERE (bar > 5)'}
+        )
+        result = stellata.schema._migrate_indexes(db, [E], False, catalog)
+        self.assertNotIn('drop index "e__foo_index" ;', result)
+
+        catalog.rendered['e__foo_index'] = 'CREATE INDEX e__foo_index USING hash (foo) WHERE (bar > 6)'
+        result = stellata.schema._migrate_indexes(db, [E], False, catalog)
+        self.assertIn('drop index "e__foo_index" ;', result)
+
+    def test_empty(self):
+        database = unittest.mock.MagicMock()
+        stellata.schema.Catalog().render(database, [E])
+        database.query.assert_not_called()
+
+class TestIndexDefinition(unittest.TestCase):
+    def test_columns(self):
+        self.assertEqual(E.foo_bar_index.columns(), ((E.foo, None), (E.bar, 'desc')))
+        self.assertEqual(E.foo_bar_index.fields(), (E.foo, E.bar))
+        self.assertEqual(stellata.index.Index(lambda: (E.bar, 'desc')).columns(), ((E.bar, 'desc'),))
+
+    def test_method(self):
+        with self.assertRaises(ValueError):
+            stellata.index.Index(lambda: E.foo, method='bogus')
+
+class G(stellata.model.Model):
+    __table__ = 'g'
+
+    id = stellata.fields.UUID(null=False)
+    email = stellata.fields.Text()
+    email_lower = stellata.fields.Text(generated=lambda: stellata.functions.Lower(G.email))
+    day = stellata.fields.Timestamp(generated=lambda: stellata.functions.DateTrunc('day', G.dt))
+    dt = stellata.fields.Timestamp()
+
+    email_index = stellata.index.Index(lambda: stellata.functions.Lower(G.email), unique=True)
+    day_index = stellata.index.Index(lambda: (stellata.functions.DateTrunc('day', G.dt), 'desc'))
+
+class TestGenerated(Base):
+    down = 'drop table if exists g;'
+
+    def test(self):
+        self.assertEqual(stellata.schema.migrate(db, models=[G])[-6:], [
+            'alter table "g" add column "email_lower" text generated always as (lower("email")) stored ;',
+            'alter table "g" alter column "email_lower" drop not null ;',
+            'alter table "g" add column "day" timestamp without time zone generated always as '
+                '(date_trunc(\'day\', "dt")) stored ;',
+            'alter table "g" alter column "day" drop not null ;',
+            'create unique index "g__email_index" on "g" using btree ((lower("email"))) ;',
+            'create index "g__day_index" on "g" using btree ((date_trunc(\'day\', "dt")) desc) ;',
+        ])
+
+        stellata.schema.migrate(db, models=[G], execute=True)
+        self.assertEqual(stellata.schema.migrate(db, models=[G]), [])
+
+        G.on(db).create(G(email='Foo'))
+        self.assertEqual(G.on(db).where(stellata.functions.Lower(G.email) == 'foo').get()[0].email_lower, 'foo')
+
+    def test_changed(self):
+        db.execute('''
+            create table g (id uuid default uuid_generate_v1mc() not null, dt timestamp default now(), email text,
+                email_lower text generated always as (upper(email)) stored, day timestamp);
+            create unique index g__email_index on g ((lower(email)));
+            create index g__day_index on g ((date_trunc('day', dt)) desc);
+        ''')
+
+        self.assertEqual(stellata.schema.migrate(db, models=[G]), [
+            'alter table "g" drop column "email_lower" ;',
+            'alter table "g" add column "email_lower" text generated always as (lower("email")) stored ;',
+            'alter table "g" alter column "email_lower" drop not null ;',
+            'alter table "g" drop column "day" ;',
+            'alter table "g" add column "day" timestamp without time zone generated always as '
+                '(date_trunc(\'day\', "dt")) stored ;',
+            'alter table "g" alter column "day" drop not null ;',
+        ])
+
+class H(stellata.model.Model):
+    __table__ = 'h'
+
+    id = stellata.fields.UUID(null=False)
+    a_id = stellata.fields.UUID()
+    b_id = stellata.fields.UUID()
+
+    a = stellata.relations.BelongsTo(lambda: H.a_id, lambda: A)
+    b = stellata.relations.BelongsTo(lambda: H.b_id, lambda: B)
+
+    b_id_index = stellata.index.Index(lambda: (H.b_id, H.id))
+    primary_key = stellata.index.PrimaryKey(lambda: H.id)
+
+class TestForeignKeyIndexes(Base):
+    down = 'drop table if exists h;'
+
+    def test(self):
+        with self.assertLogs('stellata', 'WARNING') as logs:
+            self.assertNotIn('create index "h__a_id__fkey" on "h" using btree (a_id) ;', stellata.schema.migrate(
+                db,
+                models=[H]
+            ))
+
+        self.assertIn('h.a_id', logs.output[0])
+
+        result = stellata.schema.migrate(db, models=[H], foreign_key_indexes='create')
+        index = result.index('create index concurrently "h__a_id__fkey" on "h" using btree (a_id) ;')
+        self.assertIsInstance(result[index], stellata.schema.Concurrent)
+
+        stellata.schema.migrate(db, models=[H], execute=True, foreign_key_indexes='create')
+        self.assertEqual(stellata.schema.migrate(db, models=[H], foreign_key_indexes='create'), [])
+
+    def test_catalog(self):
+        catalog = stellata.schema.Catalog(indexes={'h': [
+            ('h', 'h__b_id_index', 'CREATE INDEX h__b_id_index ON public.h USING btree (a_id)'),
+            ('h', 'h_a_id_partial', 'CREATE INDEX h_a_id_partial ON public.h USING btree (a_id) WHERE (b_id IS NULL)'),
+            ('h', 'h_a_id', 'CREATE INDEX h_a_id ON public.h USING btree (a_id, id)'),
+        ]})
+        indexes = stellata.schema._foreign_key_indexes([H], catalog)
+        self.assertEqual([e.existing for e in indexes[H]], ['h_a_id'])
+
+        result = stellata.schema._migrate_indexes(db, [H], False, catalog, foreign_key_indexes=indexes)
+        self.assertNotIn('drop index "h_a_id" ;', result)
+        self.assertNotIn('create index "h__a_id__fkey" on "h" using btree (a_id) ;', result)
+
+    def test_covered(self):
+        indexes = stellata.schema._foreign_key_indexes([H])
+        self.assertEqual([e.column for e in indexes[H]], ['a_id__fkey'])
+        self.assertIsNone(indexes[H][0].existing)
+
+    def test_mode(self):
+        with self.assertRaises(ValueError):
+            stellata.schema.migrate(db, models=[H], foreign_key_indexes='bogus')